@@ -9,170 +9,2002 @@ from ansible.module_utils.aos import *
 
 """
 import os
+import sys
+import bisect
 import json
-import requests
-import ipaddress
-from requests.adapters import HTTPAdapter
+import time
+import fcntl
+import base64
+import codecs
+import random
+import atexit
+import functools
+import socket
+import hashlib
+import importlib
+import threading
+from urllib.parse import quote
+from datetime import timedelta
 from ansible.module_utils.parsing.convert_bool import boolean
 
 
+class _LazyModule(object):
+    """
+    Placeholder of a module imported on first attribute access, which then
+    takes its place in this namespace. Keeps the startup of short-lived
+    module processes free of imports their code path never uses.
+    """
+
+    def __init__(self, name, binding=None):
+        self._name = name
+        self._binding = binding or name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._binding] = module
+
+        return getattr(module, attr)
+
+
+requests = _LazyModule('requests')
+asyncio = _LazyModule('asyncio')
+futures = _LazyModule('concurrent.futures', 'futures')
+ipaddress = _LazyModule('ipaddress')
+tempfile = _LazyModule('tempfile')
+subprocess = _LazyModule('subprocess')
+# Retry policy, traced connections and the urllib3-only transport
+_http = _LazyModule('{}aos_http'.format(__name__[:__name__.rfind('.') + 1]),
+                    '_http')
+
+# Connections to each AOS server are kept alive and shared by every helper
+# for the lifetime of the process. Size and idle eviction are tunable.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_IDLE_TIMEOUT = 60
+
+# Retries of failed requests, with exponential backoff between them
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Optional local broker (see aos_broker.py) holding warm connections across
+# module processes. Used when AOS_BROKER_SOCKET is set.
+BROKER_START_TIMEOUT = 5
+
+# Number of requests issued in parallel by bulk operations
+DEFAULT_CONCURRENCY = 8
+
+# Bytes read at a time from streamed collection responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Seconds a cached collection is served before being revalidated
+DEFAULT_CACHE_TTL = 30
+
+# Size of the on-disk cache, least recently used entries are dropped first
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Delay bounds in seconds between two polls of a long running AOS operation
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_POLL_MAX_INTERVAL = 30
+
+# Cached auth tokens are renewed this many seconds before they expire
+DEFAULT_TOKEN_REFRESH = 60
+
+# PBKDF2 rounds of the password digest kept with cached tokens
+PASSWD_DIGEST_ROUNDS = 100000
+
+POOL_ENDPOINTS = {'asn': 'resources/asn-pools',
+                  'vni': 'resources/vni-pools',
+                  'ipv4': 'resources/ip-pools',
+                  'ipv6': 'resources/ipv6-pools'}
+
+# Compressed encodings accepted from the AOS server. Brotli is decoded by
+# urllib3 only when a brotli package is installed.
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+_session_pool = {}
+_session_pool_lock = threading.Lock()
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+# Requests sent by this process, recorded when AOS_METRICS is set
+_metrics = []
+_metrics_lock = threading.Lock()
+
+# W3C trace id and parent span id of the spans written by this process
+_trace_context = None
+_trace_lock = threading.Lock()
+
+# Blueprint versions read by this process, keyed on (server, blueprint id)
+_blueprint_versions = {}
+
+
 def requests_header(session):
     return {'AUTHTOKEN': session['token'],
             'Accept': "application/json",
             'Content-Type': "application/json",
+            'Accept-Encoding': ACCEPT_ENCODING,
             'cache-control': "no-cache"}
 
 
-def set_requests_verify():
-    return boolean(os.environ.get('AOS_VERIFY_CERTIFICATE', 'True'))
+def set_requests_verify():
+    return boolean(os.environ.get('AOS_VERIFY_CERTIFICATE', 'True'))
+
+
+def pool_size():
+    return int(os.environ.get('AOS_POOL_SIZE', DEFAULT_POOL_SIZE))
+
+
+def pool_idle_timeout():
+    return float(os.environ.get('AOS_POOL_IDLE_TIMEOUT',
+                                DEFAULT_POOL_IDLE_TIMEOUT))
+
+
+def http_transport():
+    """
+    :return: string ('requests', or 'urllib3' to send requests without
+             loading requests)
+    """
+    return os.environ.get('AOS_HTTP_TRANSPORT', 'requests').lower()
+
+
+def retry_count():
+    return int(os.environ.get('AOS_RETRIES', DEFAULT_RETRIES))
+
+
+def retry_backoff():
+    return float(os.environ.get('AOS_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF))
+
+
+def retry_policy(retries=None):
+    """
+    :param retries: int (AOS_RETRIES by default)
+    :return: urllib3 Retry
+    """
+    retries = retry_count() if retries is None else retries
+
+    return _http.AosRetry(total=retries,
+                          status_forcelist=RETRY_STATUSES,
+                          backoff_factor=retry_backoff(),
+                          respect_retry_after_header=True,
+                          raise_on_status=False)
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by every thread of the process, allowing rate
+    requests per second on average in bursts of up to burst requests
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, self.rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                # Tolerate rounding errors of the refill computation
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def rate_limiter():
+    """
+    Return the process rate limiter configured by AOS_RATE_LIMIT (requests
+    per second) and AOS_RATE_BURST, or None when requests are not limited
+    :return: RateLimiter
+    """
+    global _rate_limiter
+
+    rate = float(os.environ.get('AOS_RATE_LIMIT') or 0)
+    burst = float(os.environ.get('AOS_RATE_BURST') or 0)
+
+    if rate <= 0:
+        return None
+
+    burst = burst or max(1, rate)
+
+    with _rate_limiter_lock:
+        if _rate_limiter is None or \
+                (_rate_limiter.rate, _rate_limiter.burst) != (rate, burst):
+            _rate_limiter = RateLimiter(rate, burst)
+
+        return _rate_limiter
+
+
+def requests_retry(retries=None, session=None, size=DEFAULT_POOL_SIZE):
+
+    session = session or requests.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry_policy(retries),
+                                            pool_connections=size,
+                                            pool_maxsize=size)
+
+    # Connections report their setup timings when requests are traced
+    adapter.poolmanager.pool_classes_by_scheme = _http.TRACED_POOL_CLASSES
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def evict_idle_sessions(now=None):
+    """
+    Close pooled sessions that have not been used within the idle timeout
+    :param now: float
+    :return: None
+    """
+    now = now or time.time()
+    timeout = pool_idle_timeout()
+
+    with _session_pool_lock:
+        for key, entry in list(_session_pool.items()):
+            if now - entry['last_used'] > timeout:
+                entry['session'].close()
+                del _session_pool[key]
+
+
+def get_pooled_session(server, verify=None):
+    """
+    Return the shared keep-alive session for an AOS server, creating it
+    on first use. Sessions are keyed on server, certificate verification
+    and transport.
+    :param server: string
+    :param verify: bool
+    :return: requests.Session or aos_http.Urllib3Session
+    """
+    if verify is None:
+        verify = set_requests_verify()
+
+    now = time.time()
+    evict_idle_sessions(now)
+
+    transport = http_transport()
+    key = (server, verify, transport)
+    with _session_pool_lock:
+        entry = _session_pool.get(key)
+
+        if entry is None:
+            if transport == 'urllib3':
+                http = _http.Urllib3Session(retry_policy(), pool_size(),
+                                            verify)
+            else:
+                http = requests_retry(size=pool_size())
+                http.verify = verify
+            entry = _session_pool[key] = {'session': http}
+
+        entry['last_used'] = now
+
+        return entry['session']
+
+
+@atexit.register
+def close_pooled_sessions():
+    with _session_pool_lock:
+        for entry in _session_pool.values():
+            entry['session'].close()
+        _session_pool.clear()
+
+
+def broker_socket():
+    return os.environ.get('AOS_BROKER_SOCKET')
+
+
+def _broker_call(socket_path, message):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with conn.makefile('rb') as reply:
+            line = reply.readline()
+    finally:
+        conn.close()
+
+    if not line:
+        raise requests.ConnectionError("AOS broker {} closed the connection"
+                                       .format(socket_path))
+
+    return json.loads(line.decode('utf-8'))
+
+
+def start_broker(socket_path):
+    """
+    Start the local AOS broker listening on socket_path unless one is
+    already answering, and wait for it to accept connections
+    :param socket_path: string
+    :return: None
+    """
+    try:
+        _broker_call(socket_path, {'op': 'ping'})
+        return
+    except (OSError, ValueError, requests.ConnectionError):
+        pass
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, '-m', 'library.aos_broker',
+                      '--socket', socket_path],
+                     cwd=repo_root,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+    deadline = time.time() + BROKER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            _broker_call(socket_path, {'op': 'ping'})
+            return
+        except (OSError, ValueError, requests.ConnectionError):
+            time.sleep(0.05)
+
+    raise requests.ConnectionError("Unable to start AOS broker on {}"
+                                   .format(socket_path))
+
+
+def broker_call(message, socket_path=None):
+    """
+    Send a message to the local AOS broker, starting it on first use
+    :param message: dict
+    :param socket_path: string
+    :return: dict
+    """
+    socket_path = socket_path or broker_socket()
+
+    try:
+        return _broker_call(socket_path, message)
+    except (OSError, requests.ConnectionError):
+        start_broker(socket_path)
+
+        return _broker_call(socket_path, message)
+
+
+def broker_request(method, url, headers, data, verify):
+    """
+    Relay an HTTP request through the local AOS broker
+    :param method: string
+    :param url: string
+    :param headers: dict
+    :param data: string
+    :param verify: bool
+    :return: requests.Response
+    """
+    reply = broker_call({'op': 'request',
+                         'method': method,
+                         'url': url,
+                         'headers': headers,
+                         'data': data,
+                         'verify': verify})
+
+    if 'error' in reply:
+        raise requests.ConnectionError(reply['error'])
+
+    response = requests.Response()
+    response.status_code = reply['status']
+    response.headers.update(reply['headers'])
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = reply['body'].encode('utf-8')
+
+    return response
+
+
+def broker_token(server, user, passwd):
+    """
+    Return the auth token the local broker holds for server and user, when
+    it was issued for passwd
+    :param server: string
+    :param user: string
+    :param passwd: string
+    :return: string or None
+    """
+    return broker_call({'op': 'token',
+                        'server': server,
+                        'user': user,
+                        'passwd': passwd}).get('token')
+
+
+def requests_response(response):
+    return response.json() if response.ok else response.raise_for_status()
+
+
+def response_error(response):
+    """
+    Describe a request refused by AOS
+    :param response: requests.Response
+    :return: string
+    """
+    return "{} {}".format(response.status_code, response.text)
+
+
+def aos_url(server, endpoint):
+    # AOS_API_SCHEME=http is meant for local test servers only
+    scheme = os.environ.get('AOS_API_SCHEME', 'https')
+
+    return "{}://{}/api/{}".format(scheme, server, endpoint)
+
+
+def aos_request(session, method, endpoint, payload=None, headers=None,
+                stream=False, timeout=None):
+    """
+    Send a request to the aos RestApi over the pooled server session, or
+    through the local broker when AOS_BROKER_SOCKET is set
+    :param session: dict
+    :param method: string
+    :param endpoint: string
+    :param payload: dict
+    :param headers: dict
+    :param stream: bool (read the response body lazily)
+    :param timeout: float (seconds, AOS_REQUEST_TIMEOUT by default)
+    :return: requests.Response
+    """
+    url = aos_url(session['server'], endpoint)
+    data = json.dumps(payload) if payload is not None else None
+
+    if session.get('user') and token_expiring(session.get('token')):
+        refresh_session_token(session)
+
+    headers = headers or requests_header(session)
+
+    # GraphQL POSTs are reads
+    if method != 'GET' and not endpoint.endswith('/ql'):
+        cache_invalidate(session['server'], endpoint)
+
+    timeout = request_timeout() if timeout is None else timeout
+    response = _aos_send(session, method, endpoint, url, data, headers,
+                         stream, timeout)
+
+    # The token was revoked or expired: log in again once and replay
+    if response.status_code == 401 and 'AUTHTOKEN' in headers and \
+            session.get('user') and refresh_session_token(session):
+        response.close()
+        headers = dict(headers, AUTHTOKEN=session['token'])
+        response = _aos_send(session, method, endpoint, url, data, headers,
+                             stream, timeout)
+
+    return response
+
+
+def _aos_send(session, method, endpoint, url, data, headers, stream=False,
+              timeout=None):
+    limiter = rate_limiter()
+    if limiter:
+        limiter.acquire()
+
+    traced = trace_enabled()
+    timings = None
+    start = time.time()
+
+    try:
+        if broker_socket():
+            # Connections are set up by the broker process
+            response = broker_request(method, url, headers, data,
+                                      set_requests_verify())
+        else:
+            http = get_pooled_session(session['server'])
+
+            if traced:
+                timings = _http.trace_local.timings = {}
+
+            response = http.request(method, url,
+                                    data=data,
+                                    headers=headers,
+                                    verify=http.verify,
+                                    stream=stream,
+                                    timeout=timeout)
+    except requests.RequestException as e:
+        if traced:
+            record_metric(method, endpoint, data, None, time.time() - start,
+                          server=session['server'], start=start,
+                          timings=timings, error=e)
+        raise
+    finally:
+        if timings is not None:
+            _http.trace_local.timings = None
+
+    if traced:
+        record_metric(method, endpoint, data, response, time.time() - start,
+                      stream, server=session['server'], start=start,
+                      timings=timings)
+
+    return response
+
+
+def request_timeout():
+    """
+    :return: float (seconds) or None to wait for the AOS server forever
+    """
+    timeout = os.environ.get('AOS_REQUEST_TIMEOUT')
+
+    return float(timeout) if timeout else None
+
+
+def metrics_enabled():
+    return boolean(os.environ.get('AOS_METRICS', False))
+
+
+def trace_file():
+    path = os.environ.get('AOS_TRACE_FILE')
+
+    return os.path.expanduser(path) if path else None
+
+
+def trace_format():
+    """
+    :return: string ('aos' entries or 'otel' OTLP/JSON spans)
+    """
+    return os.environ.get('AOS_TRACE_FORMAT', 'aos').lower()
+
+
+def trace_enabled():
+    return metrics_enabled() or bool(trace_file())
+
+
+def request_retries(response):
+    """
+    :return: int (retries urllib3 made before this response)
+    """
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    history = getattr(retries, 'history', None)
+
+    return len(history) if isinstance(history, tuple) else 0
+
+
+def request_timings(response, elapsed, timings):
+    """
+    Timings in seconds of a request: dns, connect and tls set up a new
+    connection (None on a reused one), ttfb runs from the start of the
+    request to its response headers and total to the end of its body
+    :param response: requests.Response
+    :param elapsed: float
+    :param timings: dict (connection timings, None when unknown)
+    :return: dict or None
+    """
+    if timings is None:
+        return None
+
+    ttfb = getattr(response, 'elapsed', None)
+
+    def seconds(name):
+        value = timings.get(name)
+        return round(value, 6) if value is not None else None
+
+    return {'reused': 'connect' not in timings,
+            'dns': seconds('dns'),
+            'connect': seconds('connect'),
+            'tls': seconds('tls'),
+            'ttfb': round(ttfb.total_seconds(), 6)
+            if isinstance(ttfb, timedelta) else None,
+            'total': round(elapsed, 6)}
+
+
+def record_metric(method, endpoint, data, response, elapsed, stream=False,
+                  server=None, start=None, timings=None, error=None):
+    """
+    Record the sizes, status, timings and retries of a request. The size
+    and total time of a streamed body are added by its reader (see
+    aos_get_items).
+    :param response: requests.Response (None when the request failed)
+    :param timings: dict (connection timings collected while sending)
+    :param error: Exception
+    :return: dict (the recorded entry)
+    """
+    headers = response.headers if response is not None else {}
+    wire_bytes = headers.get('Content-Length')
+    start = time.time() - elapsed if start is None else start
+
+    entry = {'method': method,
+             'endpoint': endpoint,
+             'server': server,
+             'status': response.status_code if response is not None else None,
+             'request_bytes': len(data or ''),
+             'response_bytes': 0 if stream or response is None
+             else len(response.content or b''),
+             'wire_bytes': int(wire_bytes) if wire_bytes else None,
+             'encoding': headers.get('Content-Encoding'),
+             'start': round(start, 6),
+             'elapsed': round(elapsed, 6),
+             'retries': request_retries(response),
+             'timings': request_timings(response, elapsed, timings)}
+
+    if error is not None:
+        entry['error'] = "{}: {}".format(type(error).__name__, error)
+
+    if response is not None:
+        response.aos_metric = entry
+
+    if metrics_enabled():
+        with _metrics_lock:
+            _metrics.append(entry)
+
+    if not stream:
+        write_trace(entry)
+
+    return entry
+
+
+def finish_metric(metric):
+    """
+    Complete the entry of a streamed request once its body is read
+    :param metric: dict
+    :return: None
+    """
+    if metric.get('timings') and metric.get('start'):
+        metric['timings']['total'] = round(time.time() - metric['start'], 6)
+
+    write_trace(metric)
+
+
+def trace_context():
+    """
+    Return the W3C trace id and parent span id of the spans of this
+    process, taken from TRACEPARENT when the caller sets it
+    :return: tuple (string, string or None)
+    """
+    global _trace_context
+
+    with _trace_lock:
+        if _trace_context is None:
+            parent = os.environ.get('TRACEPARENT', '').split('-')
+
+            if len(parent) == 4 and len(parent[1]) == 32 and \
+                    len(parent[2]) == 16:
+                _trace_context = (parent[1], parent[2])
+            else:
+                _trace_context = (os.urandom(16).hex(), None)
+
+        return _trace_context
+
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # OTLP/JSON encodes 64 bit integers as strings
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+
+    return {'stringValue': str(value)}
+
+
+def _otel_attributes(attributes):
+    return [{'key': key, 'value': _otel_value(value)}
+            for key, value in sorted(attributes.items())
+            if value is not None]
+
+
+def otel_span(entry):
+    """
+    Convert a recorded request to an OpenTelemetry client span, as an
+    OTLP/JSON export request (one per line of a trace file)
+    :param entry: dict (see record_metric)
+    :return: dict
+    """
+    trace_id, parent_id = trace_context()
+    timings = entry.get('timings') or {}
+    start = int(entry['start'] * 1e9)
+    end = start + int((timings.get('total') or entry['elapsed']) * 1e9)
+
+    attributes = {'http.request.method': entry['method'],
+                  'server.address': entry.get('server'),
+                  'http.response.status_code': entry['status'],
+                  'http.request.body.size': entry['request_bytes'],
+                  'http.response.body.size': entry['response_bytes'],
+                  'http.request.resend_count': entry['retries'] or None,
+                  'error.type': entry.get('error'),
+                  'aos.endpoint': entry['endpoint']}
+
+    for name, value in timings.items():
+        attributes['aos.timing.' + name] = value
+
+    failed = entry.get('error') or (entry['status'] or 0) >= 400
+
+    span = {'traceId': trace_id,
+            'spanId': os.urandom(8).hex(),
+            'name': "{} {}".format(entry['method'], entry['endpoint']),
+            'kind': 3,
+            'startTimeUnixNano': str(start),
+            'endTimeUnixNano': str(end),
+            'attributes': _otel_attributes(attributes),
+            'status': {'code': 2 if failed else 0}}
+
+    if parent_id:
+        span['parentSpanId'] = parent_id
+
+    resource = {'service.name': 'aos-ansible',
+                'process.pid': os.getpid()}
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': _otel_attributes(resource)},
+        'scopeSpans': [{'scope': {'name': 'library.aos'},
+                        'spans': [span]}]}]}
+
+
+def write_trace(entry):
+    """
+    Append a recorded request to AOS_TRACE_FILE, as a JSON line
+    :param entry: dict
+    :return: None
+    """
+    path = trace_file()
+    if not path:
+        return
+
+    record = otel_span(entry) if trace_format() == 'otel' \
+        else dict(entry, pid=os.getpid())
+    line = json.dumps(record, sort_keys=True) + '\n'
+
+    # Tasks of parallel forks share the file
+    with open(path, 'a') as trace:
+        fcntl.flock(trace, fcntl.LOCK_EX)
+        trace.write(line)
+
+
+def aos_metrics():
+    """
+    Summary of the requests sent by this process, for the aos_metrics key
+    of module results
+    :return: dict
+    """
+    with _metrics_lock:
+        calls = list(_metrics)
+
+    return {'requests': len(calls),
+            'request_bytes': sum(c['request_bytes'] for c in calls),
+            'response_bytes': sum(c['response_bytes'] for c in calls),
+            'wire_bytes': sum(c['wire_bytes'] or 0 for c in calls),
+            'elapsed': round(sum(c['elapsed'] for c in calls), 6),
+            'retries': sum(c.get('retries', 0) for c in calls),
+            'calls': calls}
+
+
+def instrument_module(module):
+    """
+    Add aos_metrics to the results of a module when AOS_METRICS is set
+    :param module: AnsibleModule
+    :return: AnsibleModule
+    """
+    if not metrics_enabled():
+        return module
+
+    def wrap(func):
+        def result(*args, **kwargs):
+            kwargs.setdefault('aos_metrics', aos_metrics())
+            return func(*args, **kwargs)
+        return result
+
+    module.exit_json = wrap(module.exit_json)
+    module.fail_json = wrap(module.fail_json)
+
+    return module
+
+
+class _JsonStream(object):
+    """
+    Incremental JSON reader over chunks of text or UTF-8 bytes. Values are
+    decoded one at a time, and consumed text is dropped from the buffer.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Append the next chunk to the buffer
+        :return: bool (False at the end of the stream)
+        """
+        if self.eof:
+            return False
+
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buf += self.utf8.decode(b'', final=True)
+            return False
+
+        if isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk)
+
+        self.buf += chunk
+
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, '' at the end
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+
+        if not char or char not in chars:
+            raise ValueError("Invalid JSON: expected one of {!r}, got {!r}"
+                             .format(chars, char or 'end of data'))
+
+        self.pos += 1
+
+        return char
+
+    def value(self):
+        """
+        Decode the next complete JSON value
+        """
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+
+                # A value ending the buffer may be cut, ex. a number
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self.fill()
+
+    def items(self, key):
+        self.expect('{')
+
+        if self.peek() == '}':
+            return
+
+        while True:
+            name = self.value()
+            self.expect(':')
+
+            if name == key and self.peek() in ['[', '{']:
+                for item in self.container():
+                    yield item
+            else:
+                self.value()
+
+            if self.expect(',}') == '}':
+                return
+
+    def container(self):
+        close = ']' if self.expect('[{') == '[' else '}'
+
+        if self.peek() == close:
+            self.pos += 1
+            return
+
+        while True:
+            if close == '}':
+                self.value()
+                self.expect(':')
+
+            yield self.value()
+
+            if self.expect(',' + close) == close:
+                return
+
+
+def iter_json_items(chunks, key='items'):
+    """
+    Parse a JSON collection document ({key: [items]} or {key: {id: item}})
+    from chunks and yield its items one by one, without holding the whole
+    document in memory
+    :param chunks: iterable of bytes or strings
+    :param key: string (collection key in the document)
+    :return: generator of dict
+    """
+    return _JsonStream(chunks).items(key)
+
+
+def aos_get_items(session, endpoint, key='items'):
+    """
+    GET a collection and yield its items as they are read from the
+    response. The response is closed as soon as the caller stops iterating.
+    :param session: dict
+    :param endpoint: string
+    :param key: string (collection key in the response)
+    :return: generator of dict
+    """
+    response = aos_request(session, 'GET', endpoint, stream=True)
+    metric = getattr(response, 'aos_metric', None)
+
+    try:
+        if not response.ok:
+            response.raise_for_status()
+
+        chunks = response.iter_content(STREAM_CHUNK_SIZE)
+
+        if metric is not None:
+            chunks = _count_bytes(chunks, metric)
+
+        for item in iter_json_items(chunks, key):
+            yield item
+    finally:
+        response.close()
+
+        if metric is not None:
+            finish_metric(metric)
+
+
+def _count_bytes(chunks, metric):
+    for chunk in chunks:
+        metric['response_bytes'] += len(chunk)
+        yield chunk
+
+
+def find_item(items, uuid=None, name=None, label=None):
+    """
+    Find the first item with the given id, display_name or label. Reading
+    stops at the first id or name match, labels are read on to the end to
+    report repeated labels.
+    :param items: iterable of dict
+    :param uuid: string
+    :param name: string
+    :param label: string
+    :return: tuple (item or {}, True if the label is repeated)
+    """
+    found = {}
+
+    for item in items:
+        if uuid is not None and item.get('id') == uuid or \
+                name is not None and item.get('display_name') == name:
+            return item, False
+
+        if label is not None and item.get('label') == label:
+            if found:
+                return found, True
+
+            found = item
+
+    return found, False
+
+
+def aos_get(session, endpoint):
+    """
+    GET request aginst aos RestApi
+    :param session: dict
+    :param endpoint: string
+    :return: dict
+    """
+    if http_cache_enabled():
+        return cached_get(session, endpoint, ttl=0)
+
+    response = aos_request(session, 'GET', endpoint)
+
+    return requests_response(response)
+
+
+def aos_post(session, endpoint, payload):
+    """
+    POST request aginst aos RestApi
+    :param session: dict
+    :param endpoint: string
+    :param payload: string
+    :return: dict
+    """
+    response = aos_request(session, 'POST', endpoint, payload)
+
+    return requests_response(response)
+
+
+def aos_put(session, endpoint, payload):
+    """
+    PUT request aginst aos RestApi
+    :param session: dict
+    :param endpoint: string
+    :param payload: string
+    :return: dict
+    """
+    return aos_request(session, 'PUT', endpoint, payload)
+
+
+def aos_delete(session, endpoint, aos_id):
+    """
+    DELETE request aginst aos RestApi
+    :param session: dict
+    :param endpoint: string
+    :param aos_id: string
+    :return: dict
+    """
+    return aos_request(session, 'DELETE', "{}/{}".format(endpoint, aos_id))
+
+
+class AsyncAosClient(object):
+    """
+    asyncio client of the AOS RestApi. Requests go over the pooled
+    keep-alive sessions of this module on a dedicated thread pool, at most
+    concurrency at a time, each bounded by timeout seconds.
+
+    async with AsyncAosClient(session, concurrency=32) as client:
+        pools = await client.gather(*[client.get(e) for e in endpoints])
+    """
+
+    def __init__(self, session, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use, inside the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self._semaphore
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the client thread pool
+        """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+
+            return await asyncio.wait_for(future, self.timeout)
+
+    async def request(self, method, endpoint, payload=None, headers=None):
+        return await self.call(aos_request, self.session, method, endpoint,
+                               payload, headers, timeout=self.timeout)
+
+    async def get(self, endpoint):
+        return requests_response(await self.request('GET', endpoint))
+
+    async def post(self, endpoint, payload):
+        return requests_response(await self.request('POST', endpoint,
+                                                    payload))
+
+    async def put(self, endpoint, payload):
+        return await self.request('PUT', endpoint, payload)
+
+    async def delete(self, endpoint, aos_id):
+        return await self.request('DELETE', "{}/{}".format(endpoint, aos_id))
+
+    async def gather(self, *coros):
+        """
+        Await coros concurrently
+        :return: list of (result, error) tuples in coros order
+        """
+        async def outcome(coro):
+            try:
+                return await coro, None
+            except Exception as e:
+                return None, "{}: {}".format(type(e).__name__, e)
+
+        return list(await asyncio.gather(*[outcome(c) for c in coros]))
+
+
+def run_async(coro):
+    """
+    Run a coroutine to completion from synchronous code
+    :param coro: coroutine
+    :return: result of coro
+    """
+    return asyncio.run(coro)
+
+
+def aos_get_many(session, endpoints, concurrency=DEFAULT_CONCURRENCY,
+                 timeout=None):
+    """
+    GET several endpoints concurrently
+    :param session: dict
+    :param endpoints: list of string
+    :param concurrency: int
+    :param timeout: float (seconds per request)
+    :return: list of (result, error) tuples in endpoints order
+    """
+    async def get_all():
+        async with AsyncAosClient(session, concurrency, timeout) as client:
+            return await client.gather(*[client.get(e) for e in endpoints])
+
+    return run_async(get_all())
+
+
+def cache_dir():
+    """
+    Directory of the on-disk AOS cache, private to the current user
+    :return: string
+    """
+    return os.environ.get('AOS_CACHE_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'aos-ansible')
+
+
+def cache_ttl():
+    return float(os.environ.get('AOS_CACHE_TTL', DEFAULT_CACHE_TTL))
+
+
+def http_cache_enabled():
+    return boolean(os.environ.get('AOS_HTTP_CACHE', False))
+
+
+def cache_max_bytes():
+    return int(os.environ.get('AOS_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+
+
+def cache_prune(max_bytes=None):
+    """
+    Drop the least recently used cache entries until the cache fits in
+    max_bytes
+    :param max_bytes: int
+    :return: None
+    """
+    max_bytes = cache_max_bytes() if max_bytes is None else max_bytes
+    entries = []
+
+    try:
+        for f in os.scandir(cache_dir()):
+            # Skip lock files and the temporary files of pending writes
+            if f.is_file() and not f.name.endswith('.lock') and \
+                    not f.name.startswith('tmp'):
+                stat = f.stat()
+                entries.append((stat.st_mtime, stat.st_size, f.path))
+    except (IOError, OSError):
+        return
+
+    total = sum(e[1] for e in entries)
+
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.unlink(path)
+        except (IOError, OSError):
+            pass
+
+        total -= size
+
+
+def _cache_file(server, endpoint):
+    key = "{}/{}".format(server, endpoint.strip('/'))
+
+    return os.path.join(cache_dir(),
+                        hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def cache_load(server, endpoint):
+    """
+    Return the cache entry stored for an endpoint, or None
+    :param server: string
+    :param endpoint: string
+    :return: dict
+    """
+    path = _cache_file(server, endpoint)
+
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+
+        # Mark the entry as recently used for cache_prune
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return entry
+
+
+def cache_store(server, endpoint, entry):
+    """
+    Atomically write the cache entry of an endpoint, readable by the owner
+    only as it holds AOS data
+    :param server: string
+    :param endpoint: string
+    :param entry: dict
+    :return: None
+    """
+    path = _cache_file(server, endpoint)
+
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return
+
+    cache_prune()
+
+
+def cache_invalidate(server, endpoint):
+    """
+    Drop the cache entries of an endpoint and of the collections above it,
+    ex. a write to resources/ip-pools/my-pool drops resources/ip-pools
+    :param server: string
+    :param endpoint: string
+    :return: None
+    """
+    parts = endpoint.strip('/').split('/')
+
+    for i in range(len(parts), 0, -1):
+        try:
+            os.unlink(_cache_file(server, '/'.join(parts[:i])))
+        except (IOError, OSError):
+            pass
+
+    if len(parts) > 1 and parts[0] == 'blueprints':
+        _blueprint_versions.pop((server, parts[1]), None)
+
+
+def cached_get(session, endpoint, ttl=None):
+    """
+    GET a collection through the on-disk HTTP cache. Entries younger than
+    ttl are served as is, older ones are revalidated with a conditional GET
+    (If-None-Match / If-Modified-Since) and served again on 304.
+    :param session: dict
+    :param endpoint: string
+    :param ttl: float (seconds)
+    :return: dict
+    """
+    ttl = cache_ttl() if ttl is None else ttl
+    entry = cache_load(session['server'], endpoint) or {}
+
+    if 'body' in entry and time.time() - entry['time'] < ttl:
+        return entry['body']
+
+    headers = requests_header(session)
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    response = aos_request(session, 'GET', endpoint, headers=headers)
+
+    if response.status_code == 304 and 'body' in entry:
+        body = entry['body']
+    else:
+        body = requests_response(response)
+
+    etag = response.headers.get('ETag') or entry.get('etag')
+    last_modified = response.headers.get('Last-Modified') or \
+        entry.get('last_modified')
+
+    if etag or last_modified or ttl > 0:
+        cache_store(session['server'], endpoint,
+                    {'time': time.time(), 'etag': etag,
+                     'last_modified': last_modified, 'body': body})
+
+    return body
+
+
+def blueprint_cache_enabled():
+    return boolean(os.environ.get('AOS_BLUEPRINT_CACHE', False))
+
+
+def get_blueprint_version(session, blueprint_id):
+    """
+    Return the staged version of a blueprint, read once per process until a
+    write to the blueprint
+    :param session: dict
+    :param blueprint_id: string
+    :return: int
+    """
+    key = (session['server'], blueprint_id)
+
+    if key not in _blueprint_versions:
+        resp_data = aos_get(session, "blueprints/{}".format(blueprint_id))
+        _blueprint_versions[key] = resp_data['version']
+
+    return _blueprint_versions[key]
+
+
+def blueprint_cached(session, blueprint_id, key, fetch):
+    """
+    Return the blueprint data stored on disk under key for the current
+    blueprint version, or call fetch and store its result. Only used when
+    AOS_BLUEPRINT_CACHE is set, fetch is called directly otherwise.
+    :param session: dict
+    :param blueprint_id: string
+    :param key: string (ex. 'virtual-networks')
+    :param fetch: function returning the data
+    :return: dict
+    """
+    if not blueprint_cache_enabled():
+        return fetch()
+
+    version = get_blueprint_version(session, blueprint_id)
+    endpoint = "blueprints/{}/snapshot/{}".format(blueprint_id, key)
+    entry = cache_load(session['server'], endpoint)
+
+    if entry and entry.get('version') == version:
+        return entry['body']
+
+    body = fetch()
+    cache_store(session['server'], endpoint,
+                {'time': time.time(), 'version': version, 'body': body})
+
+    return body
+
+
+def blueprint_get(session, blueprint_id, collection):
+    """
+    GET a blueprint collection through the blueprint snapshot cache
+    :param session: dict
+    :param blueprint_id: string
+    :param collection: string (ex. 'virtual-networks', 'security-zones')
+    :return: dict
+    """
+    endpoint = "blueprints/{}/{}".format(blueprint_id, collection)
+
+    return blueprint_cached(session, blueprint_id, collection,
+                            lambda: aos_get(session, endpoint))
+
+
+def find_blueprint_item(session, blueprint_id, collection, key='items',
+                        uuid=None, label=None):
+    """
+    Find a blueprint collection item by id (single item GET) or label
+    (streamed collection), unless the blueprint snapshot cache serves it
+    :param session: dict
+    :param blueprint_id: string
+    :param collection: string (ex. 'virtual-networks')
+    :param key: string (collection key in the response)
+    :param uuid: string
+    :param label: string
+    :return: tuple (item or {}, True if the label is repeated)
+    """
+    endpoint = "blueprints/{}/{}".format(blueprint_id, collection)
+
+    if blueprint_cache_enabled():
+        items = blueprint_get(session, blueprint_id, collection).get(key) or []
+        if isinstance(items, dict):
+            items = items.values()
+    elif uuid:
+        return get_resource_by_id(session, endpoint, uuid), False
+    else:
+        items = aos_get_items(session, endpoint, key)
+
+    if uuid:
+        return find_item(items, uuid=uuid)
+
+    return find_item(items, label=label)
+
+
+def token_refresh():
+    return float(os.environ.get('AOS_TOKEN_REFRESH', DEFAULT_TOKEN_REFRESH))
+
+
+def token_expiry(token):
+    """
+    Read the expiry of an AOS auth token (JWT "exp" claim)
+    :param token: string
+    :return: float (epoch seconds) or None if it can't be decoded
+    """
+    try:
+        claims = token.split('.')[1]
+        claims += '=' * (-len(claims) % 4)
+        return float(json.loads(
+            base64.urlsafe_b64decode(claims.encode('ascii')))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def token_expiring(token):
+    """
+    Tell if a token expires within AOS_TOKEN_REFRESH seconds. Tokens
+    without a readable expiry are used until rejected.
+    :param token: string
+    :return: bool
+    """
+    expiry = token_expiry(token)
+
+    return expiry is not None and expiry - time.time() < token_refresh()
+
+
+def _token_endpoint(user):
+    return "user/login/{}".format(user)
+
+
+def password_digest(passwd, salt):
+    """
+    Salted digest of a password, kept with a cached token so that only
+    callers knowing the password reuse it
+    :param passwd: string
+    :param salt: string (hex)
+    :return: string (hex)
+    """
+    return hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'),
+                               bytes.fromhex(salt),
+                               PASSWD_DIGEST_ROUNDS).hex()
+
+
+def token_entry(token, passwd):
+    """
+    Cache entry of a token issued for passwd
+    :param token: string
+    :param passwd: string
+    :return: dict
+    """
+    salt = os.urandom(16).hex()
+
+    return {'token': token, 'salt': salt,
+            'digest': password_digest(passwd, salt)}
+
+
+def cached_token(server, user, passwd, rejected=None):
+    """
+    Return the token cached on disk for server and user, unless it is about
+    to expire, it is the rejected one or it was issued for another password
+    :param server: string
+    :param user: string
+    :param passwd: string (None to skip the password check, for sessions
+                   already logged in)
+    :param rejected: string
+    :return: string or None
+    """
+    entry = cache_load(server, _token_endpoint(user))
+
+    if not entry or entry.get('token') == rejected or \
+            token_expiry(entry.get('token')) is None or \
+            token_expiring(entry['token']):
+        return None
+
+    # Entries without a digest predate it and are not reused
+    if passwd is not None and not (
+            entry.get('salt') and entry.get('digest') == password_digest(
+                passwd, entry['salt'])):
+        return None
+
+    return entry['token']
+
+
+def aos_token(server, user, passwd, rejected=None):
+    """
+    Return a valid token for server and user, from the on-disk cache when
+    possible. Logins are serialized per server and user, so when many
+    processes start at once one of them logs in and the others pick its
+    token from the cache. A cached token is only reused with the password
+    it was issued for.
+    :param server: string
+    :param user: string
+    :param passwd: string (None to only look in the cache, for sessions
+                   already logged in)
+    :param rejected: string (token refused by the AOS server)
+    :return: tuple (token, True if a login was made)
+    """
+    token = cached_token(server, user, passwd, rejected)
+    if token:
+        return token, False
+
+    lock_path = _cache_file(server, _token_endpoint(user)) + '.lock'
+
+    try:
+        os.makedirs(os.path.dirname(lock_path), mode=0o700, exist_ok=True)
+        lock = os.fdopen(os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600),
+                         'w')
+    except (IOError, OSError):
+        lock = None
+
+    try:
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have logged in while we waited
+            token = cached_token(server, user, passwd, rejected)
+            if token:
+                return token, False
+
+        if passwd is None:
+            raise requests.RequestException(
+                "No valid token cached for {} on {}".format(user, server))
+
+        token = aos_user_login(server, user, passwd)
+        cache_store(server, _token_endpoint(user),
+                    token_entry(token, passwd))
+
+        return token, True
+    finally:
+        if lock:
+            lock.close()
+
+
+def aos_user_login(server, user, passwd):
+    """
+    Log into the AOS server
+    :param server: string
+    :param user: string
+    :param passwd: string
+    :return: string (token)
+    """
+    headers = {'Accept': "application/json",
+               'Content-Type': "application/json",
+               'Accept-Encoding': ACCEPT_ENCODING,
+               'cache-control': "no-cache"}
+    payload = {"username": user,
+               "password": passwd}
+
+    response = aos_request({"server": server}, 'POST', 'user/login', payload,
+                           headers=headers)
+
+    if response.status_code != 201:
+        raise requests.HTTPError(
+            "Issue logging into AOS-server {}: {}"
+            .format(aos_url(server, 'user/login'), response.json()),
+            response=response)
+
+    return response.json()['token']
+
+
+def refresh_session_token(session):
+    """
+    Replace the token of a session created by aos_login with a fresh one,
+    from the cache or by logging in again with AOS_PASSWD
+    :param session: dict
+    :return: bool (True if the token was replaced)
+    """
+    try:
+        token, _ = aos_token(session['server'], session['user'],
+                             os.environ.get('AOS_PASSWD'),
+                             rejected=session.get('token'))
+    except requests.RequestException:
+        return False
+
+    session['token'] = token
+
+    return True
+
+
+class ResourceIndex(object):
+    """
+    Index of an AOS collection for constant time lookup by id, display_name
+    and label. Build it once per collection response and reuse it for every
+    lookup. When several items share a name or label the first one wins, and
+    repeated labels are listed in duplicate_labels.
+    """
+
+    def __init__(self, items):
+        if isinstance(items, dict):
+            items = items.values()
+
+        self.items = list(items)
+        self.ids = {}
+        self.names = {}
+        self.labels = {}
+        self.duplicate_labels = set()
+
+        for item in self.items:
+            if 'id' in item:
+                self.ids.setdefault(item['id'], item)
+
+            if 'display_name' in item:
+                self.names.setdefault(item['display_name'], item)
+
+            if 'label' in item:
+                if item['label'] in self.labels:
+                    self.duplicate_labels.add(item['label'])
+                else:
+                    self.labels[item['label']] = item
+
+    @classmethod
+    def from_response(cls, resource_data, key='items'):
+        """
+        Build the index from a collection response
+        :param resource_data: dict
+        :param key: string (collection key in the response)
+        :return: ResourceIndex
+        """
+        return cls((resource_data.get(key) or []) if resource_data else [])
+
+    def __len__(self):
+        return len(self.items)
+
+    def by_id(self, uuid):
+        return self.ids.get(uuid, {})
+
+    def by_name(self, name):
+        return self.names.get(name, {})
+
+    def by_label(self, label):
+        return self.labels.get(label, {})
+
+
+def _find_resource(resource_data, key, keyword):
+    index = ResourceIndex.from_response(resource_data)
+    lookup = {'id': index.by_id,
+              'display_name': index.by_name,
+              'label': index.by_label}[keyword]
+
+    return lookup(key)
+
+
+def find_resource_by_name(resource_data, name):
+    return _find_resource(resource_data, name, "display_name")
+
+
+def find_resource_by_id(resource_data, uuid):
+    return _find_resource(resource_data, uuid, "id")
+
+
+def get_resource_by_id(session, endpoint, uuid):
+    """
+    GET a single collection item, ex. resources/ip-pools/{id}
+    :param session: dict
+    :param endpoint: string (collection)
+    :param uuid: string
+    :return: Returns collection item (dict), empty if it does not exist
+    """
+    response = aos_request(session, 'GET',
+                           "{}/{}".format(endpoint, quote(uuid, safe='')))
+
+    if response.status_code == 404:
+        return {}
+
+    return requests_response(response)
+
+
+def find_resource_item(session, endpoint,
+                       name=None,
+                       uuid=None):
+    """
+    Find an existing resource based on name or id from a given endpoint
+    :param session: dict
+    :param endpoint: string
+    :param name: string
+    :param uuid: string
+    :return: Returns collection item (dict)
+    """
+    if name:
+        # Resources created by these modules use their name as id, try the
+        # single item first and only list the collection when it misses
+        item = get_resource_by_id(session, endpoint, name)
+
+        if item.get('display_name') != name:
+            item, _ = find_item(aos_get_items(session, endpoint), name=name)
+    elif uuid:
+        item = get_resource_by_id(session, endpoint, uuid)
+    else:
+        item = {}
+
+    return item
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_CONCURRENCY):
+    """
+    Call func for every item concurrently, at most max_workers at a time
+    :param func: function
+    :param items: list
+    :param max_workers: int
+    :return: list of (result, error) tuples in item order
+    """
+    if not items:
+        return []
+
+    async def call_all():
+        async with AsyncAosClient(None, max_workers) as client:
+            return await client.gather(*[client.call(func, item)
+                                         for item in items])
+
+    return run_async(call_all())
+
+
+def reconcile_resources(module, session, endpoint, specs, present, absent,
+                        max_workers=DEFAULT_CONCURRENCY, key='items',
+                        name_key='display_name', resource_data=None):
+    """
+    Bring every resource in specs to its expected state using a single GET
+    of the collection and concurrent writes
+    :param module: Ansible built in
+    :param session: dict
+    :param endpoint: string
+    :param specs: list of dict with name, id and state
+    :param present: function(module, session, item, spec)
+    :param absent: function(module, session, item)
+    :param max_workers: int
+    :param key: string (collection key in the response)
+    :param name_key: string ('display_name' or 'label')
+    :param resource_data: dict (collection already read from endpoint)
+    :return: changed(bool), results(list)
+    """
+    if resource_data is None:
+        resource_data = aos_get(session, endpoint)
+
+    index = ResourceIndex.from_response(resource_data, key)
+    by_name = index.by_label if name_key == 'label' else index.by_name
+
+    def apply(spec):
+        if spec['id']:
+            my_item = index.by_id(spec['id'])
+        elif name_key == 'label' and spec['name'] in index.duplicate_labels:
+            return False, False, {'msg': "Multiple items found with name {}"
+                                         .format(spec['name'])}
+        else:
+            my_item = by_name(spec['name'])
+
+        if spec['state'] == 'absent':
+            return absent(module, session, my_item)
+
+        return present(module, session, my_item, spec)
+
+    outcomes = run_concurrently(apply, specs, max_workers)
+
+    results = []
+    for spec, (outcome, error) in zip(specs, outcomes):
+        if error:
+            outcome = False, False, {'msg': error}
+
+        success, changed, value = outcome
+        results.append({'name': value.get(name_key) or spec['name'],
+                        'id': value.get('id') or spec['id'],
+                        'success': success,
+                        'changed': changed,
+                        'value': value})
+
+    return any(r['changed'] for r in results), results
+
+
+def ql_selection(field, fields, alias=None, **filters):
+    """
+    Build a GraphQL selection of fields on a blueprint node type, filtered
+    on the server by the given properties. Filters set to None are left out.
+    ex. ql_selection('system_nodes', ['id', 'label'], role='spine') gives
+    'system_nodes(role: "spine") {id, label}'
+    :param field: string (ex. 'system_nodes', 'security_zone_nodes')
+    :param fields: list of field names (or nested selections)
+    :param alias: string (name of the result in the response data)
+    :param filters: property values (string, int, bool or list)
+    :return: string
+    """
+    args = ", ".join("{}: {}".format(k, json.dumps(v))
+                     for k, v in sorted(filters.items()) if v is not None)
+
+    selection = "{}({})".format(field, args) if args else field
+
+    if alias and alias != field:
+        selection = "{}: {}".format(alias, selection)
 
+    return "{} {{{}}}".format(selection, ", ".join(fields))
 
-def requests_retry(retries=3, session=None):
 
-    session = session or requests.Session()
-    adapter = HTTPAdapter(max_retries=retries)
+class QlQuery(object):
+    """
+    Batch of named GraphQL sub-queries sent to blueprints/{id}/ql in a
+    single POST, ex. system nodes, security zones and virtual networks
+    """
 
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
+    def __init__(self):
+        self.selections = []
+        self.aliases = []
 
-    return session
+    def add(self, alias, field, fields, **filters):
+        """
+        Add a sub-query, its result is found under alias in the response
+        :param alias: string
+        :param field: string
+        :param fields: list
+        :param filters: property values
+        :return: QlQuery
+        """
+        self.selections.append(ql_selection(field, fields, alias, **filters))
+        self.aliases.append(alias)
 
+        return self
 
-def requests_response(response):
-    return response.json() if response.ok else response.raise_for_status()
+    def render(self):
+        return "{{ {} }}".format(" ".join(self.selections))
 
+    def execute(self, session, blueprint_id):
+        """
+        :param session: dict
+        :param blueprint_id: string
+        :return: dict of sub-query results keyed on alias
+        """
+        endpoint = "blueprints/{}/ql".format(blueprint_id)
+        query = self.render()
+        key = "ql/{}".format(hashlib.sha256(query.encode('utf-8')).hexdigest())
 
-def aos_get(session, endpoint):
+        return blueprint_cached(
+            session, blueprint_id, key,
+            lambda: aos_post(session, endpoint, {'query': query})['data'])
+
+
+def find_bp_system_nodes(session, blueprint_id, nodes=None, role=None):
     """
-    GET request aginst aos RestApi
+    Find the Blueprint node ID for all nodes or the given device names.
+    Names are filtered on the server, with one sub-query per name batched
+    in a single request.
     :param session: dict
-    :param endpoint: string
-    :return: dict
+    :param blueprint_id: string
+    :param nodes: list
+    :param role: string
+    :return: list
     """
-    aos_url = "https://{}/api/{}".format(session['server'], endpoint)
-    headers = requests_header(session)
-    response = requests_retry().get(aos_url,
-                                    headers=headers,
-                                    verify=set_requests_verify())
+    fields = ['id', 'label', 'role']
+    query = QlQuery()
 
-    return requests_response(response)
+    # Unique names in the given order, and a set for the label checks
+    labels = list(dict.fromkeys(nodes or []))
+    wanted = set(labels)
 
+    if labels:
+        for i, label in enumerate(labels):
+            query.add("node{}".format(i), 'system_nodes', fields,
+                      label=label, role=role)
+    else:
+        query.add('system_nodes', 'system_nodes', fields, role=role)
 
-def aos_post(session, endpoint, payload):
-    """
-    POST request aginst aos RestApi
-    :param session: dict
-    :param endpoint: string
-    :param payload: string
-    :return: dict
-    """
-    aos_url = "https://{}/api/{}".format(session['server'], endpoint)
-    headers = requests_header(session)
-    response = requests_retry().post(aos_url,
-                                     data=json.dumps(payload),
-                                     headers=headers,
-                                     verify=set_requests_verify())
+    node_data = query.execute(session, blueprint_id)
 
-    return requests_response(response)
+    return [n for alias in query.aliases for n in node_data.get(alias) or []
+            if not wanted or n['label'] in wanted]
 
 
-def aos_put(session, endpoint, payload):
+def poll_until(fetch, done, timeout, interval=DEFAULT_POLL_INTERVAL,
+               max_interval=DEFAULT_POLL_MAX_INTERVAL):
     """
-    PUT request aginst aos RestApi
-    :param session: dict
-    :param endpoint: string
-    :param payload: string
-    :return: dict
+    Call fetch until done accepts its result or timeout expires. The delay
+    between calls doubles up to max_interval, with jitter so that many
+    pollers don't hit the AOS server in lockstep.
+    :param fetch: function returning the current value
+    :param done: function(value) returning bool
+    :param timeout: float (seconds)
+    :param interval: float (seconds before the second call)
+    :param max_interval: float (seconds)
+    :return: tuple (last value, bool done)
     """
-    aos_url = "https://{}/api/{}".format(session['server'], endpoint)
-    headers = requests_header(session)
-    response = requests_retry().put(aos_url,
-                                    data=json.dumps(payload),
-                                    headers=headers,
-                                    verify=set_requests_verify())
+    deadline = time.time() + timeout
 
-    return response
+    while True:
+        value = fetch()
 
+        if done(value):
+            return value, True
 
-def aos_delete(session, endpoint, aos_id):
-    """
-    DELETE request aginst aos RestApi
-    :param session: dict
-    :param endpoint: string
-    :param aos_id: string
-    :return: dict
-    """
-    aos_url = "https://{}/api/{}/{}".format(session['server'],
-                                            endpoint,
-                                            aos_id)
-    headers = requests_header(session)
-    response = requests_retry().delete(aos_url,
-                                       headers=headers,
-                                       verify=set_requests_verify())
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return value, False
 
-    return response
+        delay = min(interval, max_interval) * random.uniform(0.5, 1.0)
+        time.sleep(min(delay, remaining))
+        interval *= 2
 
 
-def _find_resource(resource_data, key, keyword):
-    for item in resource_data['items']:
-        if item[keyword] == key:
-            return item
-    return {}
+# Deploy states after which the status of a version won't change
+DEPLOY_TERMINAL_STATES = ['success', 'failure']
 
 
-def find_resource_by_name(resource_data, name):
-    return _find_resource(resource_data, name, "display_name")
+def get_blueprint_status(session, blueprint_id):
+    endpoint = "blueprints/{}/deploy".format(blueprint_id)
 
+    resp_data = aos_get(session, endpoint)
 
-def find_resource_by_id(resource_data, uuid):
-    return _find_resource(resource_data, uuid, "id")
+    return resp_data
 
 
-def find_resource_item(session, endpoint,
-                       name=None,
-                       uuid=None):
+def deploy_done(status, version):
     """
-    Find an existing resource based on name or id from a given endpoint
-    :param session: dict
-    :param endpoint: string
-    :param name: string
-    :param uuid: string
-    :return: Returns collection item (dict)
+    Tell if the deploy of a blueprint version is over
+    :param status: dict (blueprints/{id}/deploy)
+    :param version: int
+    :return: bool
     """
-    resource_data = aos_get(session, endpoint)
-
-    if name:
-        return find_resource_by_name(resource_data, name)
-    elif uuid:
-        return find_resource_by_id(resource_data, uuid)
-    else:
-        return {}
+    return status.get('version') == version and \
+        status.get('state') in DEPLOY_TERMINAL_STATES
 
 
-def find_bp_system_nodes(session, blueprint_id, nodes=None):
+def deploy_blueprint(session, blueprint_id, wait=False, timeout=600,
+                     poll_interval=DEFAULT_POLL_INTERVAL, handle=None):
     """
-    Find the Blueprint node ID for all nodes or the given device names
+    Deploy the staged version of a blueprint, or check on the deploy of a
+    handle, waiting for its end if requested
     :param session: dict
     :param blueprint_id: string
-    :param nodes: list
-    :return: list
+    :param wait: bool
+    :param timeout: int (seconds)
+    :param poll_interval: float (seconds)
+    :param handle: dict (blueprint_id, version of a deploy already started)
+    :return: dict (id, success, changed, msg, deploy_handle, deploy_state,
+                   deploy_done)
     """
-    endpoint = "blueprints/{}/ql".format(blueprint_id)
-    device_query = {'query': "{ system_nodes{id, label, role} }"}
+    result = {'id': blueprint_id, 'success': True, 'changed': False,
+              'msg': None, 'deploy_handle': handle}
+    bp_status = None
+
+    if handle is None:
+        staged_version = get_blueprint_version(session, blueprint_id)
+        bp_status = get_blueprint_status(session, blueprint_id)
+
+        handle = result['deploy_handle'] = {'blueprint_id': blueprint_id,
+                                            'version': staged_version}
 
-    node_data = aos_post(session, endpoint, device_query)
+        if staged_version != bp_status['version']:
+            endpoint = "blueprints/{}/deploy".format(blueprint_id)
+            response = aos_put(session, endpoint, {"version": staged_version})
 
-    resp_nodes = []
+            if not response.ok:
+                try:
+                    error_message = response.json().get('errors')
+                except (TypeError, ValueError) as e:
+                    error_message = \
+                        "Failed to decode JSON from response: {}, error: {}" \
+                        .format(response, e)
 
-    if nodes:
-        for n in node_data['data']['system_nodes']:
-            if n['label'] in nodes:
-                resp_nodes.append(n)
+                result.update(success=False,
+                              msg="Issue deploying blueprint {}: {}"
+                                  .format(blueprint_id, error_message))
+                return result
 
-        return resp_nodes
+            result['changed'] = True
+            bp_status = None
+
+    if wait:
+        bp_status, done = poll_until(
+            lambda: get_blueprint_status(session, blueprint_id),
+            lambda status: deploy_done(status, handle['version']),
+            timeout, poll_interval)
+
+        if not done:
+            result.update(success=False,
+                          msg="Timed out after {} seconds deploying blueprint "
+                              "{} (state: {})".format(timeout, blueprint_id,
+                                                      bp_status.get('state')))
 
     else:
-        return node_data['data']['system_nodes']
+        bp_status = bp_status or get_blueprint_status(session, blueprint_id)
+        done = deploy_done(bp_status, handle['version'])
+
+    result.update(deploy_state=bp_status.get('state'), deploy_done=done)
+
+    if bp_status.get('state') == 'failure':
+        result.update(success=False,
+                      msg="Unable to commit blueprint: {}"
+                          .format(bp_status.get('error')))
+
+    return result
 
 
 def validate_vni_id(vni_id):
@@ -203,6 +2035,106 @@ def validate_vlan_id(vlan_id):
     return errors
 
 
+def _range_bounds(item):
+    if isinstance(item, dict):
+        return item['first'], item['last']
+
+    return item[0], item[1]
+
+
+class RangeSet(object):
+    """
+    Sorted list of non-overlapping integer ranges (ASN, VNI). Ranges given
+    to the set are sorted once and overlapping or adjacent ranges are
+    coalesced, so the set holds the minimal list of ranges and lookups are
+    binary searches.
+    """
+
+    def __init__(self, ranges=()):
+        self.firsts = []
+        self.lasts = []
+
+        for first, last in sorted(_range_bounds(r) for r in ranges):
+            if self.lasts and first <= self.lasts[-1] + 1:
+                self.lasts[-1] = max(self.lasts[-1], last)
+            else:
+                self.firsts.append(first)
+                self.lasts.append(last)
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def __iter__(self):
+        return iter(zip(self.firsts, self.lasts))
+
+    def covers(self, first, last):
+        """
+        Check whether [first, last] is entirely inside the set
+        :param first: int
+        :param last: int
+        :return: bool
+        """
+        i = bisect.bisect_right(self.firsts, first) - 1
+
+        return i >= 0 and last <= self.lasts[i]
+
+    def overlapping(self, first, last):
+        """
+        Return the ranges of the set which overlap [first, last]
+        :param first: int
+        :param last: int
+        :return: list of (first, last)
+        """
+        i = max(bisect.bisect_right(self.firsts, first) - 1, 0)
+        found = []
+
+        while i < len(self.firsts) and self.firsts[i] <= last:
+            if self.lasts[i] >= first:
+                found.append((self.firsts[i], self.lasts[i]))
+            i += 1
+
+        return found
+
+    def to_list(self):
+        return [{'first': first, 'last': last} for first, last in self]
+
+
+def overlap_error(kind, value, other, pool=None):
+    """
+    Error message of a range or subnet overlapping another one, the same
+    for overlaps within a request and with the pools of the AOS server
+    :param kind: string ('range' or 'subnet')
+    :param value: string
+    :param other: string (overlapped range or subnet)
+    :param pool: string (pool of the overlapped value, when not requested)
+    :return: string
+    """
+    error = "Invalid {}: {} overlaps {}".format(kind, value, other)
+
+    return "{} in {}".format(error, pool) if pool else error
+
+
+def find_range_overlaps(ranges):
+    """
+    Find the ranges which overlap another range of the same list
+    :param ranges: list of [first, last]
+    :return: list of error messages
+    """
+    errors = []
+    widest = None
+
+    for first, last in sorted(_range_bounds(r) for r in ranges):
+        if widest and first <= widest[1]:
+            errors.append(overlap_error(
+                'range', "[{}, {}]".format(first, last),
+                "[{}, {}]".format(widest[0], widest[1])))
+
+        if not widest or last > widest[1]:
+            widest = (first, last)
+
+    return errors
+
+
 def validate_asn_ranges(ranges):
     """
     Validate ASN ranges provided are valid and properly formatted
@@ -224,6 +2156,9 @@ def validate_asn_ranges(ranges):
             errors.append("Invalid range: must be a valid range between 1"
                           " and 4294967295")
 
+    if not errors:
+        errors = find_range_overlaps(ranges)
+
     return errors
 
 
@@ -248,6 +2183,9 @@ def validate_vni_ranges(ranges):
             errors.append("Invalid range: must be a valid range between 4096"
                           " and 16777214")
 
+    if not errors:
+        errors = find_range_overlaps(ranges)
+
     return errors
 
 
@@ -274,3 +2212,447 @@ def validate_ip_format(addrs, ip_version):
             errors.append("Invalid format: {}".format(addrs))
 
     return errors
+
+
+def canonical_ip(addr):
+    """
+    Return the canonical text of an IP address or subnet, so equivalent
+    notations compare equal (ex. 2005:0:0::1/64 and 2005::1/64)
+    :param addr: string
+    :return: string
+    """
+    try:
+        if '/' in addr:
+            return str(ipaddress.ip_interface(addr))
+
+        return str(ipaddress.ip_address(addr))
+
+    except ValueError:
+        return addr
+
+
+# Settings of a blueprint virtual network left out of a spec
+VN_DEFAULTS = {'name': None, 'id': None, 'state': 'present', 'vn_id': None,
+               'vn_type': 'vlan', 'sec_zone_id': None, 'ipv4_enabled': False,
+               'ipv6_enabled': False, 'ipv4_subnet': None, 'ipv6_subnet': None,
+               'virtual_gw_ipv4': None, 'virtual_gw_ipv6': None,
+               'dhcp_service': None, 'bound_to_id': [], 'bound_to_name': []}
+
+
+def vn_add_options(new_vn, vn_id, ipv4_enabled, ipv6_enabled, ipv4_subnet,
+                   ipv6_subnet, virtual_gw_ipv4, virtual_gw_ipv6, dhcp_service):
+    if vn_id:
+        new_vn["vn_id"] = str(vn_id)
+
+    if ipv4_enabled:
+        new_vn["ipv4_enabled"] = ipv4_enabled
+
+    if ipv6_enabled:
+        new_vn["ipv6_enabled"] = ipv6_enabled
+
+    if ipv4_subnet:
+        new_vn["ipv4_subnet"] = ipv4_subnet
+
+    if ipv6_subnet:
+        new_vn["ipv6_subnet"] = ipv6_subnet
+
+    if virtual_gw_ipv4:
+        new_vn["virtual_gw_ipv4"] = virtual_gw_ipv4
+
+    if virtual_gw_ipv6:
+        new_vn["virtual_gw_ipv6"] = virtual_gw_ipv6
+
+    if dhcp_service:
+        new_vn["dhcp_service"] = 'dhcpServiceEnabled'
+    else:
+        new_vn["dhcp_service"] = 'dhcpServiceDisabled'
+
+
+# Settings of a virtual network written by the modules. vn_add_options
+# leaves out the unset ones, which the PUT then clears.
+VN_SETTINGS = ['vn_id', 'ipv4_enabled', 'ipv6_enabled', 'ipv4_subnet',
+               'ipv6_subnet', 'virtual_gw_ipv4', 'virtual_gw_ipv6',
+               'dhcp_service', 'bound_to']
+
+
+def normalize_vn_value(key, value):
+    """
+    Normalize a virtual network setting for comparison: bound_to as a set of
+    system ids, IP settings in canonical form, vn_id as a string and flags
+    as booleans. Missing, None and False settings compare equal.
+    :param key: str
+    :param value: any
+    :return: any
+    """
+    if key == 'bound_to':
+        return frozenset(b['system_id'] for b in value or [])
+
+    if key in ['ipv4_subnet', 'ipv6_subnet', 'virtual_gw_ipv4',
+               'virtual_gw_ipv6']:
+        return canonical_ip(value) if value else None
+
+    if key == 'vn_id':
+        return str(value) if value else None
+
+    if key == 'dhcp_service':
+        return value == 'dhcpServiceEnabled'
+
+    if key in ['ipv4_enabled', 'ipv6_enabled']:
+        return bool(value)
+
+    return value
+
+
+def virt_net_changes(my_vn, new_vn):
+    """
+    List the VN_SETTINGS of new_vn which differ from the existing virtual
+    network, a setting left out of new_vn being cleared
+    :param my_vn: dict
+    :param new_vn: dict
+    :return: list
+    """
+    changes = []
+    for key in VN_SETTINGS:
+        if normalize_vn_value(key, new_vn.get(key)) != \
+                normalize_vn_value(key, my_vn.get(key)):
+            changes.append(key)
+
+    return sorted(changes)
+
+
+def validate_virtual_network(vn):
+    """
+    Validate the VN ID and IP settings of a virtual network
+    :param vn: dict (module params or entry from I(virtual_networks))
+    :return: vn_id(int), errors(list)
+    """
+    vn_id = vn.get('vn_id', None)
+    errors = []
+
+    if vn_id:
+        try:
+            vn_id = int(vn_id)
+        except ValueError:
+            return vn_id, ["Invalid ID: must be an integer"]
+
+        if vn['vn_type'] == 'vlan':
+            err = validate_vlan_id(vn_id)
+        else:
+            err = validate_vni_id(vn_id)
+
+        if err:
+            errors.append(err)
+
+    for i in [vn.get('ipv4_subnet', None), vn.get('virtual_gw_ipv4', None)]:
+        if i:
+            err = validate_ip_format([i], 'ipv4')
+
+            if err:
+                errors.append(err)
+
+    for i in [vn.get('ipv6_subnet', None), vn.get('virtual_gw_ipv6', None)]:
+        if i:
+            err = validate_ip_format([i], 'ipv6')
+
+            if err:
+                errors.append(err)
+
+    return vn_id, errors
+
+
+def get_bound_to(vn, node_index):
+    """
+    Build the bound_to list of a virtual network from node ids or names
+    :param vn: dict (module params or entry from I(virtual_networks))
+    :param node_index: ResourceIndex of blueprint system nodes
+    :return: list
+    """
+    if vn.get('bound_to_id'):
+        return [{"system_id": n} for n in vn['bound_to_id']]
+
+    return [{"system_id": node_index.by_label(n)['id']}
+            for n in vn.get('bound_to_name') or []
+            if node_index.by_label(n)]
+
+
+def merge_ranges(existing, ranges):
+    """
+    Merge requested ranges into the ranges of an existing pool. The result
+    is the minimal list of ranges covering both, and changed is False when
+    the pool already covers every requested range.
+    :param existing: list of dict ({'first': int, 'last': int})
+    :param ranges: list of [first, last]
+    :return: merged ranges (list of dict), changed(bool)
+    """
+    current = RangeSet(existing)
+    changed = not all(current.covers(*_range_bounds(r)) for r in ranges)
+
+    if not changed:
+        return [{'first': r['first'], 'last': r['last']} for r in existing], \
+            False
+
+    return RangeSet(list(existing) + list(ranges)).to_list(), True
+
+
+def _subnet_bounds(subnet):
+    network = ipaddress.ip_network(subnet['network']
+                                   if isinstance(subnet, dict) else subnet)
+
+    return (network.version, int(network.network_address),
+            int(network.broadcast_address))
+
+
+class SubnetSet(object):
+    """
+    Set of IPv4 and IPv6 subnets. A subnet is the interval of addresses
+    between its network and broadcast address, so the set keeps one
+    RangeSet of address intervals per IP version: duplicates and subnets
+    of other subnets disappear, adjacent subnets are aggregated and lookups
+    are binary searches.
+    """
+
+    def __init__(self, subnets=()):
+        bounds = {4: [], 6: []}
+
+        for subnet in subnets:
+            version, first, last = _subnet_bounds(subnet)
+            bounds[version].append((first, last))
+
+        self.ranges = {v: RangeSet(b) for v, b in bounds.items()}
+
+    def covers(self, subnet):
+        version, first, last = _subnet_bounds(subnet)
+
+        return self.ranges[version].covers(first, last)
+
+    def to_list(self):
+        """
+        Return the minimal list of CIDR subnets covering the set
+        :return: list of dict ({'network': str})
+        """
+        subnets = []
+
+        for version, address in [(4, ipaddress.IPv4Address),
+                                 (6, ipaddress.IPv6Address)]:
+            for first, last in self.ranges[version]:
+                subnets.extend(
+                    {'network': str(n)} for n in
+                    ipaddress.summarize_address_range(address(first),
+                                                      address(last)))
+
+        return subnets
+
+
+def find_subnet_overlaps(subnets):
+    """
+    Find the subnets which duplicate or overlap another subnet of the list
+    :param subnets: list of str
+    :return: list of error messages
+    """
+    errors = []
+    widest = None
+
+    for version, first, last, subnet in sorted(
+            _subnet_bounds(s) + (s,) for s in subnets):
+        if widest and widest[0] == version and first <= widest[2]:
+            errors.append(overlap_error('subnet', subnet, widest[3]))
+
+        if not widest or widest[0] != version or last > widest[2]:
+            widest = (version, first, last, subnet)
+
+    return errors
+
+
+class IntervalIndex(object):
+    """
+    Intervals (first, last, label, owner, ...) sorted by first value. Each
+    position also records the interval reaching furthest so far and the one
+    reaching furthest among other owners, so a single bisect tells whether
+    [first, last] overlaps an interval of any owner but the ignored one.
+    """
+
+    def __init__(self, intervals):
+        self.items = sorted(intervals, key=lambda i: (i[0], i[1]))
+        self.firsts = [i[0] for i in self.items]
+        self.reach = []
+
+        best = second = None
+        for item in self.items:
+            if best is None or item[1] > best[1]:
+                if best is not None and best[3] != item[3]:
+                    second = best
+                best = item
+            elif item[3] != best[3] and (second is None or item[1] > second[1]):
+                second = item
+
+            self.reach.append((best, second))
+
+    def find(self, first, last, ignore=None):
+        """
+        Return an interval overlapping [first, last] not owned by ignore
+        :param first: int
+        :param last: int
+        :param ignore: owner to skip
+        :return: tuple or None
+        """
+        i = bisect.bisect_right(self.firsts, last) - 1
+
+        if i < 0:
+            return None
+
+        best, second = self.reach[i]
+        found = second if ignore is not None and best[3] == ignore else best
+
+        if found is not None and found[1] >= first:
+            return found
+
+        return None
+
+
+def _subnet_intervals(pools, owner_key=None):
+    intervals = {4: [], 6: []}
+
+    for pool in pools:
+        for subnet in pool.get('subnets') or []:
+            version, first, last = _subnet_bounds(subnet)
+            intervals[version].append((first, last, subnet['network'],
+                                       (owner_key, pool['id']),
+                                       pool['display_name']))
+
+    return intervals
+
+
+def _range_intervals(pools, owner_key=None):
+    return [(r['first'], r['last'], "[{}, {}]".format(r['first'], r['last']),
+             (owner_key, pool['id']), pool['display_name'])
+            for pool in pools for r in pool.get('ranges') or []]
+
+
+class PoolIndex(object):
+    """
+    Index of the ranges and subnets of every AOS resource pool (ASN, VNI,
+    IPv4 and IPv6), used to reject values already owned by another pool
+    """
+
+    def __init__(self, pools):
+        """
+        :param pools: dict of pool lists keyed on 'asn', 'vni', 'ipv4'
+                      and 'ipv6' (see POOL_ENDPOINTS)
+        """
+        self.indexes = {}
+
+        for kind in ['asn', 'vni']:
+            self.indexes[kind] = IntervalIndex(
+                _range_intervals(pools.get(kind) or [], kind))
+
+        subnets = {4: [], 6: []}
+        for kind in ['ipv4', 'ipv6']:
+            for version, intervals in _subnet_intervals(pools.get(kind) or [],
+                                                        kind).items():
+                subnets[version].extend(intervals)
+
+        for version, intervals in subnets.items():
+            self.indexes[version] = IntervalIndex(intervals)
+
+    def conflicts(self, kind, values, ignore=None):
+        """
+        Find the values overlapping a range or subnet of another pool
+        :param kind: string ('asn', 'vni', 'ipv4' or 'ipv6')
+        :param values: list of ranges or subnets
+        :param ignore: dict (pool of kind being changed, not checked)
+        :return: list of error messages
+        """
+        ignore = (kind, ignore['id']) if ignore else None
+        errors = []
+
+        for value in values:
+            if kind in ['asn', 'vni']:
+                first, last = _range_bounds(value)
+                found = self.indexes[kind].find(first, last, ignore)
+                label = ('range', "[{}, {}]".format(first, last))
+            else:
+                version, first, last = _subnet_bounds(value)
+                found = self.indexes[version].find(first, last, ignore)
+                label = ('subnet', value)
+
+            if found:
+                errors.append(overlap_error(
+                    label[0], label[1], found[2],
+                    "{} pool {}".format(found[3][0], found[4])))
+
+        return errors
+
+
+def check_pool_conflicts(session, kind, specs, resource_data):
+    """
+    Check the ranges or subnets requested for a list of pools against each
+    other and against every other pool of the AOS server
+    :param session: dict
+    :param kind: string ('asn', 'vni', 'ipv4' or 'ipv6')
+    :param specs: list of dict (pool name, id, state and ranges or subnets)
+    :param resource_data: dict (collection of the pools of kind)
+    :return: list of error messages
+    """
+    field = 'ranges' if kind in ['asn', 'vni'] else 'subnets'
+    present = [s for s in specs if s['state'] == 'present']
+    values = [v for s in present for v in s[field]]
+
+    if field == 'ranges':
+        errors = find_range_overlaps(values)
+    else:
+        errors = find_subnet_overlaps(values)
+
+    index = ResourceIndex.from_response(resource_data)
+    pool_index = get_pool_index(session)
+
+    for spec in present:
+        if spec['id']:
+            my_pool = index.by_id(spec['id'])
+        else:
+            my_pool = index.by_name(spec['name'])
+
+        errors.extend(pool_index.conflicts(kind, spec[field], my_pool))
+
+    return errors
+
+
+def get_pool_index(session, ttl=None):
+    """
+    Build the PoolIndex of every resource pool of the AOS server. The four
+    collections are read concurrently through the on-disk cache.
+    :param session: dict
+    :param ttl: float (seconds, see cached_get)
+    :return: PoolIndex
+    """
+    kinds = sorted(POOL_ENDPOINTS)
+    outcomes = run_concurrently(
+        lambda kind: cached_get(session, POOL_ENDPOINTS[kind], ttl), kinds,
+        len(kinds))
+
+    pools = {}
+    for kind, (body, error) in zip(kinds, outcomes):
+        if error:
+            raise requests.RequestException(
+                "Unable to read {}: {}".format(POOL_ENDPOINTS[kind], error))
+
+        pools[kind] = body.get('items') or []
+
+    return PoolIndex(pools)
+
+
+def merge_subnets(existing, subnets):
+    """
+    Merge requested subnets into the subnets of an existing pool. The result
+    is the minimal list of subnets covering both, and changed is False when
+    the pool already covers every requested subnet.
+    :param existing: list of dict ({'network': str})
+    :param subnets: list of str
+    :return: merged subnets (list of dict), changed(bool)
+    """
+    current = SubnetSet(existing)
+    changed = not all(current.covers(s) for s in subnets)
+
+    if not changed:
+        return [{'network': s['network']} for s in existing], False
+
+    return SubnetSet(list(existing) + list(subnets)).to_list(), True
@@ -48,6 +48,29 @@ options:
         2 values. A start of range and an end of range.
     required: false
     type: str
+  check_conflicts:
+    description:
+      - Before any change, make sure the requested ranges do not overlap a
+        range of another ASN Pool (or of another entry of I(pools)).
+        The pools of the AOS server are read once and cached on disk for
+        AOS_CACHE_TTL seconds (default 30) in AOS_CACHE_DIR.
+    default: false
+    required: false
+    type: bool
+  pools:
+    description:
+      - List of ASN Pools to manage in a single run. Each entry is a dict with
+        I(name) or I(id), I(ranges) and I(state). The pool collection is read
+        once and all changes are sent concurrently.
+        Mutually exclusive with I(name) and I(id).
+    required: false
+    type: list
+  concurrency:
+    description:
+      - Maximum number of requests sent in parallel when I(pools) is used.
+    default: 8
+    required: false
+    type: int
 '''
 
 EXAMPLES = '''
@@ -82,6 +105,19 @@ EXAMPLES = '''
     session: "{{ aos_session }}"
     name: "my-asn-pool"
     state: absent
+
+- name: "Manage several ASN Pools at once"
+  aos_asn_pool:
+    session: "{{ aos_session }}"
+    pools:
+      - name: "rack-001-pool"
+        ranges:
+          - [ 100, 200 ]
+      - name: "rack-002-pool"
+        ranges:
+          - [ 300, 400 ]
+      - name: "old-pool"
+        state: absent
 '''
 
 RETURNS = '''
@@ -102,13 +138,25 @@ value:
   returned: always
   type: dict
   sample: {'...'}
+
+pools:
+  description: Outcome for each entry of I(pools)
+  returned: when I(pools) is used
+  type: list
+  sample: [{'name': 'rack-001-pool', 'id': 'rack-001-pool', 'success': True,
+            'changed': True, 'value': {'...'}}]
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import aos_post, aos_put, aos_delete, find_resource_item
+from library.aos import aos_get, aos_post, aos_put, aos_delete, response_error, \
+    find_resource_item, reconcile_resources, merge_ranges, find_range_overlaps, \
+    RangeSet, check_pool_conflicts, get_pool_index, instrument_module, \
+    DEFAULT_CONCURRENCY
 
 ENDPOINT = 'resources/asn-pools'
 
+POOL_DEFAULTS = {'name': None, 'id': None, 'state': 'present', 'ranges': []}
+
 
 def validate_ranges(ranges):
     """
@@ -128,16 +176,20 @@ def validate_ranges(ranges):
         elif asn_range[1] <= asn_range[0]:
             errors.append("Invalid range: 2nd element must be bigger than 1st")
 
+    if not errors:
+        errors = find_range_overlaps(ranges)
+
     return errors
 
 
 def get_ranges(pool):
     """
-    convert ASN pool list to dict format
+    convert ASN pool list to dict format, coalescing overlapping and
+    adjacent ranges
     :param pool: list
     :return: dict
     """
-    return [{"first": r[0], "last": r[1]} for r in pool]
+    return RangeSet(pool).to_list()
 
 
 def asn_pool_absent(module, session, my_pool):
@@ -161,26 +213,32 @@ def asn_pool_absent(module, session, my_pool):
                               " currently in use".format(my_pool['display_name'])}
 
     if not module.check_mode:
-        aos_delete(session, ENDPOINT, my_pool['id'])
+        response = aos_delete(session, ENDPOINT, my_pool['id'])
+
+        if not response.ok:
+            return False, False, {"msg": "Unable to delete ASN Pool {}: {}"
+                                  .format(my_pool['display_name'],
+                                          response_error(response))}
 
         return True, True, my_pool
 
     return True, False, my_pool
 
 
-def asn_pool_present(module, session, my_pool):
+def asn_pool_present(module, session, my_pool, spec=None):
     """
     Create new ASN pool or modify existing pool
     :param module: Ansible built in
     :param session: dict
     :param my_pool: dict
+    :param spec: dict (pool entry from I(pools), defaults to module params)
     :return: success(bool), changed(bool), results(dict)
     """
-    margs = module.params
+    margs = spec or module.params
 
     if not my_pool:
 
-        if 'name' not in margs.keys():
+        if not margs['name']:
             return False, False, {"msg": "name required to create a new resource"}
 
         new_pool = {"ranges": get_ranges(margs['ranges']),
@@ -195,26 +253,29 @@ def asn_pool_present(module, session, my_pool):
         return True, False, new_pool
 
     else:
-        if my_pool['ranges']:
+        merged, changed = merge_ranges(my_pool['ranges'], margs['ranges'])
 
-            endpoint_put = "{}/{}".format(ENDPOINT, my_pool['id'])
+        # Everything requested is already in the pool, nothing to write
+        if not changed:
+            return True, False, my_pool
 
-            new_pool = {"ranges": get_ranges(margs['ranges']),
-                        "display_name": my_pool['display_name'],
-                        "id": my_pool['id']}
+        endpoint_put = "{}/{}".format(ENDPOINT, my_pool['id'])
 
-            for asn_range in my_pool['ranges']:
-                new_pool['ranges'].append({'first': asn_range['first'],
-                                           'last': asn_range['last']})
+        new_pool = {"ranges": merged,
+                    "display_name": my_pool['display_name'],
+                    "id": my_pool['id']}
 
-            if not module.check_mode:
-                aos_put(session, endpoint_put, new_pool)
+        if not module.check_mode:
+            response = aos_put(session, endpoint_put, new_pool)
 
-                return True, True, new_pool
+            if not response.ok:
+                return False, False, {"msg": "Unable to update ASN Pool {}: {}"
+                                      .format(my_pool['display_name'],
+                                              response_error(response))}
 
-            return True, False, new_pool
+            return True, True, new_pool
 
-        return True, False, my_pool
+        return True, False, new_pool
 
 
 def asn_pool(module):
@@ -241,6 +302,13 @@ def asn_pool(module):
     my_pool = find_resource_item(margs['session'], ENDPOINT,
                                  name=name, uuid=uuid)
 
+    if margs['check_conflicts'] and margs['state'] == 'present':
+        errors = get_pool_index(margs['session']).conflicts(
+            'asn', margs['ranges'], my_pool)
+
+        if errors:
+            module.fail_json(msg=errors)
+
     if margs['state'] == 'absent':
         success, changed, results = asn_pool_absent(module,
                                                     margs['session'],
@@ -258,6 +326,58 @@ def asn_pool(module):
         module.fail_json(msg=results)
 
 
+def asn_pool_bulk(module):
+    """
+    Create, change or delete every AOS ASN resource pool listed in pools
+    """
+    margs = module.params
+
+    errors = []
+    specs = []
+    for pool in margs['pools']:
+        if not isinstance(pool, dict):
+            errors.append("Invalid pool: must be a dict")
+            continue
+
+        spec = dict(POOL_DEFAULTS, **pool)
+
+        if not spec['name'] and not spec['id']:
+            errors.append("Invalid pool: name or id required")
+
+        if spec['state'] not in ['present', 'absent']:
+            errors.append("Invalid state: {}".format(spec['state']))
+
+        errors.extend(validate_ranges(spec['ranges']))
+        specs.append(spec)
+
+    if errors:
+        module.fail_json(msg=errors)
+
+    resource_data = None
+
+    if margs['check_conflicts']:
+        resource_data = aos_get(margs['session'], ENDPOINT)
+        errors = check_pool_conflicts(margs['session'], 'asn', specs,
+                                      resource_data)
+
+        if errors:
+            module.fail_json(msg=errors)
+
+    changed, results = reconcile_resources(module, margs['session'], ENDPOINT,
+                                           specs, asn_pool_present,
+                                           asn_pool_absent,
+                                           margs['concurrency'],
+                                           resource_data=resource_data)
+
+    failed = [r for r in results if not r['success']]
+
+    if failed:
+        module.fail_json(msg="Unable to manage {} ASN Pool(s)"
+                         .format(len(failed)), changed=changed, pools=results)
+
+    module.exit_json(changed=changed, pools=results)
+
+
 def main():
     """
     Main function to setup inputs
@@ -270,14 +390,23 @@ def main():
             state=dict(required=False,
                        choices=['present', 'absent'],
                        default="present",),
-            ranges=dict(required=False, type="list", default=[])
+            ranges=dict(required=False, type="list", default=[]),
+            check_conflicts=dict(required=False, type="bool", default=False),
+            pools=dict(required=False, type="list"),
+            concurrency=dict(required=False, type="int",
+                             default=DEFAULT_CONCURRENCY),
         ),
-        mutually_exclusive=[('name', 'id')],
-        required_one_of=[('name', 'id')],
+        mutually_exclusive=[('name', 'id', 'pools')],
+        required_one_of=[('name', 'id', 'pools')],
         supports_check_mode=True
     )
 
-    asn_pool(module)
+    instrument_module(module)
+
+    if module.params['pools']:
+        asn_pool_bulk(module)
+    else:
+        asn_pool(module)
 
 
 if __name__ == "__main__":
@@ -30,6 +30,47 @@ options:
       - ID of blueprint, as defined by AOS when created.
     required: false
     type: str
+  wait:
+    description:
+      - Wait until the deploy is over (success or failure), polling its
+        status with exponential backoff.
+    default: false
+    required: false
+    type: bool
+  timeout:
+    description:
+      - Seconds to wait for the deploy to be over when I(wait) is set.
+    default: 600
+    required: false
+    type: int
+  poll_interval:
+    description:
+      - Seconds before the first status poll when I(wait) is set. The
+        interval then doubles, up to 30 seconds. Must be greater than 0.
+    default: 2
+    required: false
+    type: float
+  handle:
+    description:
+      - I(deploy_handle) returned by a previous run. Check (or with I(wait),
+        wait for) the status of that deploy instead of starting one.
+    required: false
+    type: dict
+  blueprints:
+    description:
+      - List of blueprints to deploy in parallel, each a label, an ID or a
+        dict with I(name) or I(id). The blueprints are resolved with a
+        single read of the blueprints list, and I(wait), I(timeout) and
+        I(poll_interval) apply to each of them.
+    required: false
+    type: list
+  concurrency:
+    description:
+      - Maximum number of blueprints deployed at the same time with
+        I(blueprints).
+    default: 8
+    required: false
+    type: int
 '''
 
 EXAMPLES = '''
@@ -43,6 +84,35 @@ EXAMPLES = '''
   aos_bp_deploy:
     session: "{{ aos_session }}"
     id: "{{ aos_bp_id }}"
+
+- name: Deploy Blueprint DC1-EVPN and wait up to 10 minutes for the result
+  aos_bp_deploy:
+    session: "{{ aos_session }}"
+    name: 'DC1-EVPN'
+    wait: true
+    timeout: 600
+
+- name: Deploy several blueprints, four at a time
+  aos_bp_deploy:
+    session: "{{ aos_session }}"
+    blueprints:
+      - DC1-EVPN
+      - DC2-EVPN
+      - id: "{{ aos_bp_id }}"
+    concurrency: 4
+    wait: true
+
+- name: Start deploying Blueprint DC1-EVPN
+  aos_bp_deploy:
+    session: "{{ aos_session }}"
+    name: 'DC1-EVPN'
+  register: bp_deploy
+
+- name: Wait for the deploy started above
+  aos_bp_deploy:
+    session: "{{ aos_session }}"
+    handle: "{{ bp_deploy.deploy_handle }}"
+    wait: true
 '''
 
 RETURNS = '''
@@ -51,90 +121,150 @@ blueprint_id:
   returned: always
   type: string
   sample: "db6588fe-9f36-4b04-8def-89e7dcd00c17"
+deploy_handle:
+  description: Blueprint ID and version being deployed, to pass as I(handle)
+  returned: always
+  type: dict
+  sample: {"blueprint_id": "db6588fe-9f36-4b04-8def-89e7dcd00c17",
+           "version": 12}
+deploy_state:
+  description: Last known state of the deploy, ex. 'success' or 'failure'
+  returned: always
+  type: string
+  sample: "success"
+deploy_done:
+  description: Whether the deploy of the I(deploy_handle) version is over
+  returned: always
+  type: bool
+blueprints:
+  description: Outcome of each blueprint deploy (name, id, success, changed,
+               msg, deploy_handle, deploy_state, deploy_done)
+  returned: when blueprints is set
+  type: list
 '''
 
 
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import aos_get, aos_put
+from library.aos import aos_get, ResourceIndex, run_concurrently, \
+    deploy_blueprint, instrument_module, \
+    DEFAULT_POLL_INTERVAL, DEFAULT_CONCURRENCY
 
 ENDPOINT = 'blueprints'
 
 
-def get_blueprint_status(session, blueprint_id):
-    endpoint = "{}/{}/deploy".format(ENDPOINT, blueprint_id)
+def get_blueprint_id(session, blueprint_name):
+    endpoint = "blueprints"
 
     resp_data = aos_get(session, endpoint)
 
-    return resp_data
+    return ResourceIndex.from_response(resp_data).by_label(
+        blueprint_name).get('id')
 
 
-def get_blueprint_version(session, blueprint_id):
-    endpoint = "{}/{}".format(ENDPOINT, blueprint_id)
+def aos_bp_deploy(module):
+    mod_args = module.params
 
-    resp_data = aos_get(session, endpoint)
+    if mod_args['poll_interval'] <= 0:
+        module.fail_json(msg="Invalid poll_interval: must be greater than 0")
 
-    return resp_data['version']
+    if mod_args['blueprints']:
+        return aos_bp_deploy_bulk(module)
 
+    handle = mod_args['handle']
 
-def get_blueprint_id(session, blueprint_name):
-    endpoint = "blueprints"
+    if handle:
+        blueprint_id = handle['blueprint_id']
+    elif mod_args['id']:
+        blueprint_id = mod_args['id']
+    else:
+        blueprint_id = get_blueprint_id(mod_args['session'], mod_args['name'])
 
-    resp_data = aos_get(session, endpoint)
+    result = deploy_blueprint(mod_args['session'], blueprint_id,
+                              mod_args['wait'], mod_args['timeout'],
+                              mod_args['poll_interval'], handle)
 
-    for i in resp_data['items']:
-        if i['label'] == blueprint_name:
-            return i['id']
+    if not result['success']:
+        module.fail_json(msg=result['msg'], changed=result['changed'],
+                         deploy_handle=result['deploy_handle'])
 
-    return None
+    module.exit_json(changed=result['changed'],
+                     deploy_handle=result['deploy_handle'],
+                     deploy_state=result['deploy_state'],
+                     deploy_done=result['deploy_done'],
+                     ansible_facts=dict(blueprint_id=blueprint_id))
 
 
-def aos_bp_deploy(module):
-    mod_args = module.params
+def resolve_blueprints(resource_data, blueprints):
+    """
+    Find the blueprints listed by label or id in one blueprints collection
+    :param resource_data: dict (blueprints collection)
+    :param blueprints: list of blueprint labels, ids or dicts (name or id)
+    :return: tuple (list of (name, id), list of error messages)
+    """
+    index = ResourceIndex.from_response(resource_data)
+    found = []
+    errors = []
 
-    if mod_args['id']:
-        blueprint_id = mod_args['id']
-    else:
-        blueprint_id = get_blueprint_id(mod_args['session'], mod_args['name'])
+    for blueprint in blueprints:
+        if not isinstance(blueprint, dict):
+            blueprint = {'id': blueprint, 'name': blueprint}
 
-    endpoint = "{}/{}/deploy".format(ENDPOINT, blueprint_id)
+        item = index.by_id(blueprint.get('id'))
 
-    staged_version = get_blueprint_version(mod_args['session'],
-                                           blueprint_id)
-    deployed_version = get_blueprint_status(mod_args['session'],
-                                            blueprint_id)['version']
+        if not item and blueprint.get('name') in index.duplicate_labels:
+            errors.append("Multiple blueprints found with label {}"
+                          .format(blueprint['name']))
+            continue
 
-    if staged_version == deployed_version:
-        module.exit_json(changed=False,
-                         ansible_facts=dict(blueprint_id=blueprint_id))
+        item = item or index.by_label(blueprint.get('name'))
 
-    payload = {"version": staged_version}
+        if item:
+            found.append((item.get('label'), item['id']))
+        else:
+            errors.append("Blueprint not found: {}".format(
+                blueprint.get('id') or blueprint.get('name')))
 
-    response = aos_put(mod_args['session'], endpoint, payload)
+    return found, errors
 
-    if response.ok:
 
-        bp_status = get_blueprint_status(mod_args['session'], blueprint_id)
+def aos_bp_deploy_bulk(module):
+    """
+    Deploy every blueprint listed in blueprints, in parallel
+    """
+    mod_args = module.params
 
-        if bp_status['state'] == 'failure':
-            module.fail_json(msg="Unable to commit blueprint: {}"
-                             .format(bp_status['error']))
+    resource_data = aos_get(mod_args['session'], ENDPOINT)
+    blueprints, errors = resolve_blueprints(resource_data,
+                                            mod_args['blueprints'])
 
-        else:
-            module.exit_json(changed=True,
-                             ansible_facts=dict(blueprint_id=blueprint_id))
+    if errors:
+        module.fail_json(msg=errors)
 
-    else:
-        error_message = str(response)
-        try:
-            error_message = response.json().get('errors')
-        except (TypeError, ValueError) as e:
-            module.fail_json(
-                msg="Failed to decode JSON from response: {}, error: {}"
-                    .format(response, e))
+    def deploy(blueprint):
+        return deploy_blueprint(mod_args['session'], blueprint[1],
+                                mod_args['wait'], mod_args['timeout'],
+                                mod_args['poll_interval'])
+
+    results = []
+    outcomes = run_concurrently(deploy, blueprints, mod_args['concurrency'])
+
+    for (name, blueprint_id), (result, error) in zip(blueprints, outcomes):
+        if error:
+            result = {'id': blueprint_id, 'success': False, 'changed': False,
+                      'msg': error, 'deploy_handle': None}
+
+        result['name'] = name
+        results.append(result)
 
-        module.fail_json(
-            msg="Issue deploying blueprint {}: {}"
-                .format(blueprint_id, error_message))
+    changed = any(r['changed'] for r in results)
+    failed = [r for r in results if not r['success']]
+
+    if failed:
+        module.fail_json(msg="Unable to deploy {} blueprint(s)"
+                         .format(len(failed)), changed=changed,
+                         blueprints=results)
+
+    module.exit_json(changed=changed, blueprints=results)
 
 
 def main():
@@ -142,13 +272,23 @@ def main():
         argument_spec=dict(
             session=dict(required=True, type="dict"),
             name=dict(required=False),
-            id=dict(required=False)
+            id=dict(required=False),
+            wait=dict(required=False, type="bool", default=False),
+            timeout=dict(required=False, type="int", default=600),
+            poll_interval=dict(required=False, type="float",
+                               default=DEFAULT_POLL_INTERVAL),
+            handle=dict(required=False, type="dict"),
+            blueprints=dict(required=False, type="list"),
+            concurrency=dict(required=False, type="int",
+                             default=DEFAULT_CONCURRENCY)
         ),
-        mutually_exclusive=[('name', 'id')],
-        required_one_of=[('name', 'id')],
+        mutually_exclusive=[('name', 'id', 'handle', 'blueprints')],
+        required_one_of=[('name', 'id', 'handle', 'blueprints')],
         supports_check_mode=False
     )
 
+    instrument_module(module)
+
     aos_bp_deploy(module)
 
 
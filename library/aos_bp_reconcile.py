@@ -0,0 +1,608 @@
+# (c) 2017 Apstra Inc, <community@apstra.com>
+
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: aos_bp_reconcile
+author: Apstra Inc (@Apstra)
+version_added: "2.7"
+short_description: Bring the security-zones and virtual networks of an AOS
+                   blueprint to a desired state
+description:
+  - Take the desired security-zones and virtual networks of an existing AOS
+    blueprint, read the current ones once and apply the difference in a
+    single task.
+  - Changes run in order, each step with bounded concurrency. Security-zones
+    are created and updated, then virtual networks are created and updated,
+    then virtual networks are deleted and security-zones last, so that no
+    zone is removed while a virtual network still uses it.
+  - The blueprint can be deployed once every change is applied.
+options:
+  session:
+    description:
+      - Session details from aos_login generated session.
+    required: true
+    type: dict
+  blueprint_id:
+    description:
+      - ID of blueprint, as defined by AOS when created
+    required: true
+    type: str
+  security_zones:
+    description:
+      - Desired security-zones. Each entry is a dict with I(name) (label and
+        vrf name of the zone), and optionally I(vni_id), I(vlan_id) and
+        I(state) (C(present) or C(absent)).
+    required: false
+    default: []
+    type: list
+  virtual_networks:
+    description:
+      - Desired virtual networks. Each entry is a dict with I(name) and the
+        keys of aos_bp_virtual_networks (I(state), I(vn_type), I(vn_id),
+        I(bound_to_name), I(ipv4_subnet), ...). I(security_zone) names the
+        security-zone of the virtual network, which may be created by the
+        same task. The security-zone and type of an existing virtual network
+        cannot be changed.
+    required: false
+    default: []
+    type: list
+  purge:
+    description:
+      - Delete the virtual networks and evpn security-zones of the blueprint
+        which are not listed.
+    default: false
+    required: false
+    type: bool
+  deploy:
+    description:
+      - Deploy the blueprint once every change is applied.
+    default: false
+    required: false
+    type: bool
+  wait:
+    description:
+      - Wait for the end of the deploy when I(deploy) is set.
+    default: false
+    required: false
+    type: bool
+  timeout:
+    description:
+      - Seconds to wait for the deploy when I(wait) is set.
+    default: 600
+    required: false
+    type: int
+  poll_interval:
+    description:
+      - Seconds between two first polls of the deploy status, doubled after
+        each poll. Must be greater than 0.
+    default: 2
+    required: false
+    type: float
+  concurrency:
+    description:
+      - Maximum number of requests sent in parallel by each step.
+    default: 8
+    required: false
+    type: int
+'''
+
+EXAMPLES = '''
+
+- name: Tenant networks of a blueprint
+  aos_bp_reconcile:
+    session: "{{ aos_session }}"
+    blueprint_id: "{{ bp_id }}"
+    security_zones:
+      - name: "tenant-a"
+        vni_id: 4096
+      - name: "old-tenant"
+        state: absent
+    virtual_networks:
+      - name: "tenant-a-web"
+        vn_type: "vxlan"
+        security_zone: "tenant-a"
+        bound_to_name:
+          - "rack_001_leaf1"
+          - "rack_002_leaf1"
+      - name: "vlan-101"
+        vn_id: 101
+        bound_to_name:
+          - "rack_001_leaf1"
+    deploy: true
+    wait: true
+'''
+
+RETURNS = '''
+plan:
+  description: Ordered steps bringing the blueprint to the desired state,
+               with the outcome of each (planned in check mode, done, failed
+               or skipped after a failed step)
+  returned: always
+  type: list
+  sample: [{'phase': 0, 'kind': 'security_zone', 'action': 'create',
+            'name': 'tenant-a', 'id': 'db6588fe-9f36-4b04-8def-89e7dcd00c17',
+            'status': 'done', 'payload': {'...'}}]
+deploy:
+  description: Outcome of the deploy, as returned by aos_bp_deploy
+  returned: when I(deploy) is set and every step is done
+  type: dict
+  sample: {'changed': True, 'deploy_state': 'success', 'deploy_done': True}
+'''
+
+
+from ansible.module_utils.basic import AnsibleModule
+from library.aos import aos_post, aos_put, aos_delete, blueprint_get, \
+    find_bp_system_nodes, run_concurrently, deploy_blueprint, ResourceIndex, \
+    validate_vni_id, validate_vlan_id, VN_DEFAULTS, vn_add_options, \
+    virt_net_changes, validate_virtual_network, get_bound_to, \
+    instrument_module, DEFAULT_POLL_INTERVAL, DEFAULT_CONCURRENCY
+
+SZ_ENDPOINT = 'blueprints/{}/security-zones'
+VN_ENDPOINT = 'blueprints/{}/virtual-networks'
+
+SZ_DEFAULTS = {'name': None, 'state': 'present', 'vni_id': None,
+               'vlan_id': None}
+
+# Steps run phase after phase: zones exist before the virtual networks
+# using them, and are deleted after them
+PHASES = [('security_zone', ('create', 'update')),
+          ('virtual_network', ('create', 'update')),
+          ('virtual_network', ('delete',)),
+          ('security_zone', ('delete',))]
+
+
+def step_phase(kind, action):
+    return next(i for i, (k, actions) in enumerate(PHASES)
+                if k == kind and action in actions)
+
+
+def make_step(kind, action, name, item_id=None, payload=None, **extra):
+    return dict(extra, phase=step_phase(kind, action), kind=kind,
+                action=action, name=name, id=item_id, payload=payload)
+
+
+def validate_security_zone(sz):
+    """
+    Validate the VNI and VLAN ID of a security-zone
+    :param sz: dict (entry from I(security_zones))
+    :return: errors(list)
+    """
+    errors = []
+
+    for key, validate in [('vni_id', validate_vni_id),
+                          ('vlan_id', validate_vlan_id)]:
+        if sz[key] is None:
+            continue
+
+        try:
+            sz[key] = int(sz[key])
+        except ValueError:
+            errors.append("Invalid ID: must be an integer")
+            continue
+
+        err = validate(sz[key])
+
+        if err:
+            errors.append(err)
+
+    return errors
+
+
+def parse_specs(entries, defaults, kind):
+    """
+    Apply defaults to the desired items and check their name and state
+    :param entries: list of dict
+    :param defaults: dict
+    :param kind: str (for error messages)
+    :return: specs(list), errors(list)
+    """
+    specs = []
+    errors = []
+    names = set()
+
+    for entry in entries or []:
+        if not isinstance(entry, dict):
+            errors.append("Invalid {}: must be a dict".format(kind))
+            continue
+
+        spec = dict(defaults, **entry)
+
+        if not spec['name']:
+            errors.append("Invalid {}: name required".format(kind))
+        elif spec['name'] in names:
+            errors.append("Duplicate {}: {}".format(kind, spec['name']))
+
+        if spec['state'] not in ['present', 'absent']:
+            errors.append("Invalid state: {}".format(spec['state']))
+
+        names.add(spec['name'])
+        specs.append(spec)
+
+    return specs, errors
+
+
+def zone_step(my_sz, spec):
+    """
+    Step bringing a security-zone to its spec, None when it is up to date
+    :param my_sz: dict (current security-zone, empty when missing)
+    :param spec: dict
+    :return: dict or None
+    """
+    if spec['state'] == 'absent':
+        if my_sz:
+            return make_step('security_zone', 'delete', spec['name'],
+                             my_sz['id'])
+        return None
+
+    options = dict((key, spec[key]) for key in ['vni_id', 'vlan_id']
+                   if spec[key])
+
+    if not my_sz:
+        payload = dict(options, sz_type='evpn', label=spec['name'],
+                       vrf_name=spec['name'])
+        return make_step('security_zone', 'create', spec['name'],
+                         payload=payload)
+
+    if any(my_sz.get(key) != value for key, value in options.items()):
+        payload = dict(options, sz_type='evpn', label=my_sz['label'],
+                       vrf_name=my_sz.get('vrf_name', my_sz['label']),
+                       id=my_sz['id'])
+        return make_step('security_zone', 'update', spec['name'],
+                         my_sz['id'], payload)
+
+    return None
+
+
+def vn_step(my_vn, spec, bound_to):
+    """
+    Step bringing a virtual network to its spec, None when it is up to date.
+    A security-zone created by the plan is named in the step and resolved
+    once created.
+    :param my_vn: dict (current virtual network, empty when missing)
+    :param spec: dict
+    :param bound_to: list
+    :return: dict or None
+    """
+    if spec['state'] == 'absent':
+        if my_vn:
+            return make_step('virtual_network', 'delete', spec['name'],
+                             my_vn['id'])
+        return None
+
+    if not my_vn:
+        payload = {'vn_type': spec['vn_type'],
+                   'label': spec['name'],
+                   'bound_to': bound_to,
+                   'sec_zone_id': spec['sec_zone_id']}
+
+        if spec['sec_zone_id']:
+            payload['security_zone_id'] = spec['sec_zone_id']
+
+        vn_add_options(payload, spec['vn_id'], spec['ipv4_enabled'],
+                       spec['ipv6_enabled'], spec['ipv4_subnet'],
+                       spec['ipv6_subnet'], spec['virtual_gw_ipv4'],
+                       spec['virtual_gw_ipv6'], spec['dhcp_service'])
+
+        return make_step('virtual_network', 'create', spec['name'],
+                         payload=payload,
+                         security_zone=spec.get('security_zone'))
+
+    payload = {'vn_type': my_vn['vn_type'],
+               'label': my_vn['label'],
+               'bound_to': bound_to,
+               'id': my_vn['id']}
+
+    vn_add_options(payload, spec['vn_id'], spec['ipv4_enabled'],
+                   spec['ipv6_enabled'], spec['ipv4_subnet'],
+                   spec['ipv6_subnet'], spec['virtual_gw_ipv4'],
+                   spec['virtual_gw_ipv6'], spec['dhcp_service'])
+
+    if not virt_net_changes(my_vn, payload):
+        return None
+
+    return make_step('virtual_network', 'update', spec['name'], my_vn['id'],
+                     payload)
+
+
+def vn_zone_id(vn):
+    return vn.get('security_zone_id') or vn.get('sec_zone_id')
+
+
+def build_plan(sz_data, vn_data, sz_specs, vn_specs, node_index,
+               purge=False):
+    """
+    Compute the ordered steps bringing the blueprint to the desired state
+    :param sz_data: dict (blueprint security-zones)
+    :param vn_data: dict (blueprint virtual networks)
+    :param sz_specs: list of dict
+    :param vn_specs: list of dict
+    :param node_index: ResourceIndex of the bound_to_name system nodes
+    :param purge: bool
+    :return: plan(list), errors(list)
+    """
+    zones = ResourceIndex.from_response(sz_data, 'items')
+    vns = ResourceIndex.from_response(vn_data, 'virtual_networks')
+    errors = []
+    steps = []
+
+    for kind, index, specs in [('security-zones', zones, sz_specs),
+                               ('virtual networks', vns, vn_specs)]:
+        for spec in specs:
+            if spec['name'] in index.duplicate_labels:
+                errors.append("Multiple {} found with name {}"
+                              .format(kind, spec['name']))
+
+    if errors:
+        return [], errors
+
+    for spec in sz_specs:
+        steps.append(zone_step(zones.by_label(spec['name']), spec))
+
+    if purge:
+        listed = set(spec['name'] for spec in sz_specs)
+        # Only evpn zones are tenant zones, the default zone stays
+        tenant_zones = [sz for sz in zones.items
+                        if sz.get('sz_type') == 'evpn']
+        steps.extend(make_step('security_zone', 'delete', sz['label'],
+                               sz['id'])
+                     for sz in tenant_zones if sz['label'] not in listed)
+
+    deleted_zones = dict((s['id'], s['name']) for s in steps
+                         if s and s['action'] == 'delete')
+    kept_zones = set(sz['label'] for sz in zones.items
+                     if sz['id'] not in deleted_zones)
+    kept_zones.update(s['name'] for s in steps
+                      if s and s['action'] == 'create')
+
+    for spec in vn_specs:
+        zone = spec.get('security_zone')
+        my_vn = vns.by_label(spec['name'])
+
+        if spec['state'] == 'present' and zone:
+            if zone not in kept_zones:
+                errors.append("Security zone {} of virtual network {} is "
+                              "not in the blueprint or removed"
+                              .format(zone, spec['name']))
+                continue
+
+            # Zones created by the plan are resolved once created
+            my_zone = zones.by_label(zone)
+            spec['sec_zone_id'] = my_zone.get('id')
+
+            if my_zone:
+                spec['security_zone'] = None
+
+            # The update PUT keeps the zone of a virtual network
+            if my_vn and vn_zone_id(my_vn) != spec['sec_zone_id']:
+                current = zones.by_id(vn_zone_id(my_vn)).get('label')
+                errors.append("Virtual network {} is in security zone {}, "
+                              "it cannot be moved to {}"
+                              .format(spec['name'], current, zone))
+                continue
+
+        # Nor does it change its type
+        if spec['state'] == 'present' and my_vn and \
+                my_vn.get('vn_type') != spec['vn_type']:
+            errors.append("Virtual network {} is of type {}, it cannot be "
+                          "changed to {}".format(spec['name'],
+                                                 my_vn.get('vn_type'),
+                                                 spec['vn_type']))
+            continue
+
+        steps.append(vn_step(my_vn, spec, get_bound_to(spec, node_index)))
+
+    if purge:
+        listed = set(spec['name'] for spec in vn_specs)
+        steps.extend(make_step('virtual_network', 'delete', vn['label'],
+                               vn['id'])
+                     for vn in vns.items if vn.get('label') not in listed)
+
+    vn_steps = [s for s in steps if s and s['kind'] == 'virtual_network']
+    deleted_vns = set(s['id'] for s in vn_steps if s['action'] == 'delete')
+    remaining = [vn for vn in vns.items if vn['id'] not in deleted_vns]
+    planned = [spec for spec in vn_specs if spec['state'] == 'present']
+
+    for zone_id, name in sorted(deleted_zones.items()):
+        users = set(vn['label'] for vn in remaining
+                    if vn_zone_id(vn) == zone_id)
+        users.update(spec['name'] for spec in planned
+                     if spec['sec_zone_id'] == zone_id)
+        users = sorted(users)
+
+        if users:
+            errors.append("Security zone {} is still used by virtual "
+                          "network(s) {}".format(name, ', '.join(users)))
+
+    plan = sorted((s for s in steps if s), key=lambda s: s['phase'])
+
+    return plan, errors
+
+
+def apply_step(session, blueprint_id, step, zone_ids):
+    """
+    Send the request of a step, recording the id of created items
+    :param session: dict
+    :param blueprint_id: str
+    :param step: dict
+    :param zone_ids: dict (security-zone ids by label)
+    :return: None
+    """
+    endpoint = (SZ_ENDPOINT if step['kind'] == 'security_zone'
+                else VN_ENDPOINT).format(blueprint_id)
+
+    if step['action'] == 'create':
+        payload = step['payload']
+
+        if step.get('security_zone'):
+            zone_id = zone_ids[step['security_zone']]
+            payload = dict(payload, sec_zone_id=zone_id,
+                           security_zone_id=zone_id)
+
+        step['id'] = aos_post(session, endpoint, payload)['id']
+        return
+
+    if step['action'] == 'update':
+        response = aos_put(session, "{}/{}".format(endpoint, step['id']),
+                           step['payload'])
+    else:
+        response = aos_delete(session, endpoint, step['id'])
+
+        # Already gone
+        if response.status_code == 404:
+            return
+
+    response.raise_for_status()
+
+
+def run_plan(session, blueprint_id, plan, zone_ids,
+             concurrency=DEFAULT_CONCURRENCY):
+    """
+    Apply the steps of a plan phase after phase, each phase concurrently.
+    Steps after a failed phase are skipped.
+    :return: failed steps(list)
+    """
+    failed = []
+
+    for phase in range(len(PHASES)):
+        steps = [s for s in plan if s['phase'] == phase]
+
+        if failed:
+            for step in steps:
+                step['status'] = 'skipped'
+            continue
+
+        outcomes = run_concurrently(
+            lambda step: apply_step(session, blueprint_id, step, zone_ids),
+            steps, concurrency)
+
+        for step, (_, error) in zip(steps, outcomes):
+            step['status'] = 'failed' if error else 'done'
+
+            if error:
+                step['error'] = error
+                failed.append(step)
+            elif step['kind'] == 'security_zone':
+                zone_ids[step['name']] = step['id']
+
+    return failed
+
+
+def aos_bp_reconcile(module):
+    """
+    Main function to bring the security-zones and virtual networks of an AOS
+    blueprint to their desired state
+    """
+    margs = module.params
+    session = margs['session']
+    blueprint_id = margs['blueprint_id']
+
+    sz_specs, errors = parse_specs(margs['security_zones'], SZ_DEFAULTS,
+                                   'security-zone')
+    vn_specs, vn_errors = parse_specs(margs['virtual_networks'],
+                                      dict(VN_DEFAULTS, security_zone=None),
+                                      'virtual network')
+    errors.extend(vn_errors)
+
+    for spec in sz_specs:
+        errors.extend(validate_security_zone(spec))
+
+    for spec in vn_specs:
+        if spec['vn_type'] not in ['vlan', 'vxlan']:
+            errors.append("Invalid vn_type: {}".format(spec['vn_type']))
+
+        spec['vn_id'], err = validate_virtual_network(spec)
+        errors.extend(err)
+
+    if margs['poll_interval'] <= 0:
+        errors.append("Invalid poll_interval: must be greater than 0")
+
+    if errors:
+        module.fail_json(msg=errors)
+
+    labels = sorted(set(n for spec in vn_specs if spec['state'] == 'present'
+                        for n in spec['bound_to_name']))
+
+    node_index = ResourceIndex([])
+    if labels:
+        node_index = ResourceIndex(find_bp_system_nodes(session, blueprint_id,
+                                                        labels))
+
+        missing = [n for n in labels if not node_index.by_label(n)]
+
+        if missing:
+            module.fail_json(msg="System Node not found by name: {}"
+                             .format(', '.join(missing)))
+
+    sz_data = blueprint_get(session, blueprint_id, 'security-zones')
+    vn_data = blueprint_get(session, blueprint_id, 'virtual-networks')
+
+    plan, errors = build_plan(sz_data, vn_data, sz_specs, vn_specs,
+                              node_index, margs['purge'])
+
+    if errors:
+        module.fail_json(msg=errors)
+
+    if module.check_mode:
+        for step in plan:
+            step['status'] = 'planned'
+
+        module.exit_json(changed=bool(plan), plan=plan)
+
+    zone_ids = dict((sz['label'], sz['id']) for sz in
+                    ResourceIndex.from_response(sz_data, 'items').items)
+
+    failed = run_plan(session, blueprint_id, plan, zone_ids,
+                      margs['concurrency'])
+    changed = any(s['status'] == 'done' for s in plan)
+
+    if failed:
+        module.fail_json(msg="Unable to apply {} step(s) of the plan"
+                         .format(len(failed)), changed=changed, plan=plan)
+
+    if not margs['deploy']:
+        module.exit_json(changed=changed, plan=plan)
+
+    result = deploy_blueprint(session, blueprint_id, margs['wait'],
+                              margs['timeout'], margs['poll_interval'])
+    changed = changed or result['changed']
+
+    if not result['success']:
+        module.fail_json(msg=result['msg'], changed=changed, plan=plan,
+                         deploy=result)
+
+    module.exit_json(changed=changed, plan=plan, deploy=result)
+
+
+def main():
+    """
+    Main function to setup inputs
+    """
+    module = AnsibleModule(
+        argument_spec=dict(
+            session=dict(required=True, type='dict'),
+            blueprint_id=dict(required=True,),
+            security_zones=dict(required=False, type='list', default=[]),
+            virtual_networks=dict(required=False, type='list', default=[]),
+            purge=dict(required=False, type='bool', default=False),
+            deploy=dict(required=False, type='bool', default=False),
+            wait=dict(required=False, type='bool', default=False),
+            timeout=dict(required=False, type='int', default=600),
+            poll_interval=dict(required=False, type='float',
+                               default=DEFAULT_POLL_INTERVAL),
+            concurrency=dict(required=False, type='int',
+                             default=DEFAULT_CONCURRENCY),
+        ),
+        supports_check_mode=True
+    )
+
+    instrument_module(module)
+
+    aos_bp_reconcile(module)
+
+
+if __name__ == "__main__":
+    main()
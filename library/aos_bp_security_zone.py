@@ -108,8 +108,8 @@ value:
 
 
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import aos_get, aos_post, aos_put, aos_delete, validate_vni_id, \
-    validate_vlan_id
+from library.aos import aos_post, aos_put, aos_delete, validate_vni_id, \
+    validate_vlan_id, find_blueprint_item, instrument_module
 
 ENDPOINT = 'security-zones'
 
@@ -235,19 +235,14 @@ def sec_zone(module):
         if errors:
             module.fail_json(msg=errors)
 
-    sz_data = aos_get(margs['session'], endpoint)
-    my_sz = {}
+    my_sz, duplicate = find_blueprint_item(margs['session'],
+                                           margs['blueprint_id'],
+                                           'security-zones',
+                                           uuid=uuid, label=name)
 
-    if not uuid:
-
-        for k, v in sz_data['items'].items():
-            if v['label'] == name:
-                my_sz = v
-    else:
-
-        for k, v in sz_data['items'].items():
-            if v['id'] == uuid:
-                my_sz = v
+    if duplicate:
+        module.fail_json(msg="Multiple security-zones found with name {}"
+                         .format(name))
 
     if margs['state'] == 'absent':
         success, changed, results = sec_zone_absent(module, margs['session'],
@@ -286,6 +281,8 @@ def main():
         supports_check_mode=True
     )
 
+    instrument_module(module)
+
     sec_zone(module)
 
 
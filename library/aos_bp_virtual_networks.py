@@ -113,6 +113,23 @@ options:
       - IP of DHCP server for relay services
     required: false
     type: bool
+  virtual_networks:
+    description:
+      - List of virtual networks to manage in a single run. Each entry is a
+        dict accepting the same keys as the module (I(name), I(id), I(state),
+        I(vn_type), I(bound_to_name), ...). All I(bound_to_name) labels are
+        resolved with one query, the blueprint virtual networks are read
+        once and all changes are sent concurrently.
+        Mutually exclusive with I(name) and I(id).
+    required: false
+    type: list
+  concurrency:
+    description:
+      - Maximum number of requests sent in parallel when I(virtual_networks)
+        is used.
+    default: 8
+    required: false
+    type: int
 '''
 
 EXAMPLES = '''
@@ -153,6 +170,25 @@ EXAMPLES = '''
     with_items:
       - 'my-virt-net'
       - 'my-virt-net2'
+
+- name: Manage several VNs in one task
+    local_action:
+      module: aos_bp_virtual_networks
+      session: "{{ aos_session }}"
+      blueprint_id: "{{bp_id}}"
+      virtual_networks:
+        - name: "vlan-101"
+          vn_id: 101
+          bound_to_name:
+            - "rack_001_leaf1"
+        - name: "vxlan-5001"
+          vn_type: "vxlan"
+          bound_to_name:
+            - "rack_001_leaf1"
+            - "rack_002_leaf1"
+        - name: "my-virt-net2"
+          state: absent
+      concurrency: 16
 '''
 
 RETURNS = '''
@@ -171,46 +207,25 @@ value:
   returned: always
   type: dict
   sample: {'...'}
+virtual_networks:
+  description: Outcome for each entry of I(virtual_networks)
+  returned: when I(virtual_networks) is used
+  type: list
+  sample: [{'name': 'vlan-101', 'id': 'db6588fe-9f36-4b04-8def-89e7dcd00c17',
+            'success': True, 'changed': True, 'value': {'...'}}]
 '''
 
 
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import aos_get, aos_post, aos_put, aos_delete, validate_vlan_id, \
-    validate_vni_id, validate_ip_format, find_bp_system_nodes
+from library.aos import aos_post, aos_put, aos_delete, find_bp_system_nodes, \
+    ResourceIndex, reconcile_resources, blueprint_get, find_blueprint_item, \
+    instrument_module, VN_DEFAULTS, vn_add_options, virt_net_changes, \
+    validate_virtual_network, get_bound_to, response_error, DEFAULT_CONCURRENCY
 
 
 ENDPOINT = '/virtual-networks'
 
 
-def vn_add_options(new_vn, vn_id, ipv4_enabled, ipv6_enabled, ipv4_subnet,
-                   ipv6_subnet, virtual_gw_ipv4, virtual_gw_ipv6, dhcp_service):
-    if vn_id:
-        new_vn["vn_id"] = str(vn_id)
-
-    if ipv4_enabled:
-        new_vn["ipv4_enabled"] = ipv4_enabled
-
-    if ipv6_enabled:
-        new_vn["ipv6_enabled"] = ipv6_enabled
-
-    if ipv4_subnet:
-        new_vn["ipv4_subnet"] = ipv4_subnet
-
-    if ipv6_subnet:
-        new_vn["ipv6_subnet"] = ipv6_subnet
-
-    if virtual_gw_ipv4:
-        new_vn["virtual_gw_ipv4"] = virtual_gw_ipv4
-
-    if virtual_gw_ipv6:
-        new_vn["virtual_gw_ipv6"] = virtual_gw_ipv6
-
-    if dhcp_service:
-        new_vn["dhcp_service"] = 'dhcpServiceEnabled'
-    else:
-        new_vn["dhcp_service"] = 'dhcpServiceDisabled'
-
-
 def virt_net_absent(module, session, endpoint, my_vn):
     """
     Remove virtual-network if exist and is not in use
@@ -226,7 +241,12 @@ def virt_net_absent(module, session, endpoint, my_vn):
                              'msg': 'security-zone does not exist'}
 
     if not module.check_mode:
-        aos_delete(session, endpoint, my_vn['id'])
+        response = aos_delete(session, endpoint, my_vn['id'])
+
+        if not response.ok:
+            msg = "Unable to delete virtual network {}: {}".format(
+                my_vn['label'], response_error(response))
+            return False, False, {"msg": msg}
 
         return True, True, my_vn
 
@@ -235,7 +255,8 @@ def virt_net_absent(module, session, endpoint, my_vn):
 
 def virt_net_present(module, session, endpoint, my_vn, vn_id, sec_zone_id,
                      ipv4_enabled, ipv6_enabled, ipv4_subnet, ipv6_subnet,
-                     virtual_gw_ipv4, virtual_gw_ipv6, bound_to, dhcp_service):
+                     virtual_gw_ipv4, virtual_gw_ipv6, bound_to, dhcp_service,
+                     spec=None):
     """
     Create new virtual-network or modify existing pool
     :param module: Ansible built in
@@ -252,13 +273,15 @@ def virt_net_present(module, session, endpoint, my_vn, vn_id, sec_zone_id,
     :param virtual_gw_ipv6: str
     :param bound_to: list
     :param dhcp_service: bool
+    :param spec: dict (entry from I(virtual_networks), defaults to module
+                 params)
     :return: success(bool), changed(bool), results(dict)
     """
-    margs = module.params
+    margs = spec or module.params
 
     if not my_vn:
 
-        if 'name' not in margs.keys():
+        if not margs['name']:
             return False, False, {"msg": "name required to create a new "
                                          "virtual-network"}
 
@@ -298,8 +321,17 @@ def virt_net_present(module, session, endpoint, my_vn, vn_id, sec_zone_id,
                        ipv4_subnet, ipv6_subnet, virtual_gw_ipv4,
                        virtual_gw_ipv6, dhcp_service)
 
+        # Nothing to change, skip the write to keep the blueprint unstaged
+        if not virt_net_changes(my_vn, new_vn):
+            return True, False, my_vn
+
         if not module.check_mode:
-            aos_put(session, endpoint_put, new_vn)
+            response = aos_put(session, endpoint_put, new_vn)
+
+            if not response.ok:
+                msg = "Unable to update virtual network {}: {}".format(
+                    my_vn['label'], response_error(response))
+                return False, False, {"msg": msg}
 
             return True, True, new_vn
 
@@ -317,7 +349,6 @@ def virtual_network(module):
 
     name = margs.get('name', None)
     uuid = margs.get('id', None)
-    vn_id = margs.get('vn_id', None)
     sec_zone_id = margs.get('sec_zone_id', None)
     ipv4_enabled = margs.get('ipv4_enabled', False)
     ipv6_enabled = margs.get('ipv6_enabled', False)
@@ -326,78 +357,35 @@ def virtual_network(module):
     virtual_gw_ipv4 = margs.get('virtual_gw_ipv4', None)
     virtual_gw_ipv6 = margs.get('virtual_gw_ipv6', None)
     dhcp_service = margs.get('dhcp_service', True)
-    bound_to_id = margs.get('bound_to_id', [])
     bound_to_name = margs.get('bound_to_name', [])
 
-    errors = []
-
-    if vn_id and margs['vn_type'] == 'vlan':
-        try:
-            vn_id = int(vn_id)
-        except ValueError:
-            module.fail_json(msg="Invalid ID: must be an integer")
-
-        err = validate_vlan_id(vn_id)
-
-        if err:
-            errors.append(err)
-
-    elif vn_id and margs['vn_type'] == 'vxlan':
-        try:
-            vn_id = int(vn_id)
-        except ValueError:
-            module.fail_json(msg="Invalid ID: must be an integer")
-
-        err = validate_vni_id(vn_id)
-
-        if err:
-            errors.append(err)
-
-    for i in [ipv4_subnet, virtual_gw_ipv4]:
-        if i:
-            err = validate_ip_format([i], 'ipv4')
-
-            if err:
-                errors.append(err)
-
-    for i in [ipv6_subnet, virtual_gw_ipv6]:
-        if i:
-            err = validate_ip_format([i], 'ipv6')
-
-            if err:
-                errors.append(err)
+    vn_id, errors = validate_virtual_network(margs)
 
     if errors:
         module.fail_json(msg=errors)
 
-    bound_to = []
-    if bound_to_id:
-        for n in bound_to_id:
-            bound_to.append({"system_id": n})
-    elif bound_to_name:
+    node_index = ResourceIndex([])
+    if bound_to_name and not margs.get('bound_to_id'):
         node_data = find_bp_system_nodes(margs['session'],
                                          margs['blueprint_id'],
                                          bound_to_name)
 
-        if node_data:
-            for n in node_data:
-                bound_to.append({"system_id": n['id']})
-        else:
+        if not node_data:
             module.fail_json(msg="System Node not found by name")
 
-    vn_data = aos_get(margs['session'], endpoint)
-    my_vn = {}
+        node_index = ResourceIndex(node_data)
 
-    if not uuid:
-        if vn_data:
-            for k, v in vn_data['virtual_networks'].items():
-                if v['label'] == name:
-                    my_vn = v
-    else:
-        if vn_data:
-            for k, v in vn_data['virtual_networks'].items():
-                if v['id'] == uuid:
-                    my_vn = v
+    bound_to = get_bound_to(margs, node_index)
+
+    my_vn, duplicate = find_blueprint_item(margs['session'],
+                                           margs['blueprint_id'],
+                                           'virtual-networks',
+                                           'virtual_networks',
+                                           uuid=uuid, label=name)
+
+    if duplicate:
+        module.fail_json(msg="Multiple virtual networks found with name {}"
+                         .format(name))
 
     if margs['state'] == 'absent':
         success, changed, results = virt_net_absent(module, margs['session'],
@@ -419,6 +407,97 @@ def virtual_network(module):
         module.fail_json(msg=results)
 
 
+def virtual_network_bulk(module):
+    """
+    Create, change or delete every virtual network listed in
+    virtual_networks with one system node query, one read of the
+    blueprint virtual networks and concurrent writes
+    """
+    margs = module.params
+    session = margs['session']
+
+    endpoint = 'blueprints/{}/virtual-networks'.format(margs['blueprint_id'])
+
+    errors = []
+    specs = []
+    for vn in margs['virtual_networks']:
+        if not isinstance(vn, dict):
+            errors.append("Invalid virtual network: must be a dict")
+            continue
+
+        spec = dict(VN_DEFAULTS, **vn)
+
+        if not spec['name'] and not spec['id']:
+            errors.append("Invalid virtual network: name or id required")
+
+        if spec['state'] not in ['present', 'absent']:
+            errors.append("Invalid state: {}".format(spec['state']))
+
+        if spec['vn_type'] not in ['vlan', 'vxlan']:
+            errors.append("Invalid vn_type: {}".format(spec['vn_type']))
+
+        if spec['bound_to_id'] and spec['bound_to_name']:
+            errors.append("Invalid virtual network {}: bound_to_id and "
+                          "bound_to_name are mutually exclusive"
+                          .format(spec['name'] or spec['id']))
+
+        spec['vn_id'], err = validate_virtual_network(spec)
+        errors.extend(err)
+        specs.append(spec)
+
+    if errors:
+        module.fail_json(msg=errors)
+
+    labels = sorted(set(n for spec in specs if spec['state'] == 'present'
+                        for n in spec['bound_to_name']))
+
+    node_index = ResourceIndex([])
+    if labels:
+        node_index = ResourceIndex(find_bp_system_nodes(session,
+                                                        margs['blueprint_id'],
+                                                        labels))
+
+        missing = [n for n in labels if not node_index.by_label(n)]
+
+        if missing:
+            module.fail_json(msg="System Node not found by name: {}"
+                             .format(', '.join(missing)))
+
+    for spec in specs:
+        spec['bound_to'] = get_bound_to(spec, node_index)
+
+    def present(module, session, my_vn, spec):
+        return virt_net_present(module, session, endpoint, my_vn,
+                                spec['vn_id'], spec['sec_zone_id'],
+                                spec['ipv4_enabled'], spec['ipv6_enabled'],
+                                spec['ipv4_subnet'], spec['ipv6_subnet'],
+                                spec['virtual_gw_ipv4'],
+                                spec['virtual_gw_ipv6'], spec['bound_to'],
+                                spec['dhcp_service'], spec=spec)
+
+    def absent(module, session, my_vn):
+        return virt_net_absent(module, session, endpoint, my_vn)
+
+    vn_data = blueprint_get(session, margs['blueprint_id'],
+                            'virtual-networks')
+
+    changed, results = reconcile_resources(module, session, endpoint, specs,
+                                           present, absent,
+                                           margs['concurrency'],
+                                           key='virtual_networks',
+                                           name_key='label',
+                                           resource_data=vn_data)
+
+    failed = [r for r in results if not r['success']]
+
+    if failed:
+        module.fail_json(msg="Unable to manage {} virtual network(s)"
+                         .format(len(failed)), changed=changed,
+                         virtual_networks=results)
+
+    module.exit_json(changed=changed, virtual_networks=results)
+
+
 def main():
     """
     Main function to setup inputs
@@ -449,17 +528,25 @@ def main():
             virtual_gw_ipv6=dict(required=False),
             svi_ips=dict(required=False, type='dict'),
             dhcp_service=dict(required=False, type='bool'),
+            virtual_networks=dict(required=False, type='list'),
+            concurrency=dict(required=False, type='int',
+                             default=DEFAULT_CONCURRENCY),
         ),
-        mutually_exclusive=[('name', 'id'),
+        mutually_exclusive=[('name', 'id', 'virtual_networks'),
                             ('bound_to_id', 'bound_to_name')],
-        required_one_of=[('name', 'id')],
+        required_one_of=[('name', 'id', 'virtual_networks')],
         required_if=[
             ["state", "present", ["bound_to_name"], ["bound_to_id"]]
         ],
         supports_check_mode=True
     )
 
-    virtual_network(module)
+    instrument_module(module)
+
+    if module.params['virtual_networks']:
+        virtual_network_bulk(module)
+    else:
+        virtual_network(module)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+"""
+Local connection broker for Apstra AOS modules
+
+Every Ansible task runs its module in a short-lived process, so pooled
+connections to the AOS server die with the task. The broker is a small
+daemon listening on a Unix socket which keeps warm keep-alive connections
+and the auth token of each AOS server, and relays the module's requests.
+
+It is started automatically by library/aos.py on first use when
+AOS_BROKER_SOCKET is set, and shuts down after AOS_BROKER_IDLE_TIMEOUT
+seconds without requests. It can also be started by hand:
+
+python -m library.aos_broker --socket /tmp/aos-broker.sock
+
+Messages are single JSON lines, each answered by a single JSON line.
+
+"""
+import os
+import json
+import time
+import fcntl
+import socket
+import argparse
+import threading
+import socketserver
+from urllib.parse import urlparse
+from library.aos import get_pooled_session, password_digest, token_entry
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Headers describing the wire encoding of the body relayed by the broker
+HOP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding',
+               'connection', 'keep-alive')
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            self.server.touch()
+
+            try:
+                reply = self.server.dispatch(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                reply = {'error': "{}: {}".format(type(e).__name__, e)}
+
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.server.touch()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Relay AOS RestApi requests from module processes over pooled sessions
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
+        self.last_activity = time.time()
+        self.timeout = 1
+
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               BrokerHandler)
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def idle(self):
+        return time.time() - self.last_activity > self.idle_timeout
+
+    def serve_until_idle(self):
+        try:
+            while not self.idle():
+                self.handle_request()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def dispatch(self, message):
+        op = message.get('op')
+
+        if op == 'ping':
+            return {'pong': True}
+
+        elif op == 'token':
+            with self.tokens_lock:
+                entry = self.tokens.get((message['server'], message['user']))
+
+            # Tokens are only handed to callers knowing the password
+            if not entry or password_digest(message.get('passwd') or '',
+                                            entry['salt']) != entry['digest']:
+                return {'token': None}
+
+            return {'token': entry['token']}
+
+        elif op == 'request':
+            return self.relay(message)
+
+        return {'error': "Unknown broker operation: {}".format(op)}
+
+    def relay(self, message):
+        server = urlparse(message['url']).netloc
+        http = get_pooled_session(server, verify=message['verify'])
+
+        response = http.request(message['method'], message['url'],
+                                data=message['data'],
+                                headers=message['headers'],
+                                verify=message['verify'])
+
+        self.record_token(server, message, response)
+
+        return {'status': response.status_code,
+                'headers': {k: v for k, v in response.headers.items()
+                            if k.lower() not in HOP_HEADERS},
+                'body': response.text}
+
+    def record_token(self, server, message, response):
+        """
+        Remember tokens issued by user/login, with a digest of the password
+        they were issued for, and forget rejected ones
+        """
+        if response.status_code == 201 and \
+                message['url'].endswith('/api/user/login'):
+            login = json.loads(message['data'])
+            entry = token_entry(response.json()['token'], login['password'])
+
+            with self.tokens_lock:
+                self.tokens[(server, login['username'])] = entry
+
+        elif response.status_code == 401:
+            rejected = message['headers'].get('AUTHTOKEN')
+
+            with self.tokens_lock:
+                for key, entry in list(self.tokens.items()):
+                    if entry['token'] == rejected:
+                        del self.tokens[key]
+
+
+def broker_running(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local AOS connection broker")
+    parser.add_argument('--socket',
+                        default=os.environ.get('AOS_BROKER_SOCKET'))
+    parser.add_argument('--idle-timeout', type=float,
+                        default=float(os.environ.get('AOS_BROKER_IDLE_TIMEOUT',
+                                                     DEFAULT_IDLE_TIMEOUT)))
+    args = parser.parse_args()
+
+    if not args.socket:
+        parser.error("--socket or AOS_BROKER_SOCKET is required")
+
+    # Tokens pass through the socket, keep it private to the current user
+    os.umask(0o077)
+
+    with open(args.socket + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if broker_running(args.socket):
+            return
+
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+        server = BrokerServer(args.socket, args.idle_timeout)
+
+    server.serve_until_idle()
+
+
+if __name__ == '__main__':
+    main()
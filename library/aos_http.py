@@ -0,0 +1,256 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+"""
+HTTP transport of the Apstra AOS modules
+
+library/aos.py imports it on the first request sent to AOS, so modules
+which exit before talking to the server do not load the HTTP stack. It
+holds the urllib3 pieces shared by both transports: the retry policy,
+connections reporting their setup timings, and the urllib3-only session
+used instead of requests when AOS_HTTP_TRANSPORT=urllib3.
+
+"""
+import json
+import time
+import random
+import socket
+import threading
+from datetime import timedelta
+import urllib3
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import HTTPError, ConnectTimeoutError, \
+    NewConnectionError, ReadTimeoutError, SSLError
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.retry import Retry
+
+# Connection setup timings of the request sent by each thread, filled by
+# the traced connections while AOS_METRICS or AOS_TRACE_FILE is set
+trace_local = threading.local()
+
+
+class AosRetry(Retry):
+    """
+    Retry policy of the AOS sessions. Idempotent requests are retried on
+    connection errors and RETRY_STATUSES; any request refused with 429 is
+    retried too, since AOS did not process it. Retry-After is honored.
+    Up to backoff_factor seconds of jitter are added to each backoff, so
+    that concurrent modules do not retry in lockstep.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+
+        return super(AosRetry, self).is_retry(method, status_code,
+                                              has_retry_after)
+
+    def get_backoff_time(self):
+        # backoff_jitter of urllib3 2.x, done here to run on urllib3 1.x
+        backoff = super(AosRetry, self).get_backoff_time()
+
+        if backoff <= 0:
+            return backoff
+
+        return backoff + random.uniform(0, self.backoff_factor)
+
+
+class _TracedConnection(object):
+    """
+    Record the DNS and TCP connect durations of a new connection in the
+    timings of the request traced by the current thread
+    """
+
+    def _new_conn(self):
+        timings = getattr(trace_local, 'timings', None)
+        if timings is None:
+            return super(_TracedConnection, self)._new_conn()
+
+        start = time.time()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port,
+                                           allowed_gai_family(),
+                                           socket.SOCK_STREAM)
+        except socket.gaierror:
+            # Let urllib3 report the resolution failure
+            return super(_TracedConnection, self)._new_conn()
+
+        timings['dns'] = time.time() - start
+        start = time.time()
+        dns_host = self._dns_host
+        error = None
+
+        try:
+            # Try each address in turn, like urllib3 create_connection
+            for address in addresses:
+                self._dns_host = address[4][0]
+                try:
+                    return super(_TracedConnection, self)._new_conn()
+                except ConnectTimeoutError as e:
+                    error = e
+            raise error
+        finally:
+            self._dns_host = dns_host
+            timings['connect'] = time.time() - start
+
+
+class _TracedHTTPConnection(_TracedConnection, HTTPConnection):
+    pass
+
+
+class _TracedHTTPSConnection(_TracedConnection, HTTPSConnection):
+
+    def connect(self):
+        timings = getattr(trace_local, 'timings', None)
+        start = time.time()
+
+        super(_TracedHTTPSConnection, self).connect()
+
+        if timings is not None:
+            setup = timings.get('dns', 0) + timings.get('connect', 0)
+            timings['tls'] = max(0.0, time.time() - start - setup)
+
+
+class _TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
+
+
+class _TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
+
+
+# Pool classes mounted by both transports
+TRACED_POOL_CLASSES = {'http': _TracedHTTPConnectionPool,
+                       'https': _TracedHTTPSConnectionPool}
+
+
+def requests_error(error):
+    """
+    Convert a urllib3 error to the requests exception the AOS helpers and
+    modules handle. requests is only imported once a request failed.
+    :param error: urllib3.exceptions.HTTPError
+    :return: requests.RequestException
+    """
+    from requests import exceptions
+
+    reason = getattr(error, 'reason', None) or error
+
+    if isinstance(reason, NewConnectionError):
+        cls = exceptions.ConnectionError
+    elif isinstance(reason, ConnectTimeoutError):
+        cls = exceptions.ConnectTimeout
+    elif isinstance(reason, ReadTimeoutError):
+        cls = exceptions.ReadTimeout
+    elif isinstance(reason, SSLError):
+        cls = exceptions.SSLError
+    else:
+        cls = exceptions.ConnectionError
+
+    return cls(error)
+
+
+class Urllib3Response(object):
+    """
+    The part of requests.Response used by the AOS helpers, over a urllib3
+    response read lazily
+    """
+
+    def __init__(self, raw, url, elapsed):
+        self.raw = raw
+        self.url = url
+        self.status_code = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        self.elapsed = timedelta(seconds=elapsed)
+        self.encoding = 'utf-8'
+        self._content = None
+        self._consumed = False
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = self.raw.read()
+            except HTTPError as e:
+                raise requests_error(e)
+            finally:
+                self.close()
+
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        try:
+            for chunk in self.raw.stream(chunk_size):
+                yield chunk
+        except HTTPError as e:
+            raise requests_error(e)
+
+        self._consumed = True
+
+    def raise_for_status(self):
+        if self.ok:
+            return
+
+        from requests import HTTPError as RequestsHTTPError
+
+        kind = 'Client' if self.status_code < 500 else 'Server'
+        raise RequestsHTTPError("{} {} Error: {} for url: {}"
+                                .format(self.status_code, kind, self.reason,
+                                        self.url), response=self)
+
+    def close(self):
+        # An unread body would be left on the connection: drop it instead
+        if self._content is None and not self._consumed:
+            self.raw.close()
+
+        self.raw.release_conn()
+
+
+class Urllib3Session(object):
+    """
+    Keep-alive session sending requests with urllib3 alone, taking the
+    arguments of requests.Session.request used by library/aos.py
+    """
+
+    def __init__(self, retries, size, verify=True):
+        self.verify = verify
+        self.manager = urllib3.PoolManager(
+            num_pools=size,
+            maxsize=size,
+            retries=retries,
+            cert_reqs='CERT_REQUIRED' if verify else 'CERT_NONE')
+        self.manager.pool_classes_by_scheme = TRACED_POOL_CLASSES
+
+    def request(self, method, url, data=None, headers=None, verify=None,
+                stream=False, timeout=None):
+        start = time.time()
+
+        try:
+            raw = self.manager.request(method, url,
+                                       body=data,
+                                       headers=headers,
+                                       preload_content=False,
+                                       timeout=timeout)
+        except HTTPError as e:
+            raise requests_error(e)
+
+        response = Urllib3Response(raw, url, time.time() - start)
+
+        if not stream:
+            response.content
+
+        return response
+
+    def close(self):
+        self.manager.clear()
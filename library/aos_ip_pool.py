@@ -55,6 +55,29 @@ options:
     default: 'ipv4'
     required: false
     type: str
+  check_conflicts:
+    description:
+      - Before any change, make sure the requested subnets do not overlap a
+        subnet of another IP or IPv6 Pool (or of another entry of I(pools)).
+        The pools of the AOS server are read once and cached on disk for
+        AOS_CACHE_TTL seconds (default 30) in AOS_CACHE_DIR.
+    default: false
+    required: false
+    type: bool
+  pools:
+    description:
+      - List of IP Pools to manage in a single run. Each entry is a dict with
+        I(name) or I(id), I(subnets) and I(state). The pool collection is read
+        once and all changes are sent concurrently.
+        Mutually exclusive with I(name) and I(id).
+    required: false
+    type: list
+  concurrency:
+    description:
+      - Maximum number of requests sent in parallel when I(pools) is used.
+    default: 8
+    required: false
+    type: int
 '''
 
 EXAMPLES = '''
@@ -101,6 +124,19 @@ EXAMPLES = '''
     session: "{{ aos_session }}"
     name: "my-ip-pool"
     state: absent
+
+- name: "Manage several IP Pools at once"
+  aos_ip_pool:
+    session: "{{ aos_session }}"
+    pools:
+      - name: "rack-001-pool"
+        subnets:
+          - 10.1.0.0/24
+      - name: "rack-002-pool"
+        subnets:
+          - 10.2.0.0/24
+      - name: "old-pool"
+        state: absent
 '''
 
 RETURNS = '''
@@ -121,15 +157,32 @@ value:
   returned: always
   type: dict
   sample: {'...'}
+
+pools:
+  description: Outcome for each entry of I(pools)
+  returned: when I(pools) is used
+  type: list
+  sample: [{'name': 'rack-001-pool', 'id': 'rack-001-pool', 'success': True,
+            'changed': True, 'value': {'...'}}]
 '''
 
 import ipaddress
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import aos_post, aos_put, aos_delete, find_resource_item
+from library.aos import aos_get, aos_post, aos_put, aos_delete, response_error, \
+    find_resource_item, reconcile_resources, merge_subnets, \
+    find_subnet_overlaps, check_pool_conflicts, get_pool_index, \
+    instrument_module, DEFAULT_CONCURRENCY
 
 V4_ENDPOINT = 'resources/ip-pools'
 V6_ENDPOINT = 'resources/ipv6-pools'
 
+ENDPOINTS = {
+    "ipv4": V4_ENDPOINT,
+    "ipv6": V6_ENDPOINT
+}
+
+POOL_DEFAULTS = {'name': None, 'id': None, 'state': 'present', 'subnets': []}
+
 
 def validate_subnets(subnets, addr_type):
     """
@@ -149,6 +202,9 @@ def validate_subnets(subnets, addr_type):
         except ValueError:
             errors.append("Invalid subnet: {}".format(subnet))
 
+    if not errors:
+        errors = find_subnet_overlaps(subnets)
+
     return errors
 
 
@@ -180,27 +236,33 @@ def ip_pool_absent(module, session, endpoint, my_pool):
                               "currently in use".format(my_pool['display_name'])}
 
     if not module.check_mode:
-        aos_delete(session, endpoint, my_pool['id'])
+        response = aos_delete(session, endpoint, my_pool['id'])
+
+        if not response.ok:
+            return False, False, {"msg": "Unable to delete IP Pool {}: {}"
+                                  .format(my_pool['display_name'],
+                                          response_error(response))}
 
         return True, True, my_pool
 
     return True, False, my_pool
 
 
-def ip_pool_present(module, session, endpoint, my_pool):
+def ip_pool_present(module, session, endpoint, my_pool, spec=None):
     """
     Create new IP pool or modify existing pool
     :param module: Ansible built in
     :param session: dict
     :param endpoint: str
     :param my_pool: dict
+    :param spec: dict (pool entry from I(pools), defaults to module params)
     :return: success(bool), changed(bool), results(dict)
     """
-    margs = module.params
+    margs = spec or module.params
 
     if not my_pool:
 
-        if 'name' not in margs.keys():
+        if not margs['name']:
             return False, False, {"msg": "name required to create a new resource"}
 
         new_pool = {"subnets": get_subnets(margs['subnets']),
@@ -215,25 +277,29 @@ def ip_pool_present(module, session, endpoint, my_pool):
         return True, False, new_pool
 
     else:
-        if my_pool['subnets']:
+        merged, changed = merge_subnets(my_pool['subnets'], margs['subnets'])
 
-            endpoint_put = "{}/{}".format(endpoint, my_pool['id'])
+        # Everything requested is already in the pool, nothing to write
+        if not changed:
+            return True, False, my_pool
 
-            new_pool = {"subnets": get_subnets(margs['subnets']),
-                        "display_name": my_pool['display_name'],
-                        "id": margs['name']}
+        endpoint_put = "{}/{}".format(endpoint, my_pool['id'])
 
-            for ip_subnet in my_pool['subnets']:
-                new_pool['subnets'].append({'network': ip_subnet['network']})
+        new_pool = {"subnets": merged,
+                    "display_name": my_pool['display_name'],
+                    "id": my_pool['id']}
 
-            if not module.check_mode:
-                aos_put(session, endpoint_put, new_pool)
+        if not module.check_mode:
+            response = aos_put(session, endpoint_put, new_pool)
 
-                return True, True, new_pool
+            if not response.ok:
+                return False, False, {"msg": "Unable to update IP Pool {}: {}"
+                                      .format(my_pool['display_name'],
+                                              response_error(response))}
 
-            return True, False, new_pool
+            return True, True, new_pool
 
-        return True, False, my_pool
+        return True, False, new_pool
 
 
 def ip_pool(module):
@@ -257,15 +323,18 @@ def ip_pool(module):
         if errors:
             module.fail_json(msg=errors)
 
-    choice_map = {
-        "ipv4": V4_ENDPOINT,
-        "ipv6": V6_ENDPOINT
-    }
+    endpoint = ENDPOINTS.get(margs['ip_version'])
 
-    endpoint = choice_map.get(margs['ip_version'])
     my_pool = find_resource_item(margs['session'], endpoint,
                                  name=name, uuid=uuid)
 
+    if margs['check_conflicts'] and margs['state'] == 'present':
+        errors = get_pool_index(margs['session']).conflicts(
+            margs['ip_version'], margs['subnets'], my_pool)
+
+        if errors:
+            module.fail_json(msg=errors)
+
     if margs['state'] == 'absent':
         success, changed, results = ip_pool_absent(module,
                                                    margs['session'],
@@ -285,6 +354,65 @@ def ip_pool(module):
         module.fail_json(msg=results)
 
 
+def ip_pool_bulk(module):
+    """
+    Create, change or delete every AOS IP resource pool listed in pools
+    """
+    margs = module.params
+
+    errors = []
+    specs = []
+    for pool in margs['pools']:
+        if not isinstance(pool, dict):
+            errors.append("Invalid pool: must be a dict")
+            continue
+
+        spec = dict(POOL_DEFAULTS, **pool)
+
+        if not spec['name'] and not spec['id']:
+            errors.append("Invalid pool: name or id required")
+
+        if spec['state'] not in ['present', 'absent']:
+            errors.append("Invalid state: {}".format(spec['state']))
+
+        errors.extend(validate_subnets(spec['subnets'],
+                                       margs['ip_version']))
+        specs.append(spec)
+
+    if errors:
+        module.fail_json(msg=errors)
+
+    endpoint = ENDPOINTS.get(margs['ip_version'])
+    resource_data = None
+
+    if margs['check_conflicts']:
+        resource_data = aos_get(margs['session'], endpoint)
+        errors = check_pool_conflicts(margs['session'], margs['ip_version'],
+                                      specs, resource_data)
+
+        if errors:
+            module.fail_json(msg=errors)
+
+    def present(module, session, my_pool, spec):
+        return ip_pool_present(module, session, endpoint, my_pool, spec)
+
+    def absent(module, session, my_pool):
+        return ip_pool_absent(module, session, endpoint, my_pool)
+
+    changed, results = reconcile_resources(module, margs['session'], endpoint,
+                                           specs, present, absent,
+                                           margs['concurrency'],
+                                           resource_data=resource_data)
+
+    failed = [r for r in results if not r['success']]
+
+    if failed:
+        module.fail_json(msg="Unable to manage {} IP Pool(s)"
+                         .format(len(failed)), changed=changed, pools=results)
+
+    module.exit_json(changed=changed, pools=results)
+
+
 def main():
     """
     Main function to setup inputs
@@ -301,13 +429,22 @@ def main():
             ip_version=dict(required=False,
                             choices=['ipv4', 'ipv6'],
                             default='ipv4'),
+            check_conflicts=dict(required=False, type="bool", default=False),
+            pools=dict(required=False, type="list"),
+            concurrency=dict(required=False, type="int",
+                             default=DEFAULT_CONCURRENCY),
         ),
-        mutually_exclusive=[('name', 'id')],
-        required_one_of=[('name', 'id')],
+        mutually_exclusive=[('name', 'id', 'pools')],
+        required_one_of=[('name', 'id', 'pools')],
         supports_check_mode=True
     )
 
-    ip_pool(module)
+    instrument_module(module)
+
+    if module.params['pools']:
+        ip_pool_bulk(module)
+    else:
+        ip_pool(module)
 
 
 if __name__ == "__main__":
@@ -18,7 +18,13 @@ description:
     this module will return the session-token that is required by all
     subsequent AOS module usage. On success the module will automatically
     populate ansible facts with the variable I(aos_session)
-    This module is not idempotent and do not support check mode.
+  - Tokens are cached on disk per server and user (see AOS_CACHE_DIR) and
+    reused until AOS_TOKEN_REFRESH seconds (default 60) before they expire,
+    in which case the module reports no change. This module does not
+    support check mode.
+  - When a token is rejected, the other AOS modules log in again once with
+    the cached token of another task or with the AOS_PASSWD environment
+    variable.
 options:
   server:
     description:
@@ -68,35 +74,42 @@ aos_session:
   sample: "eyJhbUdm45OiJIUzI1Ni3asvdsInR5cCI6IkpXVCJ9.eyJ1c2V..."
 '''
 
-import json
+import requests
 from ansible.module_utils.basic import AnsibleModule
-from library.aos import requests_retry, set_requests_verify
+from library.aos import aos_token, broker_socket, broker_token, \
+    token_expiring, instrument_module
 
 
 def aos_login(module):
-
+    """
+    Return the AOS session of the user, reusing a cached token when it is
+    still valid
+    :param module: AnsibleModule
+    :return: tuple (session dict, True if a login was made)
+    """
     mod_args = module.params
 
-    aos_url = "https://{}/api/user/login".format(mod_args['server'])
+    if broker_socket():
+        token = broker_token(mod_args['server'], mod_args['user'],
+                             mod_args['passwd'] or '')
 
-    headers = {'Accept': "application/json",
-               'Content-Type': "application/json",
-               'cache-control': "no-cache"}
-    payload = {"username": mod_args['user'],
-               "password": mod_args['passwd']}
+        # The broker only forgets a token once AOS rejects it: log in again
+        # before it expires
+        if token and not token_expiring(token):
+            return {"server": mod_args['server'],
+                    "user": mod_args['user'],
+                    "token": token}, False
 
-    response = requests_retry().post(aos_url,
-                                     data=json.dumps(payload),
-                                     headers=headers,
-                                     verify=set_requests_verify())
+    try:
+        # None would skip the password check of the cached token
+        token, changed = aos_token(mod_args['server'], mod_args['user'],
+                                   mod_args['passwd'] or '')
+    except requests.RequestException as e:
+        module.fail_json(msg=str(e))
 
-    if response.status_code == 201:
-        return {"server": mod_args['server'],
-                "token": response.json()['token']}
-    else:
-        module.fail_json(
-            msg="Issue logging into AOS-server {}: {}"
-                .format(aos_url, response.json()))
+    return {"server": mod_args['server'],
+            "user": mod_args['user'],
+            "token": token}, changed
 
 
 def main():
@@ -107,8 +120,10 @@ def main():
             user=dict(default='admin'),
             passwd=dict(default='admin', no_log=True)))
 
-    aos_session = aos_login(module)
-    module.exit_json(changed=True,
+    instrument_module(module)
+
+    aos_session, changed = aos_login(module)
+    module.exit_json(changed=changed,
                      ansible_facts=dict(aos_session=aos_session),
                      aos_session=dict(aos_session=aos_session))
 
@@ -0,0 +1,234 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+"""
+Load benchmark of the AOS modules and helpers against the mock AOS server
+
+Each scenario drives a module or helper at scale and reports the number of
+requests, bytes sent and received, request latency percentiles and wall
+time, as recorded by AOS_METRICS.
+
+python -m tests.benchmark --nodes 10000 --vns 5000 --pools 1000
+python -m tests.benchmark --latency 0.02 --scenario vn_bulk --json
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import library.aos as aos
+import library.aos_asn_pool as aos_asn_pool
+import library.aos_bp_deploy as aos_bp_deploy
+import library.aos_bp_reconcile as aos_bp_reconcile
+import library.aos_bp_virtual_networks as aos_vn
+from tests.mock_aos_server import start_mock_server
+
+
+class BenchModule(object):
+    """
+    Minimal AnsibleModule stand-in recording the module result
+    """
+
+    def __init__(self, **params):
+        self.params = params
+        self.check_mode = False
+        self.result = None
+
+    def exit_json(self, **result):
+        self.result = result
+        raise SystemExit(0)
+
+    def fail_json(self, **result):
+        self.result = dict(result, failed=True)
+        raise SystemExit(1)
+
+
+def run_module(func, **params):
+    module = BenchModule(**params)
+
+    try:
+        func(module)
+    except SystemExit:
+        pass
+
+    if module.result and module.result.get('failed'):
+        raise RuntimeError(module.result['msg'])
+
+    return module.result
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def scenario_login(session, args):
+    cache = os.environ['AOS_CACHE_DIR']
+
+    # An empty cache for each iteration, so that every call logs in
+    try:
+        for _ in range(args.repeat):
+            os.environ['AOS_CACHE_DIR'] = tempfile.mkdtemp(prefix='aos-bench-')
+            try:
+                aos.aos_token(session['server'], 'admin', 'admin')
+            finally:
+                shutil.rmtree(os.environ['AOS_CACHE_DIR'], ignore_errors=True)
+    finally:
+        os.environ['AOS_CACHE_DIR'] = cache
+
+
+def scenario_pool_lookup(session, args):
+    for i in range(args.repeat):
+        aos.find_resource_item(session, 'resources/asn-pools',
+                               name="asn-{}".format(i % max(1, args.pools)))
+
+
+def scenario_pool_bulk(session, args):
+    pools = [{'name': "bench-{}".format(i),
+              'ranges': [[4000000 + 10 * i, 4000000 + 10 * i + 5]]}
+             for i in range(args.repeat)]
+
+    run_module(aos_asn_pool.asn_pool_bulk, session=session, pools=pools,
+               concurrency=args.concurrency, check_conflicts=True)
+
+
+def scenario_system_nodes(session, args):
+    labels = ["node_{}".format(i) for i in range(0, args.nodes, 200)]
+
+    for _ in range(args.repeat):
+        aos.find_bp_system_nodes(session, 'bp-0', labels)
+
+
+def scenario_vn_bulk(session, args):
+    vns = [{'name': "bench-vn-{}".format(i), 'vn_type': 'vxlan',
+            'bound_to_name': ["node_{}".format(i % max(1, args.nodes))]}
+           for i in range(args.repeat)]
+
+    run_module(aos_vn.virtual_network_bulk, session=session,
+               blueprint_id='bp-0', virtual_networks=vns,
+               concurrency=args.concurrency)
+
+
+def scenario_deploy_bulk(session, args):
+    run_module(aos_bp_deploy.aos_bp_deploy, session=session, name=None,
+               id=None, handle=None, wait=True, timeout=600,
+               poll_interval=0.01, concurrency=args.concurrency,
+               blueprints=["blueprint-{}".format(b)
+                           for b in range(args.blueprints)])
+
+
+def scenario_reconcile(session, args):
+    vns = [{'name': "tenant-vn-{}".format(i), 'vn_type': 'vxlan',
+            'security_zone': 'bench-tenant',
+            'bound_to_name': ["node_{}".format(i % max(1, args.nodes))]}
+           for i in range(args.repeat)]
+
+    run_module(aos_bp_reconcile.aos_bp_reconcile, session=session,
+               blueprint_id='bp-0', security_zones=[{'name': 'bench-tenant'}],
+               virtual_networks=vns, purge=False, deploy=True, wait=True,
+               timeout=600, poll_interval=0.01, concurrency=args.concurrency)
+
+
+SCENARIOS = [('login', scenario_login),
+             ('pool_lookup', scenario_pool_lookup),
+             ('pool_bulk', scenario_pool_bulk),
+             ('system_nodes', scenario_system_nodes),
+             ('vn_bulk', scenario_vn_bulk),
+             ('deploy_bulk', scenario_deploy_bulk),
+             ('reconcile', scenario_reconcile)]
+
+
+def run_scenario(server, name, func, args):
+    """
+    :return: dict (scenario report)
+    """
+    aos.close_pooled_sessions()
+    aos._blueprint_versions.clear()
+    del aos._metrics[:]
+
+    token, _ = aos.aos_token(server.address, 'admin', 'admin')
+    session = {'server': server.address, 'user': 'admin', 'token': token}
+    del aos._metrics[:]
+
+    start = time.time()
+    func(session, args)
+    wall = time.time() - start
+
+    metrics = aos.aos_metrics()
+    latencies = [c['elapsed'] for c in metrics['calls']]
+
+    return {'scenario': name,
+            'requests': metrics['requests'],
+            'request_bytes': metrics['request_bytes'],
+            'response_bytes': metrics['response_bytes'],
+            'wire_bytes': metrics['wire_bytes'],
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'wall': wall}
+
+
+def print_table(reports):
+    columns = ['scenario', 'requests', 'request_bytes', 'response_bytes',
+               'wire_bytes', 'p50', 'p95', 'p99', 'wall']
+    print(" ".join("{:>14}".format(c) for c in columns))
+
+    for report in reports:
+        print(" ".join("{:>14.4f}".format(report[c])
+                       if isinstance(report[c], float)
+                       else "{:>14}".format(report[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AOS modules benchmark")
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--vns', type=int, default=5000)
+    parser.add_argument('--pools', type=int, default=1000)
+    parser.add_argument('--blueprints', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--padding', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=100,
+                        help="Lookups, pools or VNs per scenario")
+    parser.add_argument('--concurrency', type=int,
+                        default=aos.DEFAULT_CONCURRENCY)
+    parser.add_argument('--scenario', action='append',
+                        choices=[name for name, _ in SCENARIOS])
+    parser.add_argument('--json', action='store_true',
+                        help="Print the reports as JSON")
+    args = parser.parse_args(argv)
+
+    server = start_mock_server(nodes=args.nodes, vns=args.vns,
+                               pools=args.pools, blueprints=args.blueprints,
+                               latency=args.latency,
+                               error_rate=args.error_rate,
+                               padding=args.padding)
+    cache = tempfile.mkdtemp(prefix='aos-bench-')
+
+    os.environ.update({'AOS_API_SCHEME': 'http',
+                       'AOS_CACHE_DIR': cache,
+                       'AOS_METRICS': 'true'})
+
+    try:
+        reports = [run_scenario(server, name, func, args)
+                   for name, func in SCENARIOS
+                   if not args.scenario or name in args.scenario]
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache, ignore_errors=True)
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(reports)
+
+
+if __name__ == '__main__':
+    main()
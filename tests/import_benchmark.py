@@ -0,0 +1,100 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+"""
+Startup cost of the AOS modules
+
+Each module is imported in fresh interpreters with -X importtime and the
+median cumulative import time is reported, with the heavy dependencies
+its import loaded.
+
+python -m tests.import_benchmark
+python -m tests.import_benchmark --repeat 20 --module aos_bp_deploy --json
+
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import statistics
+import subprocess
+
+# Dependencies worth keeping off the import path of every module
+HEAVY_MODULES = ('requests', 'urllib3', 'asyncio', 'concurrent.futures',
+                 'ipaddress', 'ansible.module_utils.basic')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHECK_LOADED = "import sys; print(','.join(m for m in {!r} if m in sys.modules))"
+
+
+def library_modules():
+    return sorted(os.path.basename(path)[:-3] for path in
+                  glob.glob(os.path.join(REPO_ROOT, 'library', 'aos*.py')))
+
+
+def import_time(module):
+    """
+    Import library.<module> in a new interpreter
+    :return: tuple (microseconds, list of loaded HEAVY_MODULES)
+    """
+    name = 'library.' + module
+    code = "import {}; {}".format(name, CHECK_LOADED.format(HEAVY_MODULES))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=REPO_ROOT, capture_output=True, text=True,
+                            check=True)
+
+    # "import time: self [us] | cumulative | imported package", the
+    # module itself is the last line naming it
+    cumulative = [int(line.split('|')[1])
+                  for line in result.stderr.splitlines()
+                  if line.split('|')[-1].strip() == name]
+    loaded = result.stdout.strip()
+
+    return cumulative[-1], loaded.split(',') if loaded else []
+
+
+def measure(module, repeat):
+    times = []
+    loaded = []
+
+    for _ in range(repeat):
+        elapsed, loaded = import_time(module)
+        times.append(elapsed)
+
+    return {'module': module,
+            'median_ms': round(statistics.median(times) / 1000.0, 2),
+            'min_ms': round(min(times) / 1000.0, 2),
+            'loaded': loaded}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AOS modules import time")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--module', action='append',
+                        choices=library_modules())
+    parser.add_argument('--json', action='store_true',
+                        help="Print the reports as JSON")
+    args = parser.parse_args(argv)
+
+    # Compile once so that the runs measure imports, not bytecode compiling
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', 'library'],
+                   cwd=REPO_ROOT, check=True)
+
+    reports = [measure(module, args.repeat)
+               for module in args.module or library_modules()]
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+        return
+
+    print("{:>26} {:>10} {:>10}  {}".format('module', 'median_ms',
+                                            'min_ms', 'loaded'))
+    for report in reports:
+        print("{module:>26} {median_ms:>10} {min_ms:>10}  {}".format(
+            ' '.join(report['loaded']), **report))
+
+
+if __name__ == '__main__':
+    main()
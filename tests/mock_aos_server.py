@@ -0,0 +1,399 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+"""
+Stand-in AOS RestApi server for tests and benchmarks
+
+It serves, from memory, the endpoints used by the modules: user/login,
+resources pools, blueprints with their virtual-networks, security-zones,
+ql and deploy. Latency, payload padding and error injection are tunable
+so module performance can be measured without a real AOS server.
+
+python -m tests.mock_aos_server --port 8080 --nodes 10000 --vns 5000
+
+Point the modules at it with AOS_API_SCHEME=http and server 127.0.0.1:8080.
+
+"""
+import re
+import json
+import gzip
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+POOL_KINDS = ['asn-pools', 'vni-pools', 'ip-pools', 'ipv6-pools']
+
+# Bodies smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
+QL_ALIAS = re.compile(r'(?:(\w+): )?system_nodes(?:\(([^)]*)\))? \{')
+QL_FILTER = re.compile(r'(\w+): ("(?:[^"\\]|\\.)*"|\[[^\]]*\])')
+
+
+def make_token(ttl=3600):
+    """
+    Build an unsigned JWT carrying an expiry, as AOS tokens do
+    """
+    def encode(data):
+        raw = json.dumps(data).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    return "{}.{}.mock".format(encode({'alg': 'none'}),
+                               encode({'exp': int(time.time() + ttl)}))
+
+
+class MockAos(object):
+    """
+    In-memory state of the mock AOS server
+    """
+
+    def __init__(self, nodes=100, vns=0, pools=0, blueprints=1, latency=0.0,
+                 error_rate=0.0, error_status=503, padding=0, deploy_polls=0,
+                 seed=0):
+        """
+        :param nodes: int (system nodes per blueprint)
+        :param vns: int (virtual networks per blueprint)
+        :param pools: int (pools of each kind)
+        :param blueprints: int
+        :param latency: float (seconds added to every request)
+        :param error_rate: float (share of requests answered error_status)
+        :param error_status: int
+        :param padding: int (bytes of filler added to every item)
+        :param deploy_polls: int (deploy status reads before success)
+        :param seed: int
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.padding = 'x' * padding
+        self.deploy_polls = deploy_polls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.tokens = set()
+
+        self.pools = {kind: {} for kind in POOL_KINDS}
+        for i in range(pools):
+            self.add_pool('asn-pools', {'ranges': [
+                {'first': 1000 * i + 1, 'last': 1000 * i + 100}]})
+            self.add_pool('vni-pools', {'ranges': [
+                {'first': 5000 + 1000 * i, 'last': 5000 + 1000 * i + 99}]})
+            self.add_pool('ip-pools', {'subnets': [
+                {'network': "10.{}.{}.0/24".format(i // 256, i % 256)}]})
+            self.add_pool('ipv6-pools', {'subnets': [
+                {'network': "fd00:{:x}::/64".format(i)}]})
+
+        self.blueprints = {}
+        for b in range(blueprints):
+            bp_id = "bp-{}".format(b)
+            self.blueprints[bp_id] = {
+                'id': bp_id,
+                'label': "blueprint-{}".format(b),
+                'version': 1,
+                'deployed': {'version': 1, 'state': 'success'},
+                'polls': 0,
+                'nodes': [self.item({'id': "node-{}".format(n),
+                                     'label': "node_{}".format(n),
+                                     'role': 'spine' if n % 10 == 0
+                                     else 'leaf'})
+                          for n in range(nodes)],
+                'virtual-networks': {},
+                'security-zones': {'sz-default': self.item({
+                    'id': 'sz-default', 'label': 'default',
+                    'vrf_name': 'default', 'sz_type': 'l3_fabric'})},
+                'next_id': 0}
+
+            for v in range(vns):
+                self.add_vn(bp_id, {'label': "vn-{}".format(v),
+                                    'vn_type': 'vxlan',
+                                    'vn_id': str(10000 + v),
+                                    'bound_to': []})
+
+    def item(self, item):
+        if self.padding:
+            item['padding'] = self.padding
+        return item
+
+    def add_pool(self, kind, item):
+        pool_id = item.get('id') or "{}-{}".format(kind[:-6],
+                                                   len(self.pools[kind]))
+        pool = dict(item, id=pool_id,
+                    display_name=item.get('display_name', pool_id),
+                    status='not_in_use')
+        self.pools[kind][pool_id] = self.item(pool)
+        return pool
+
+    def add_vn(self, bp_id, item):
+        bp = self.blueprints[bp_id]
+        vn_id = item.get('id') or "vn-id-{}".format(
+            len(bp['virtual-networks']))
+        bp['virtual-networks'][vn_id] = self.item(dict(item, id=vn_id))
+        return bp['virtual-networks'][vn_id]
+
+    def query_nodes(self, bp, query):
+        """
+        Answer the system_nodes selections of a GraphQL query, with their
+        label and role filters
+        """
+        data = {}
+
+        for alias, args in QL_ALIAS.findall(query):
+            filters = {k: json.loads(v) for k, v in QL_FILTER.findall(args)}
+            nodes = []
+
+            for node in bp['nodes']:
+                for key, value in filters.items():
+                    values = value if isinstance(value, list) else [value]
+                    if node.get(key) not in values:
+                        break
+                else:
+                    nodes.append(node)
+
+            data[alias or 'system_nodes'] = nodes
+
+        return {'data': data}
+
+    def handle(self, method, path, body, token):
+        """
+        Route a request
+        :return: tuple (status, body)
+        """
+        parts = path.strip('/').split('/')[1:]
+
+        if parts == ['user', 'login']:
+            if method != 'POST' or not body.get('username'):
+                return 400, {'errors': 'username required'}
+            token = make_token()
+            self.tokens.add(token)
+            return 201, {'token': token}
+
+        if token not in self.tokens:
+            return 401, {'errors': 'invalid token'}
+
+        if parts[0] == 'resources' and len(parts) > 1 and \
+                parts[1] in POOL_KINDS:
+            return self.collection(method, self.pools[parts[1]], parts[2:],
+                                   body, 'items', self.add_pool, parts[1])
+
+        if parts[0] == 'blueprints':
+            return self.blueprint(method, parts[1:], body)
+
+        return 404, {'errors': 'unknown endpoint'}
+
+    def collection(self, method, items, rest, body, key, add, owner):
+        if not rest:
+            if method == 'GET':
+                if key == 'items' and owner in POOL_KINDS:
+                    return 200, {key: list(items.values())}
+                return 200, {key: items}
+            if method == 'POST':
+                return 201, {'id': add(owner, body)['id']}
+            return 405, {'errors': 'method not allowed'}
+
+        item_id = rest[0]
+        if item_id not in items:
+            return 404, {'errors': "{} not found".format(item_id)}
+
+        if method == 'GET':
+            return 200, items[item_id]
+        if method == 'PUT':
+            items[item_id] = self.item(dict(body, id=item_id))
+            return 204, None
+        if method == 'DELETE':
+            del items[item_id]
+            return 202, None
+
+        return 405, {'errors': 'method not allowed'}
+
+    def blueprint(self, method, rest, body):
+        if not rest:
+            return 200, {'items': [{'id': bp['id'], 'label': bp['label'],
+                                    'version': bp['version']}
+                                   for bp in self.blueprints.values()]}
+
+        bp = self.blueprints.get(rest[0])
+        if not bp:
+            return 404, {'errors': "{} not found".format(rest[0])}
+
+        if len(rest) == 1:
+            return 200, {'id': bp['id'], 'label': bp['label'],
+                         'version': bp['version']}
+
+        if rest[1] == 'ql' and method == 'POST':
+            return 200, self.query_nodes(bp, body.get('query', ''))
+
+        if rest[1] == 'deploy':
+            return self.deploy(method, bp, body)
+
+        if rest[1] in ['virtual-networks', 'security-zones']:
+            key = 'virtual_networks' if rest[1] == 'virtual-networks' \
+                else 'items'
+
+            def add(bp_id, item):
+                bp['next_id'] += 1
+                item_id = "{}-{}".format(rest[1][:2], bp['next_id'])
+                bp[rest[1]][item_id] = self.item(dict(item, id=item_id))
+                return bp[rest[1]][item_id]
+
+            # AOS refuses to delete a security-zone still in use
+            if rest[1] == 'security-zones' and method == 'DELETE' and \
+                    rest[2:] and any(vn.get('security_zone_id') == rest[2]
+                                     for vn in bp['virtual-networks']
+                                     .values()):
+                return 422, {'errors': 'security-zone in use'}
+
+            status, data = self.collection(method, bp[rest[1]], rest[2:],
+                                           body, key, add, bp['id'])
+
+            if method != 'GET' and status < 300:
+                bp['version'] += 1
+
+            return status, data
+
+        return 404, {'errors': 'unknown endpoint'}
+
+    def deploy(self, method, bp, body):
+        if method == 'PUT':
+            if body.get('version') != bp['version']:
+                return 422, {'errors': 'version is not the staged version'}
+            bp['deployed'] = {'version': body['version'], 'state': 'init'}
+            bp['polls'] = 0
+            return 202, None
+
+        if bp['deployed']['state'] == 'init':
+            bp['polls'] += 1
+            if bp['polls'] > self.deploy_polls:
+                bp['deployed']['state'] = 'success'
+
+        return 200, dict(bp['deployed'])
+
+
+class MockAosHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes: without TCP_NODELAY each
+    # response would wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_method(self, method):
+        aos = self.server.aos
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+
+        if aos.latency:
+            time.sleep(aos.latency)
+
+        with aos.lock:
+            aos.requests += 1
+
+            if aos.error_rate and aos.random.random() < aos.error_rate:
+                status, data = aos.error_status, {'errors': 'injected'}
+                extra = {'Retry-After': '0'}
+            else:
+                body = json.loads(raw.decode('utf-8')) if raw else {}
+                status, data = aos.handle(method, self.path, body,
+                                          self.headers.get('AUTHTOKEN'))
+                extra = {}
+
+            payload = json.dumps(data).encode('utf-8') \
+                if data is not None else b''
+
+        etag = '"{}"'.format(hashlib.sha1(payload).hexdigest())
+
+        if method == 'GET' and status == 200:
+            extra['ETag'] = etag
+
+            if self.headers.get('If-None-Match') == etag:
+                status, payload = 304, b''
+
+        if len(payload) >= GZIP_MIN_SIZE and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, compresslevel=1)
+            extra['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for header, value in extra.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+        with aos.lock:
+            aos.bytes_sent += len(payload)
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+
+class MockAosServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, aos, host='127.0.0.1', port=0):
+        self.aos = aos
+        ThreadingHTTPServer.__init__(self, (host, port), MockAosHandler)
+
+    @property
+    def address(self):
+        """
+        Server address to use as aos_login server, ex. 127.0.0.1:8080
+        """
+        return "{}:{}".format(*self.server_address[:2])
+
+
+def start_mock_server(host='127.0.0.1', port=0, **kwargs):
+    """
+    Start a mock AOS server in a background thread
+    :param kwargs: MockAos settings
+    :return: MockAosServer (call shutdown() and server_close() to stop it)
+    """
+    server = MockAosServer(MockAos(**kwargs), host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock AOS RestApi server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--vns', type=int, default=0)
+    parser.add_argument('--pools', type=int, default=0)
+    parser.add_argument('--blueprints', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--padding', type=int, default=0)
+    parser.add_argument('--deploy-polls', type=int, default=0)
+    args = parser.parse_args()
+
+    aos = MockAos(nodes=args.nodes, vns=args.vns, pools=args.pools,
+                  blueprints=args.blueprints, latency=args.latency,
+                  error_rate=args.error_rate, error_status=args.error_status,
+                  padding=args.padding, deploy_polls=args.deploy_polls)
+    server = MockAosServer(aos, args.host, args.port)
+
+    print("Mock AOS server listening on {}".format(server.address))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
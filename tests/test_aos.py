@@ -1,11 +1,20 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
 import os
+import re
+import sys
 import json
+import subprocess
 import pytest
-from mock import patch
+from mock import patch, MagicMock
+import library.aos as aos
+from library.aos_http import AosRetry
 from library.aos import validate_vlan_id, validate_ip_format, validate_vni_ranges, \
-    validate_asn_ranges, validate_vni_id, find_bp_system_nodes
+    validate_asn_ranges, validate_vni_id, find_bp_system_nodes, \
+    get_pooled_session, close_pooled_sessions, run_concurrently, \
+    reconcile_resources, ResourceIndex, find_resource_by_name, find_resource_by_id, \
+    merge_ranges, merge_subnets, RangeSet, find_range_overlaps, SubnetSet, \
+    find_subnet_overlaps
 
 
 def read_fixture(name):
@@ -230,52 +239,82 @@ class TestIpv6PoolValidate(object):
                                                     "['fe80:0:g:1::/64']"]
 
 
+def fake_system_nodes_ql(session, endpoint, payload):
+    """
+    Answer the batched system_nodes query from the blueprint fixture, as
+    the AOS server would with its label filters
+    """
+    nodes = deserialize_fixture('bp_system_nodes_ql.json')['data']['system_nodes']
+    query = payload['query']
+
+    data = {}
+    for alias, label in re.findall(r'(\w+): system_nodes\(label: "([^"]*)"\)',
+                                   query):
+        data[alias] = [n for n in nodes if n['label'] == label]
+
+    if re.search(r'{ system_nodes ', query):
+        data['system_nodes'] = nodes
+
+    return {'data': data}
+
+
 class TestFindBpSystemNodes:
 
     @patch('library.aos.aos_post')
     def test_find_system_node_id_valid(self, mock_post):
 
-        mock_return = deserialize_fixture('bp_system_nodes_ql.json')
-
-        mock_post.return_value = mock_return
+        mock_post.side_effect = fake_system_nodes_ql
         test_session = 'test'
         test_nodes = ['spine1']
         test_bp = 'testbpid'
 
         return_node = find_bp_system_nodes(test_session, test_bp, nodes=test_nodes)
         assert return_node[0]['id'] == '06b3424a-6f6a-422f-b6fa-a340f117981a'
+        mock_post.assert_called_once_with(
+            test_session, 'blueprints/testbpid/ql',
+            {'query': '{ node0: system_nodes(label: "spine1") '
+                      '{id, label, role} }'})
 
     @patch('library.aos.aos_post')
     def test_find_system_node_id_valid_multiple(self, mock_post):
 
-        mock_return = deserialize_fixture('bp_system_nodes_ql.json')
-
-        mock_post.return_value = mock_return
+        mock_post.side_effect = fake_system_nodes_ql
         test_session = 'test'
         test_nodes = ['spine1', 'spine2']
         test_bp = 'testbpid'
 
         expected = [
             {
-                'id': 'e0fc723a-114d-4080-89ab-789d7da6c0eb',
-                'label': 'spine2',
+                'id': '06b3424a-6f6a-422f-b6fa-a340f117981a',
+                'label': 'spine1',
                 'role': 'spine'
             },
             {
-                'id': '06b3424a-6f6a-422f-b6fa-a340f117981a',
-                'label': 'spine1',
+                'id': 'e0fc723a-114d-4080-89ab-789d7da6c0eb',
+                'label': 'spine2',
                 'role': 'spine'
             }
         ]
 
         return_node = find_bp_system_nodes(test_session, test_bp, nodes=test_nodes)
         assert return_node == expected
+        assert mock_post.call_count == 1
 
     @patch('library.aos.aos_post')
-    def test_find_system_node_id_invalid(self, mock_post):
-        mock_return = deserialize_fixture('bp_system_nodes_ql.json')
+    def test_find_system_node_id_duplicates(self, mock_post):
 
-        mock_post.return_value = mock_return
+        mock_post.side_effect = fake_system_nodes_ql
+
+        return_node = find_bp_system_nodes('test', 'testbpid',
+                                           nodes=['spine2', 'spine1', 'spine2'])
+
+        # One sub-query per name, in the order first given
+        assert [n['label'] for n in return_node] == ['spine2', 'spine1']
+        assert mock_post.call_args[0][2]['query'].count('system_nodes') == 2
+
+    @patch('library.aos.aos_post')
+    def test_find_system_node_id_invalid(self, mock_post):
+        mock_post.side_effect = fake_system_nodes_ql
         test_session = 'test'
         test_nodes = ['bad_name']
         test_bp = 'testbpid'
@@ -305,3 +344,1021 @@ class TestFindBpSystemNodes:
 
         return_node = find_bp_system_nodes(test_session, test_bp, nodes=test_nodes)
         assert return_node == mock_return['data']['system_nodes']
+
+
+class TestQlQuery(object):
+
+    def test_ql_selection(self):
+
+        assert aos.ql_selection('system_nodes', ['id', 'label'],
+                                role='spine', label=None) == \
+            'system_nodes(role: "spine") {id, label}'
+        assert aos.ql_selection('system_nodes', ['id'], alias='leafs',
+                                role=['leaf', 'spine']) == \
+            'leafs: system_nodes(role: ["leaf", "spine"]) {id}'
+
+    @patch('library.aos.aos_post')
+    def test_ql_query_batch(self, mock_post):
+
+        mock_post.return_value = {'data': {'nodes': [], 'zones': []}}
+        query = aos.QlQuery()
+        query.add('nodes', 'system_nodes', ['id'], role='spine')
+        query.add('zones', 'security_zone_nodes', ['id', 'vrf_name'])
+
+        assert query.execute('session', 'bp') == {'nodes': [], 'zones': []}
+        mock_post.assert_called_once_with(
+            'session', 'blueprints/bp/ql',
+            {'query': '{ nodes: system_nodes(role: "spine") {id} '
+                      'zones: security_zone_nodes {id, vrf_name} }'})
+
+
+class TestPooledSession(object):
+
+    def setup_method(self):
+        close_pooled_sessions()
+
+    def teardown_method(self):
+        close_pooled_sessions()
+
+    def test_pooled_session_reused(self):
+
+        first = get_pooled_session('aos-server', verify=False)
+        second = get_pooled_session('aos-server', verify=False)
+        assert first is second
+
+    def test_pooled_session_keyed_on_server_and_verify(self):
+
+        first = get_pooled_session('aos-server', verify=False)
+        assert get_pooled_session('aos-server', verify=True) is not first
+        assert get_pooled_session('aos-server2', verify=False) is not first
+
+    def test_pooled_session_idle_eviction(self, monkeypatch):
+
+        monkeypatch.setenv('AOS_POOL_IDLE_TIMEOUT', '30')
+        first = get_pooled_session('aos-server', verify=False)
+
+        aos.evict_idle_sessions(aos.time.time() + 60)
+        assert get_pooled_session('aos-server', verify=False) is not first
+
+    def test_pooled_session_pool_size(self, monkeypatch):
+
+        monkeypatch.setenv('AOS_POOL_SIZE', '4')
+        http = get_pooled_session('aos-server', verify=False)
+        assert http.get_adapter('https://aos-server')._pool_maxsize == 4
+
+    @patch('library.aos.requests.Session.request')
+    def test_aos_get_uses_pooled_session(self, mock_request):
+
+        mock_request.return_value.ok = True
+        mock_request.return_value.json.return_value = {'items': []}
+        test_session = {'server': 'aos-server', 'token': 'token'}
+
+        assert aos.aos_get(test_session, 'resources/asn-pools') == {'items': []}
+        aos.aos_get(test_session, 'resources/vni-pools')
+
+        assert len(aos._session_pool) == 1
+        mock_request.assert_called_with(
+            'GET', 'https://aos-server/api/resources/vni-pools',
+            data=None, headers=aos.requests_header(test_session),
+            verify=True, stream=False, timeout=None)
+
+
+class TestRunConcurrently(object):
+
+    def test_run_concurrently_keeps_order(self):
+
+        results = run_concurrently(lambda i: i * 2, [1, 2, 3])
+        assert results == [(2, None), (4, None), (6, None)]
+
+    def test_run_concurrently_reports_errors(self):
+
+        def func(item):
+            if item == 2:
+                raise ValueError("bad item")
+            return item
+
+        assert run_concurrently(func, [1, 2]) == [(1, None),
+                                                  (None, 'ValueError: bad item')]
+
+    def test_run_concurrently_empty(self):
+
+        assert run_concurrently(lambda i: i, []) == []
+
+
+class TestReconcileResources(object):
+
+    @patch('library.aos.aos_get')
+    def test_reconcile_resources_single_get(self, mock_get):
+
+        mock_get.return_value = {'items': [{'id': 'pool-1',
+                                            'display_name': 'pool-1'},
+                                           {'id': 'pool-2',
+                                            'display_name': 'pool-2'}]}
+        specs = [{'name': 'pool-1', 'id': None, 'state': 'present'},
+                 {'name': None, 'id': 'pool-2', 'state': 'absent'},
+                 {'name': 'pool-3', 'id': None, 'state': 'present'}]
+
+        def present(module, session, item, spec):
+            return True, not item, item or {'display_name': spec['name'],
+                                            'id': spec['name']}
+
+        def absent(module, session, item):
+            return True, True, item
+
+        changed, results = reconcile_resources('module', 'session', 'pools',
+                                               specs, present, absent)
+
+        mock_get.assert_called_once_with('session', 'pools')
+        assert changed
+        assert [(r['name'], r['changed']) for r in results] == [
+            ('pool-1', False), ('pool-2', True), ('pool-3', True)]
+
+
+class TestResourceIndex(object):
+
+    items = [{'id': 'id-1', 'display_name': 'pool-1', 'label': 'vn-1'},
+             {'id': 'id-2', 'display_name': 'pool-2', 'label': 'vn-2'},
+             {'id': 'id-3', 'display_name': 'pool-1', 'label': 'vn-1'}]
+
+    def test_index_lookup_list(self):
+
+        index = ResourceIndex.from_response({'items': self.items})
+        assert index.by_id('id-2') == self.items[1]
+        assert index.by_name('pool-2') == self.items[1]
+        assert index.by_label('vn-2') == self.items[1]
+        assert len(index) == 3
+
+    def test_index_lookup_dict(self):
+
+        vn_data = {'virtual_networks': {i['id']: i for i in self.items}}
+        index = ResourceIndex.from_response(vn_data, 'virtual_networks')
+        assert index.by_id('id-3') == self.items[2]
+
+    def test_index_first_match_and_duplicates(self):
+
+        index = ResourceIndex(self.items)
+        assert index.by_name('pool-1') == self.items[0]
+        assert index.by_label('vn-1') == self.items[0]
+        assert index.duplicate_labels == {'vn-1'}
+
+    def test_index_missing(self):
+
+        index = ResourceIndex.from_response({})
+        assert index.by_id('id-1') == {}
+        assert index.by_label('vn-1') == {}
+
+    def test_find_resource_by_name(self):
+
+        resource_data = {'items': self.items}
+        assert find_resource_by_name(resource_data, 'pool-2') == self.items[1]
+        assert find_resource_by_id(resource_data, 'id-9') == {}
+
+
+class TestMergeRanges(object):
+
+    existing = [{'first': 100, 'last': 200, 'status': 'pool_element_available'}]
+
+    def test_merge_ranges_contained(self):
+
+        assert merge_ranges(self.existing, [[100, 200], [150, 160]]) == \
+            ([{'first': 100, 'last': 200}], False)
+
+    def test_merge_ranges_new(self):
+
+        assert merge_ranges(self.existing, [[300, 400]]) == \
+            ([{'first': 100, 'last': 200}, {'first': 300, 'last': 400}], True)
+
+    def test_merge_ranges_repeated_request(self):
+
+        merged, changed = merge_ranges([], [[300, 400], [300, 400]])
+        assert merged == [{'first': 300, 'last': 400}]
+
+
+class TestMergeSubnets(object):
+
+    existing = [{'network': '10.0.0.0/16'}, {'network': '2005::/64'}]
+
+    def test_merge_subnets_contained(self):
+
+        merged, changed = merge_subnets(self.existing,
+                                        ['10.0.1.0/24', '2005::/80'])
+        assert merged == self.existing
+        assert not changed
+
+    def test_merge_subnets_new(self):
+
+        merged, changed = merge_subnets(self.existing, ['10.1.0.0/24'])
+        assert merged == [{'network': '10.0.0.0/16'},
+                          {'network': '10.1.0.0/24'},
+                          {'network': '2005::/64'}]
+        assert changed
+
+    def test_merge_subnets_aggregate(self):
+
+        merged, changed = merge_subnets([{'network': '10.0.0.0/31'}],
+                                        ['10.0.0.2/31', '10.0.0.0/30'])
+        assert merged == [{'network': '10.0.0.0/30'}]
+        assert changed
+
+
+class TestSubnetSet(object):
+
+    def test_subnet_set_aggregate(self):
+
+        subnet_set = SubnetSet(['10.0.0.0/25', '10.0.0.128/25', '10.0.0.0/26',
+                                '2005::/65', '2005:0:0:0:8000::/65',
+                                '10.0.1.0/24'])
+        assert subnet_set.to_list() == [{'network': '10.0.0.0/23'},
+                                        {'network': '2005::/64'}]
+
+    def test_subnet_set_covers(self):
+
+        subnet_set = SubnetSet([{'network': '10.0.0.0/24'},
+                                {'network': '10.0.1.0/24'}])
+        assert subnet_set.covers('10.0.0.0/23')
+        assert not subnet_set.covers('10.0.0.0/22')
+        assert not subnet_set.covers('2005::/64')
+
+    def test_subnet_overlaps(self):
+
+        assert find_subnet_overlaps(['10.0.0.0/24', '10.0.0.128/25',
+                                     '10.0.1.0/24', '2005::/64']) == [
+            "Invalid subnet: 10.0.0.128/25 overlaps 10.0.0.0/24"]
+
+
+class TestRangeSet(object):
+
+    def test_range_set_coalesce(self):
+
+        range_set = RangeSet([[300, 400], [100, 200], [201, 250], [150, 160]])
+        assert range_set.to_list() == [{'first': 100, 'last': 250},
+                                       {'first': 300, 'last': 400}]
+
+    def test_range_set_covers(self):
+
+        range_set = RangeSet([{'first': 100, 'last': 200},
+                              {'first': 201, 'last': 300}])
+        assert range_set.covers(150, 250)
+        assert not range_set.covers(50, 150)
+        assert not range_set.covers(250, 350)
+
+    def test_range_set_overlapping(self):
+
+        range_set = RangeSet([[100, 200], [300, 400], [500, 600]])
+        assert range_set.overlapping(150, 350) == [(100, 200), (300, 400)]
+        assert range_set.overlapping(201, 299) == []
+
+    def test_range_overlaps(self):
+
+        assert find_range_overlaps([[300, 400], [100, 200], [200, 250]]) == [
+            "Invalid range: [200, 250] overlaps [100, 200]"]
+
+    def test_range_adjacent_not_overlap(self):
+
+        assert find_range_overlaps([[100, 200], [201, 300]]) == []
+
+    def test_asn_validate_overlap(self):
+
+        assert validate_asn_ranges([[100, 200], [150, 300]]) == [
+            "Invalid range: [150, 300] overlaps [100, 200]"]
+
+    def test_merge_ranges_coalesce(self):
+
+        existing = [{'first': 100, 'last': 200}]
+        assert merge_ranges(existing, [[201, 300], [150, 250]]) == \
+            ([{'first': 100, 'last': 300}], True)
+
+    def test_merge_ranges_covered_by_union(self):
+
+        existing = [{'first': 100, 'last': 200}, {'first': 201, 'last': 300}]
+        assert merge_ranges(existing, [[150, 250]]) == (existing, False)
+
+
+class TestPoolIndex(object):
+
+    pools = {'asn': [{'id': 'asn-1', 'display_name': 'asn-1',
+                      'ranges': [{'first': 100, 'last': 200}]}],
+             'vni': [{'id': 'vni-1', 'display_name': 'vni-1',
+                      'ranges': [{'first': 5000, 'last': 5100}]}],
+             'ipv4': [{'id': 'ip-1', 'display_name': 'ip-1',
+                       'subnets': [{'network': '10.0.0.0/24'}]}],
+             'ipv6': [{'id': 'ip6-1', 'display_name': 'ip6-1',
+                       'subnets': [{'network': 'fe80::/64'}]}]}
+
+    def test_interval_index_ignore(self):
+
+        index = aos.IntervalIndex([(1, 10, 'a', 'x', 'X'),
+                                   (5, 20, 'b', 'y', 'Y')])
+        assert index.find(8, 8)[3] in ['x', 'y']
+        assert index.find(8, 8, ignore='x')[3] == 'y'
+        assert index.find(8, 8, ignore='y')[3] == 'x'
+        assert index.find(15, 30, ignore='y') is None
+        assert index.find(21, 30) is None
+
+    def test_pool_index_conflicts(self):
+
+        index = aos.PoolIndex(self.pools)
+        assert index.conflicts('asn', [[200, 300]]) == [
+            "Invalid range: [200, 300] overlaps [100, 200] in asn pool asn-1"]
+        assert index.conflicts('asn', [[5000, 5000]]) == []
+        assert index.conflicts('vni', [[5000, 5000]], self.pools['vni'][0]) == []
+        assert index.conflicts('ipv6', ['10.0.0.128/25']) == [
+            "Invalid subnet: 10.0.0.128/25 overlaps 10.0.0.0/24 "
+            "in ipv4 pool ip-1"]
+
+
+class TestCachedGet(object):
+
+    session = {'server': 'aos-server', 'token': 'token'}
+
+    @patch('library.aos.aos_request')
+    def test_cached_get_ttl(self, mock_request, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        mock_request.return_value.ok = True
+        mock_request.return_value.headers = {'ETag': '"1"'}
+        mock_request.return_value.json.return_value = {'items': []}
+
+        assert aos.cached_get(self.session, 'resources/asn-pools') == \
+            {'items': []}
+        assert aos.cached_get(self.session, 'resources/asn-pools') == \
+            {'items': []}
+        assert mock_request.call_count == 1
+
+    @patch('library.aos.aos_request')
+    def test_cached_get_not_modified(self, mock_request, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        aos.cache_store('aos-server', 'resources/asn-pools',
+                        {'time': 0, 'etag': '"1"', 'body': {'items': [1]}})
+        mock_request.return_value.status_code = 304
+        mock_request.return_value.headers = {}
+
+        assert aos.cached_get(self.session, 'resources/asn-pools') == \
+            {'items': [1]}
+        headers = mock_request.call_args[1]['headers']
+        assert headers['If-None-Match'] == '"1"'
+        assert aos.cache_load('aos-server',
+                              'resources/asn-pools')['time'] > 0
+
+    def test_cache_invalidate(self, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        aos.cache_store('aos-server', 'resources/asn-pools',
+                        {'time': 0, 'etag': None, 'body': {}})
+
+        aos.cache_invalidate('aos-server', 'resources/asn-pools/pool-1')
+        assert aos.cache_load('aos-server', 'resources/asn-pools') is None
+
+
+def make_token(exp):
+    claims = aos.base64.urlsafe_b64encode(
+        json.dumps({'exp': exp}).encode('ascii')).decode('ascii').rstrip('=')
+    return "header.{}.signature".format(claims)
+
+
+class TestAosToken(object):
+
+    def test_token_expiry(self):
+
+        assert aos.token_expiry(make_token(1234)) == 1234
+        assert aos.token_expiry('not-a-jwt') is None
+        assert aos.token_expiry(None) is None
+
+    def test_token_expiring(self):
+
+        assert aos.token_expiring(make_token(aos.time.time() + 30))
+        assert not aos.token_expiring(make_token(aos.time.time() + 3600))
+        assert not aos.token_expiring('not-a-jwt')
+
+    @patch('library.aos.aos_user_login')
+    def test_aos_token_cached(self, mock_login, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        token = make_token(aos.time.time() + 3600)
+        mock_login.return_value = token
+
+        assert aos.aos_token('aos-server', 'admin', 'admin') == (token, True)
+        assert aos.aos_token('aos-server', 'admin', 'admin') == (token, False)
+        assert mock_login.call_count == 1
+        mode = os.stat(aos._cache_file('aos-server', 'user/login/admin')).st_mode
+        assert mode & 0o077 == 0
+
+    @patch('library.aos.aos_user_login')
+    def test_aos_token_refresh(self, mock_login, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        old = make_token(aos.time.time() + 30)
+        aos.cache_store('aos-server', 'user/login/admin', {'token': old})
+        mock_login.return_value = make_token(aos.time.time() + 3600)
+
+        assert aos.aos_token('aos-server', 'admin', 'admin') == \
+            (mock_login.return_value, True)
+
+    @patch('library.aos.aos_user_login')
+    def test_aos_token_password_checked(self, mock_login, tmpdir,
+                                        monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        token = make_token(aos.time.time() + 3600)
+        mock_login.return_value = token
+        aos.aos_token('aos-server', 'admin', 'admin')
+
+        entry = aos.cache_load('aos-server', 'user/login/admin')
+        assert 'admin' not in entry['digest']
+
+        # Another password logs in, the AOS server checks it
+        mock_login.side_effect = aos.requests.HTTPError('bad password')
+        with pytest.raises(aos.requests.HTTPError):
+            aos.aos_token('aos-server', 'admin', 'wrong')
+        with pytest.raises(aos.requests.HTTPError):
+            aos.aos_token('aos-server', 'admin', '')
+
+        assert aos.aos_token('aos-server', 'admin', 'admin') == (token, False)
+        # Sessions refreshing their token skip the check
+        assert aos.aos_token('aos-server', 'admin', None) == (token, False)
+
+    @patch('library.aos.aos_user_login')
+    def test_aos_token_without_digest(self, mock_login, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        aos.cache_store('aos-server', 'user/login/admin',
+                        {'token': make_token(aos.time.time() + 3600)})
+        mock_login.return_value = make_token(aos.time.time() + 7200)
+
+        assert aos.aos_token('aos-server', 'admin', 'admin') == \
+            (mock_login.return_value, True)
+
+    def test_aos_token_no_password(self, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+
+        with pytest.raises(aos.requests.RequestException):
+            aos.aos_token('aos-server', 'admin', None)
+
+    @patch('library.aos.aos_user_login')
+    @patch('library.aos._aos_send')
+    def test_aos_request_relogin(self, mock_send, mock_login, tmpdir,
+                                 monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        monkeypatch.setenv('AOS_PASSWD', 'admin')
+        new = make_token(aos.time.time() + 3600)
+        mock_login.return_value = new
+        rejected = MagicMock()
+        rejected.status_code = 401
+        accepted = MagicMock()
+        accepted.status_code = 200
+        mock_send.side_effect = [rejected, accepted]
+        session = {'server': 'aos-server', 'user': 'admin', 'token': 'old'}
+
+        assert aos.aos_request(session, 'GET', 'blueprints') is accepted
+        assert session['token'] == new
+        assert mock_send.call_args[0][5]['AUTHTOKEN'] == new
+        mock_login.assert_called_once_with('aos-server', 'admin', 'admin')
+
+    @patch('library.aos._aos_send')
+    def test_aos_request_401_without_user(self, mock_send):
+
+        mock_send.return_value.status_code = 401
+        session = {'server': 'aos-server', 'token': 'old'}
+
+        assert aos.aos_request(session, 'GET', 'blueprints') is \
+            mock_send.return_value
+        assert mock_send.call_count == 1
+
+
+class TestPollUntil(object):
+
+    @patch('library.aos.time.sleep')
+    def test_poll_until_backoff(self, mock_sleep):
+
+        values = iter([1, 2, 3])
+        assert aos.poll_until(lambda: next(values), lambda v: v == 3, 600,
+                              interval=2) == (3, True)
+
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        assert 1 <= delays[0] <= 2
+        assert 2 <= delays[1] <= 4
+
+    @patch('library.aos.time.sleep')
+    def test_poll_until_timeout(self, mock_sleep):
+
+        assert aos.poll_until(lambda: 1, lambda v: False, 0) == (1, False)
+        assert not mock_sleep.called
+
+
+class TestBlueprintCache(object):
+
+    session = {'server': 'aos-server', 'token': 'token'}
+
+    def setup_method(self):
+        aos._blueprint_versions.clear()
+
+    @patch('library.aos.aos_get')
+    def test_blueprint_get_disabled(self, mock_get, monkeypatch):
+
+        monkeypatch.delenv('AOS_BLUEPRINT_CACHE', raising=False)
+        mock_get.return_value = {'items': {}}
+
+        aos.blueprint_get(self.session, 'bp', 'security-zones')
+        aos.blueprint_get(self.session, 'bp', 'security-zones')
+        assert mock_get.call_count == 2
+
+    @patch('library.aos.aos_get')
+    def test_blueprint_get_cached(self, mock_get, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_BLUEPRINT_CACHE', 'true')
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        bodies = {'blueprints/bp': {'version': 1},
+                  'blueprints/bp/security-zones': {'items': {}}}
+        mock_get.side_effect = lambda session, endpoint: bodies[endpoint]
+
+        for _ in range(3):
+            assert aos.blueprint_get(self.session, 'bp', 'security-zones') == \
+                {'items': {}}
+        assert mock_get.call_count == 2
+
+        # A new blueprint version, seen by another process, is refetched
+        aos._blueprint_versions.clear()
+        bodies['blueprints/bp'] = {'version': 2}
+        aos.blueprint_get(self.session, 'bp', 'security-zones')
+        assert mock_get.call_count == 4
+
+    @patch('library.aos.aos_get')
+    def test_blueprint_write_invalidates(self, mock_get, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_BLUEPRINT_CACHE', 'true')
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        mock_get.return_value = {'version': 1}
+
+        assert aos.get_blueprint_version(self.session, 'bp') == 1
+        aos.cache_invalidate('aos-server', 'blueprints/bp/virtual-networks/vn')
+        assert ('aos-server', 'bp') not in aos._blueprint_versions
+
+    @patch('library.aos.aos_get')
+    @patch('library.aos.aos_post')
+    def test_ql_query_cached(self, mock_post, mock_get, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_BLUEPRINT_CACHE', 'true')
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        mock_get.return_value = {'version': 1}
+        mock_post.return_value = {'data': {'system_nodes': []}}
+
+        find_bp_system_nodes(self.session, 'bp')
+        find_bp_system_nodes(self.session, 'bp')
+        assert mock_post.call_count == 1
+
+
+class TestJsonStream(object):
+
+    def chunks(self, document, size):
+        data = json.dumps(document).encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_iter_json_items_list(self):
+
+        document = {'count': 123456, 'items': [{'id': 'a', 'n': 1.5},
+                                               {'id': 'b', 'label': 'é'}],
+                    'links': {'next': None}}
+
+        for size in [1, 3, 7, 1000]:
+            assert list(aos.iter_json_items(self.chunks(document, size))) == \
+                document['items']
+
+    def test_iter_json_items_dict(self):
+
+        document = {'virtual_networks': {'vn-1': {'id': 'vn-1'},
+                                         'vn-2': {'id': 'vn-2'}}}
+
+        assert list(aos.iter_json_items(self.chunks(document, 5),
+                                        'virtual_networks')) == \
+            [{'id': 'vn-1'}, {'id': 'vn-2'}]
+
+    def test_iter_json_items_empty(self):
+
+        assert list(aos.iter_json_items([b'{"items": []}'])) == []
+        assert list(aos.iter_json_items([b'{}'])) == []
+
+    def test_iter_json_items_truncated(self):
+
+        with pytest.raises(ValueError):
+            list(aos.iter_json_items([b'{"items": [{"id": "a"}, {"id"']))
+
+    def test_find_item_stops_early(self):
+
+        read = []
+
+        def items():
+            for i in range(10):
+                read.append(i)
+                yield {'id': str(i), 'label': 'vn'}
+
+        assert aos.find_item(items(), uuid='2') == ({'id': '2', 'label': 'vn'},
+                                                    False)
+        assert read == [0, 1, 2]
+        assert aos.find_item(items(), label='vn') == ({'id': '0', 'label': 'vn'},
+                                                      True)
+        assert aos.find_item(items(), label='other') == ({}, False)
+
+    @patch('library.aos.aos_request')
+    def test_find_resource_item_streamed(self, mock_request):
+
+        missing = MagicMock(ok=False, status_code=404)
+        listing = MagicMock(ok=True, status_code=200)
+        listing.iter_content.return_value = self.chunks(
+            {'items': [{'id': 'id-1', 'display_name': 'pool-1'},
+                       {'id': 'id-2', 'display_name': 'pool-2'}]}, 16)
+        mock_request.side_effect = [missing, listing]
+
+        assert aos.find_resource_item('session', 'resources/asn-pools',
+                                      name='pool-2')['id'] == 'id-2'
+        mock_request.assert_called_with('session', 'GET',
+                                        'resources/asn-pools', stream=True)
+        assert listing.close.called
+
+
+class TestGetResourceById(object):
+
+    @patch('library.aos.aos_request')
+    def test_find_resource_item_by_id(self, mock_request):
+
+        mock_request.return_value.ok = True
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.return_value = {'id': 'pool 1'}
+
+        assert aos.find_resource_item('session', 'resources/ip-pools',
+                                      uuid='pool 1') == {'id': 'pool 1'}
+        mock_request.assert_called_once_with('session', 'GET',
+                                             'resources/ip-pools/pool%201')
+
+    @patch('library.aos.aos_request')
+    def test_find_resource_item_by_id_missing(self, mock_request):
+
+        mock_request.return_value.ok = False
+        mock_request.return_value.status_code = 404
+
+        assert aos.find_resource_item('session', 'resources/ip-pools',
+                                      uuid='pool-1') == {}
+
+    @patch('library.aos.aos_request')
+    def test_find_resource_item_name_as_id(self, mock_request):
+
+        mock_request.return_value.ok = True
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.json.return_value = {
+            'id': 'pool-1', 'display_name': 'pool-1'}
+
+        assert aos.find_resource_item('session', 'resources/ip-pools',
+                                      name='pool-1')['id'] == 'pool-1'
+        assert mock_request.call_count == 1
+
+
+class TestMetrics(object):
+
+    session = {'server': 'aos-server', 'token': 'token'}
+
+    def setup_method(self):
+        del aos._metrics[:]
+
+    def test_accept_encoding(self):
+
+        assert 'gzip' in aos.requests_header(self.session)['Accept-Encoding']
+
+    @patch('library.aos.requests.Session.request')
+    def test_metrics_recorded(self, mock_request, monkeypatch):
+
+        monkeypatch.setenv('AOS_METRICS', 'true')
+        response = mock_request.return_value
+        response.status_code = 200
+        response.content = b'{"items": []}'
+        response.headers = {'Content-Length': '40',
+                            'Content-Encoding': 'gzip'}
+
+        aos.aos_request(self.session, 'POST', 'resources/asn-pools',
+                        {'id': 'pool-1'})
+
+        metrics = aos.aos_metrics()
+        assert metrics['requests'] == 1
+        assert metrics['request_bytes'] == len('{"id": "pool-1"}')
+        assert metrics['response_bytes'] == 13
+        assert metrics['wire_bytes'] == 40
+        assert metrics['calls'][0]['status'] == 200
+        assert metrics['calls'][0]['encoding'] == 'gzip'
+
+    @patch('library.aos.requests.Session.request')
+    def test_metrics_disabled(self, mock_request, monkeypatch):
+
+        monkeypatch.delenv('AOS_METRICS', raising=False)
+        mock_request.return_value.status_code = 200
+
+        aos.aos_request(self.session, 'GET', 'resources/asn-pools')
+        assert aos.aos_metrics()['requests'] == 0
+
+        module = MagicMock()
+        assert aos.instrument_module(module).exit_json is module.exit_json
+
+    @patch('library.aos.aos_request')
+    def test_metrics_streamed_bytes(self, mock_request):
+
+        metric = {'response_bytes': 0}
+        mock_request.return_value.ok = True
+        mock_request.return_value.aos_metric = metric
+        mock_request.return_value.iter_content.return_value = [
+            b'{"items": [', b'{"id": "a"}]}']
+
+        assert list(aos.aos_get_items(self.session, 'pools')) == [{'id': 'a'}]
+        assert metric['response_bytes'] == 24
+
+    def test_instrument_module(self, monkeypatch):
+
+        monkeypatch.setenv('AOS_METRICS', 'true')
+        module = MagicMock()
+        exit_json = module.exit_json
+
+        aos.instrument_module(module).exit_json(changed=False)
+
+        assert exit_json.call_args[1]['aos_metrics']['requests'] == 0
+
+    @patch('library.aos.requests.Session.request')
+    def test_metrics_failed_request(self, mock_request, monkeypatch):
+
+        monkeypatch.setenv('AOS_METRICS', 'true')
+        mock_request.side_effect = aos.requests.ConnectionError('refused')
+
+        with pytest.raises(aos.requests.ConnectionError):
+            aos.aos_request(self.session, 'GET', 'blueprints')
+
+        call = aos.aos_metrics()['calls'][0]
+        assert call['status'] is None
+        assert call['error'] == 'ConnectionError: refused'
+        assert call['timings']['reused']
+
+    @patch('library.aos.requests.Session.request')
+    def test_trace_file(self, mock_request, monkeypatch, tmp_path):
+
+        trace = tmp_path / 'trace.jsonl'
+        monkeypatch.delenv('AOS_METRICS', raising=False)
+        monkeypatch.setenv('AOS_TRACE_FILE', str(trace))
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = b'{}'
+        mock_request.return_value.headers = {}
+
+        aos.aos_request(self.session, 'GET', 'blueprints')
+        aos.aos_request(self.session, 'GET', 'blueprints/bp-1')
+
+        lines = [json.loads(line) for line in trace.read_text().splitlines()]
+        assert [line['endpoint'] for line in lines] == ['blueprints',
+                                                        'blueprints/bp-1']
+        assert lines[0]['pid'] == os.getpid()
+        assert aos.aos_metrics()['requests'] == 0
+
+    def test_otel_span(self, monkeypatch):
+
+        monkeypatch.setattr(aos, '_trace_context', None)
+        monkeypatch.setenv('TRACEPARENT',
+                           '00-{}-{}-01'.format('a' * 32, 'b' * 16))
+        entry = {'method': 'GET', 'endpoint': 'blueprints',
+                 'server': 'aos-server', 'status': 503, 'request_bytes': 0,
+                 'response_bytes': 10, 'start': 100.0, 'elapsed': 0.25,
+                 'retries': 2, 'timings': {'reused': True, 'dns': None,
+                                           'total': 0.5}}
+
+        export = aos.otel_span(entry)
+        span = export['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        attributes = dict((a['key'], a['value']) for a in span['attributes'])
+
+        assert span['traceId'] == 'a' * 32
+        assert span['parentSpanId'] == 'b' * 16
+        assert span['kind'] == 3
+        assert span['status'] == {'code': 2}
+        assert span['startTimeUnixNano'] == str(100 * 10 ** 9)
+        assert span['endTimeUnixNano'] == str(int(100.5 * 10 ** 9))
+        assert attributes['http.response.status_code'] == {'intValue': '503'}
+        assert attributes['http.request.resend_count'] == {'intValue': '2'}
+        assert attributes['aos.timing.reused'] == {'boolValue': True}
+        assert 'aos.timing.dns' not in attributes
+
+
+class TestHttpCache(object):
+
+    session = {'server': 'aos-server', 'token': 'token'}
+
+    @patch('library.aos.requests.Session.request')
+    def test_aos_get_revalidates(self, mock_request, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_HTTP_CACHE', 'true')
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        full = MagicMock(ok=True, status_code=200,
+                         headers={'Last-Modified': 'Mon, 05 Oct 2026'})
+        full.json.return_value = {'items': [1]}
+        not_modified = MagicMock(ok=False, status_code=304, headers={})
+        mock_request.side_effect = [full, not_modified]
+
+        assert aos.aos_get(self.session, 'blueprints') == {'items': [1]}
+        assert aos.aos_get(self.session, 'blueprints') == {'items': [1]}
+
+        headers = mock_request.call_args[1]['headers']
+        assert headers['If-Modified-Since'] == 'Mon, 05 Oct 2026'
+
+    @patch('library.aos.requests.Session.request')
+    def test_aos_get_write_invalidates(self, mock_request, tmpdir,
+                                       monkeypatch):
+
+        monkeypatch.setenv('AOS_HTTP_CACHE', 'true')
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        response = MagicMock(ok=True, status_code=200, headers={'ETag': '"1"'})
+        response.json.return_value = {'items': []}
+        mock_request.return_value = response
+
+        aos.aos_get(self.session, 'resources/asn-pools')
+        assert aos.cache_load('aos-server', 'resources/asn-pools')
+
+        aos.aos_request(self.session, 'DELETE', 'resources/asn-pools/pool-1')
+        assert aos.cache_load('aos-server', 'resources/asn-pools') is None
+
+    def test_cache_prune_lru(self, tmpdir, monkeypatch):
+
+        monkeypatch.setenv('AOS_CACHE_DIR', str(tmpdir))
+        monkeypatch.setenv('AOS_CACHE_MAX_BYTES', '10000000')
+
+        for i, endpoint in enumerate(['a', 'b', 'c']):
+            aos.cache_store('aos-server', endpoint, {'body': 'x' * 100})
+            os.utime(aos._cache_file('aos-server', endpoint), (i, i))
+
+        # Reading 'a' makes 'b' the least recently used entry
+        aos.cache_load('aos-server', 'a')
+        size = os.path.getsize(aos._cache_file('aos-server', 'a'))
+        aos.cache_prune(2 * size)
+
+        assert aos.cache_load('aos-server', 'a')
+        assert aos.cache_load('aos-server', 'b') is None
+        assert aos.cache_load('aos-server', 'c')
+
+
+class TestLazyImports(object):
+
+    def test_module_import(self):
+
+        code = ("import sys, library.aos_bp_deploy, library.aos_ip_pool; "
+                "print([m for m in ('requests', 'urllib3', 'asyncio') "
+                "if m in sys.modules])")
+        loaded = subprocess.check_output([sys.executable, '-c', code])
+
+        assert loaded.strip() == b'[]'
+
+    def test_lazy_module(self):
+
+        lazy = aos._LazyModule('json', 'lazy_json')
+
+        assert lazy.dumps([]) == '[]'
+        assert aos.lazy_json is json
+        del aos.lazy_json
+
+
+class TestRetryPolicy(object):
+
+    def test_retry_policy(self, monkeypatch):
+
+        monkeypatch.setenv('AOS_RETRIES', '5')
+        retry = aos.retry_policy()
+
+        assert retry.total == 5
+        assert 503 in retry.status_forcelist
+        assert retry.respect_retry_after_header
+        assert not retry.raise_on_status
+
+    def test_retry_idempotent_methods(self):
+
+        retry = aos.retry_policy(3)
+
+        assert retry.is_retry('GET', 503)
+        assert retry.is_retry('PUT', 502)
+        assert not retry.is_retry('POST', 503)
+        assert retry.is_retry('POST', 429)
+        assert not retry.is_retry('GET', 404)
+        assert not aos.retry_policy(0).is_retry('POST', 429)
+
+    @patch('library.aos_http.random.uniform', return_value=0.25)
+    def test_retry_backoff_jitter(self, mock_uniform, monkeypatch):
+
+        monkeypatch.setenv('AOS_RETRY_BACKOFF', '0.5')
+        retry = aos.retry_policy(5)
+
+        assert retry.get_backoff_time() == 0
+        retry = retry.increment('GET', '/', error=OSError())
+        retry = retry.increment('GET', '/', error=OSError())
+        retry = retry.increment('GET', '/', error=OSError())
+
+        # 0.5 * 2 ** 2 plus jitter in [0, 0.5]
+        assert retry.get_backoff_time() == 2.25
+        mock_uniform.assert_called_with(0, 0.5)
+
+    def test_pooled_session_retry(self):
+
+        close_pooled_sessions()
+        http = get_pooled_session('aos-server', verify=False)
+        adapter = http.get_adapter('https://aos-server')
+
+        assert isinstance(adapter.max_retries, AosRetry)
+        close_pooled_sessions()
+
+
+class TestRateLimiter(object):
+
+    def test_rate_limiter_disabled(self, monkeypatch):
+
+        monkeypatch.delenv('AOS_RATE_LIMIT', raising=False)
+        assert aos.rate_limiter() is None
+
+    def test_rate_limiter_shared(self, monkeypatch):
+
+        monkeypatch.setenv('AOS_RATE_LIMIT', '5')
+        monkeypatch.setenv('AOS_RATE_BURST', '2')
+
+        limiter = aos.rate_limiter()
+        assert limiter is aos.rate_limiter()
+        assert (limiter.rate, limiter.burst) == (5, 2)
+
+    @patch('library.aos.time.sleep')
+    def test_rate_limiter_waits(self, mock_sleep):
+
+        limiter = aos.RateLimiter(10, burst=2)
+        now = [100.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        mock_sleep.side_effect = sleep
+        limiter.last = now[0]
+
+        with patch('library.aos.time.monotonic', lambda: now[0]):
+            for _ in range(4):
+                limiter.acquire()
+
+        # Two requests in the burst, then one every 1/rate seconds
+        assert round(now[0] - 100.0, 6) == 0.2
+
+
+class TestAsyncAosClient(object):
+
+    session = {'server': 'aos-server', 'token': 'token'}
+
+    @patch('library.aos.aos_request')
+    def test_aos_get_many(self, mock_request):
+
+        def request(session, method, endpoint, *args, **kwargs):
+            response = MagicMock(ok=endpoint != 'missing')
+            response.json.return_value = {'endpoint': endpoint}
+            response.raise_for_status.side_effect = ValueError('404')
+            return response
+
+        mock_request.side_effect = request
+
+        assert aos.aos_get_many(self.session, ['a', 'missing', 'b']) == [
+            ({'endpoint': 'a'}, None), (None, 'ValueError: 404'),
+            ({'endpoint': 'b'}, None)]
+
+    def test_client_concurrency_limit(self):
+
+        running = []
+        peak = []
+        lock = aos.threading.Lock()
+
+        def work(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            aos.time.sleep(0.01)
+            with lock:
+                running.remove(item)
+            return item
+
+        async def main():
+            async with aos.AsyncAosClient(self.session, 3) as client:
+                return await client.gather(*[client.call(work, i)
+                                             for i in range(12)])
+
+        assert aos.run_async(main()) == [(i, None) for i in range(12)]
+        assert max(peak) <= 3
+
+    def test_client_timeout(self):
+
+        async def main():
+            async with aos.AsyncAosClient(self.session, timeout=0.01) as client:
+                return await client.gather(client.call(aos.time.sleep, 0.5))
+
+        result, error = aos.run_async(main())[0]
+        assert error.startswith('TimeoutError')
+
+    @patch('library.aos.aos_request')
+    def test_client_delete(self, mock_request):
+
+        async def main():
+            async with aos.AsyncAosClient(self.session, timeout=5) as client:
+                return await client.delete('resources/asn-pools', 'pool-1')
+
+        assert aos.run_async(main()) is mock_request.return_value
+        mock_request.assert_called_once_with(
+            self.session, 'DELETE', 'resources/asn-pools/pool-1', None, None,
+            timeout=5)
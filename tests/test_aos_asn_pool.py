@@ -1,5 +1,8 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
+import mock
+import pytest
+import library.aos as aos
 import library.aos_asn_pool as aos_asn_pool
 
 
@@ -62,3 +65,140 @@ class TestAsnGetRange(object):
                                                         'last': 200},
                                                        {'first': 300,
                                                         'last': 400}]
+
+
+class TestAsnPoolBulk(object):
+
+    @mock.patch('library.aos_asn_pool.aos_post')
+    @mock.patch('library.aos.aos_get')
+    def test_asn_pool_bulk_create(self, mock_get, mock_post):
+
+        mock_get.return_value = {'items': [{'id': 'pool-1',
+                                            'display_name': 'pool-1',
+                                            'status': 'not_in_use',
+                                            'ranges': []}]}
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'pool-1', 'ranges': [[1, 2]]},
+                                   {'name': 'pool-2', 'ranges': [[3, 4]]}]}
+
+        aos_asn_pool.asn_pool_bulk(module)
+
+        mock_get.assert_called_once_with('session', aos_asn_pool.ENDPOINT)
+        mock_post.assert_called_once_with('session', aos_asn_pool.ENDPOINT,
+                                          {'ranges': [{'first': 3, 'last': 4}],
+                                           'display_name': 'pool-2',
+                                           'id': 'pool-2'})
+        results = module.exit_json.call_args[1]
+        assert results['changed']
+        assert [p['name'] for p in results['pools']] == ['pool-1', 'pool-2']
+
+    @mock.patch('library.aos_asn_pool.aos_delete')
+    @mock.patch('library.aos_asn_pool.aos_put')
+    @mock.patch('library.aos.aos_get')
+    def test_asn_pool_bulk_write_failed(self, mock_get, mock_put, mock_delete):
+
+        mock_get.return_value = {'items': [{'id': 'pool-1',
+                                            'display_name': 'pool-1',
+                                            'status': 'not_in_use',
+                                            'ranges': []},
+                                           {'id': 'pool-2',
+                                            'display_name': 'pool-2',
+                                            'status': 'not_in_use',
+                                            'ranges': []}]}
+        mock_put.return_value = mock.MagicMock(ok=False, status_code=422,
+                                               text='invalid ranges')
+        mock_delete.return_value = mock.MagicMock(ok=True)
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'pool-1', 'ranges': [[1, 2]]},
+                                   {'name': 'pool-2', 'state': 'absent'}]}
+
+        with pytest.raises(SystemExit):
+            aos_asn_pool.asn_pool_bulk(module)
+
+        pools = module.fail_json.call_args[1]['pools']
+        assert [(p['success'], p['changed']) for p in pools] == [
+            (False, False), (True, True)]
+        assert pools[0]['value']['msg'] == \
+            "Unable to update ASN Pool pool-1: 422 invalid ranges"
+
+    def test_asn_pool_bulk_invalid(self):
+
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'pools': [{'ranges': [[1, 2]]}, 'pool']}
+
+        with pytest.raises(SystemExit):
+            aos_asn_pool.asn_pool_bulk(module)
+
+        module.fail_json.assert_called_once_with(
+            msg=["Invalid pool: name or id required",
+                 "Invalid pool: must be a dict"])
+
+    @mock.patch('library.aos.get_pool_index')
+    @mock.patch('library.aos_asn_pool.aos_get')
+    def test_asn_pool_bulk_conflicts(self, mock_get, mock_index):
+
+        mock_get.return_value = {'items': [{'id': 'pool-1',
+                                            'display_name': 'pool-1',
+                                            'ranges': [{'first': 1,
+                                                        'last': 2}]}]}
+        mock_index.return_value = aos.PoolIndex(
+            {'asn': mock_get.return_value['items']})
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'check_conflicts': True,
+                         'pools': [{'name': 'pool-1', 'ranges': [[1, 5]]},
+                                   {'name': 'pool-2', 'ranges': [[2, 3]]}]}
+
+        with pytest.raises(SystemExit):
+            aos_asn_pool.asn_pool_bulk(module)
+
+        module.fail_json.assert_called_once_with(
+            msg=["Invalid range: [2, 3] overlaps [1, 5]",
+                 "Invalid range: [2, 3] overlaps [1, 2] in asn pool pool-1"])
+
+
+class TestAsnPoolPresent(object):
+
+    my_pool = {'id': 'pool-1',
+               'display_name': 'pool-1',
+               'status': 'not_in_use',
+               'ranges': [{'first': 100, 'last': 200}]}
+
+    @mock.patch('library.aos_asn_pool.aos_put')
+    def test_asn_pool_present_unchanged(self, mock_put):
+
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'name': 'pool-1', 'ranges': [[100, 200]]}
+
+        assert aos_asn_pool.asn_pool_present(module, 'session', self.my_pool) == \
+            (True, False, self.my_pool)
+        assert not mock_put.called
+
+    @mock.patch('library.aos_asn_pool.aos_put')
+    def test_asn_pool_present_extended(self, mock_put):
+
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'name': 'pool-1', 'ranges': [[100, 200], [300, 400]]}
+
+        success, changed, results = aos_asn_pool.asn_pool_present(
+            module, 'session', self.my_pool)
+
+        assert changed
+        mock_put.assert_called_once_with(
+            'session', 'resources/asn-pools/pool-1',
+            {'ranges': [{'first': 100, 'last': 200},
+                        {'first': 300, 'last': 400}],
+             'display_name': 'pool-1',
+             'id': 'pool-1'})
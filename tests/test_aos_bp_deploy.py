@@ -1,7 +1,9 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
 import mock
+import pytest
 import library.aos_bp_deploy as aos_bp_deploy
+from library.aos import deploy_done
 
 
 @mock.patch('library.aos_bp_deploy.aos_bp_deploy')
@@ -16,8 +18,145 @@ def test_module_args(mock_module,
         argument_spec={
             'session': {'required': True, 'type': 'dict'},
             'name': {'required': False},
-            'id': {'required': False}
+            'id': {'required': False},
+            'wait': {'required': False, 'type': 'bool', 'default': False},
+            'timeout': {'required': False, 'type': 'int', 'default': 600},
+            'poll_interval': {'required': False, 'type': 'float',
+                              'default': 2},
+            'handle': {'required': False, 'type': 'dict'},
+            'blueprints': {'required': False, 'type': 'list'},
+            'concurrency': {'required': False, 'type': 'int', 'default': 8}
         },
-        mutually_exclusive=[('name', 'id')],
-        required_one_of=[('name', 'id')],
+        mutually_exclusive=[('name', 'id', 'handle', 'blueprints')],
+        required_one_of=[('name', 'id', 'handle', 'blueprints')],
         supports_check_mode=False)
+
+
+class TestBpDeployWait(object):
+
+    def make_module(self, **params):
+        module = mock.MagicMock()
+        module.exit_json.side_effect = SystemExit
+        module.fail_json.side_effect = SystemExit
+        module.params = dict({'session': 'session', 'name': None,
+                              'id': 'bp-1', 'wait': True, 'timeout': 60,
+                              'poll_interval': 0.01, 'handle': None,
+                              'blueprints': None, 'concurrency': 4},
+                             **params)
+        return module
+
+    def test_deploy_done(self):
+
+        assert deploy_done({'version': 2, 'state': 'success'}, 2)
+        assert not deploy_done({'version': 1, 'state': 'success'}, 2)
+        assert not deploy_done({'version': 2, 'state': 'init'}, 2)
+
+    def test_deploy_invalid_poll_interval(self):
+
+        module = self.make_module(poll_interval=0)
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        module.fail_json.assert_called_with(
+            msg="Invalid poll_interval: must be greater than 0")
+
+    @mock.patch('library.aos.aos_put')
+    @mock.patch('library.aos.get_blueprint_version')
+    @mock.patch('library.aos.get_blueprint_status')
+    def test_deploy_wait(self, mock_status, mock_version, mock_put):
+
+        mock_version.return_value = 2
+        mock_status.side_effect = [{'version': 1, 'state': 'success'},
+                                   {'version': 1, 'state': 'success'},
+                                   {'version': 2, 'state': 'init'},
+                                   {'version': 2, 'state': 'success'}]
+        module = self.make_module()
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        mock_put.assert_called_once_with('session', 'blueprints/bp-1/deploy',
+                                         {'version': 2})
+        result = module.exit_json.call_args[1]
+        assert result['changed']
+        assert result['deploy_done']
+        assert result['deploy_state'] == 'success'
+        assert result['deploy_handle'] == {'blueprint_id': 'bp-1',
+                                           'version': 2}
+
+    @mock.patch('library.aos.get_blueprint_status')
+    def test_deploy_handle_timeout(self, mock_status):
+
+        mock_status.return_value = {'version': 2, 'state': 'init'}
+        module = self.make_module(id=None, timeout=0,
+                                  handle={'blueprint_id': 'bp-1',
+                                          'version': 2})
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        assert module.fail_json.call_args[1]['msg'].startswith(
+            "Timed out after 0 seconds deploying blueprint bp-1")
+
+    @mock.patch('library.aos.get_blueprint_status')
+    def test_deploy_handle_check(self, mock_status):
+
+        mock_status.return_value = {'version': 2, 'state': 'init'}
+        module = self.make_module(id=None, wait=False,
+                                  handle={'blueprint_id': 'bp-1',
+                                          'version': 2})
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        result = module.exit_json.call_args[1]
+        assert not result['changed']
+        assert not result['deploy_done']
+
+
+class TestBpDeployBulk(object):
+
+    blueprints = {'items': [{'id': 'bp-1', 'label': 'DC1'},
+                            {'id': 'bp-2', 'label': 'DC2'},
+                            {'id': 'bp-3', 'label': 'DC3'},
+                            {'id': 'bp-4', 'label': 'DC3'}]}
+
+    def test_resolve_blueprints(self):
+
+        found, errors = aos_bp_deploy.resolve_blueprints(
+            self.blueprints, ['DC1', 'bp-2', {'name': 'DC3'}, {'id': 'bp-4'},
+                              'DC9'])
+
+        assert found == [('DC1', 'bp-1'), ('DC2', 'bp-2'), ('DC3', 'bp-4')]
+        assert errors == ["Multiple blueprints found with label DC3",
+                          "Blueprint not found: DC9"]
+
+    @mock.patch('library.aos_bp_deploy.deploy_blueprint')
+    @mock.patch('library.aos_bp_deploy.aos_get')
+    def test_deploy_bulk(self, mock_get, mock_deploy):
+
+        mock_get.return_value = self.blueprints
+
+        def deploy(session, blueprint_id, *args):
+            if blueprint_id == 'bp-2':
+                raise ValueError('boom')
+            return {'id': blueprint_id, 'success': True, 'changed': True}
+
+        mock_deploy.side_effect = deploy
+        module = mock.MagicMock()
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session', 'blueprints': ['DC1', 'DC2'],
+                         'concurrency': 2, 'wait': False, 'timeout': 60,
+                         'poll_interval': 1}
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        mock_get.assert_called_once_with('session', 'blueprints')
+        result = module.fail_json.call_args[1]
+        assert result['msg'] == "Unable to deploy 1 blueprint(s)"
+        assert result['changed']
+        assert [(r['name'], r['success']) for r in result['blueprints']] == \
+            [('DC1', True), ('DC2', False)]
+        assert result['blueprints'][1]['msg'] == "ValueError: boom"
@@ -0,0 +1,225 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+import mock
+import pytest
+import library.aos_bp_reconcile as aos_reconcile
+from library.aos import ResourceIndex, VN_DEFAULTS
+
+
+NODES = [{'id': 'node-1', 'label': 'rack_001_leaf1', 'role': 'leaf'}]
+
+ZONES = {'items': {
+    'sz-default': {'id': 'sz-default', 'label': 'default',
+                   'sz_type': 'l3_fabric'},
+    'sz-1': {'id': 'sz-1', 'label': 'tenant-a', 'vrf_name': 'tenant-a',
+             'sz_type': 'evpn', 'vni_id': 5000},
+    'sz-2': {'id': 'sz-2', 'label': 'old-tenant', 'vrf_name': 'old-tenant',
+             'sz_type': 'evpn'}}}
+
+VNS = {'virtual_networks': {
+    'vn-1': {'id': 'vn-1', 'label': 'web', 'vn_type': 'vxlan',
+             'security_zone_id': 'sz-1', 'bound_to': [],
+             'dhcp_service': 'dhcpServiceDisabled'},
+    'vn-2': {'id': 'vn-2', 'label': 'old-web', 'vn_type': 'vxlan',
+             'security_zone_id': 'sz-2', 'bound_to': [],
+             'dhcp_service': 'dhcpServiceDisabled'}}}
+
+
+def sz_spec(**kwargs):
+    return dict(aos_reconcile.SZ_DEFAULTS, **kwargs)
+
+
+def vn_spec(**kwargs):
+    return dict(dict(VN_DEFAULTS, security_zone=None), **kwargs)
+
+
+def build_plan(sz_specs, vn_specs, purge=False, vn_data=VNS):
+    return aos_reconcile.build_plan(ZONES, vn_data, sz_specs, vn_specs,
+                                    ResourceIndex(NODES), purge)
+
+
+class TestReconcilePlan(object):
+
+    def test_plan_order(self):
+
+        plan, errors = build_plan(
+            [sz_spec(name='tenant-b'), sz_spec(name='old-tenant',
+                                               state='absent')],
+            [vn_spec(name='app', vn_type='vxlan', security_zone='tenant-b',
+                     bound_to_name=['rack_001_leaf1']),
+             vn_spec(name='old-web', state='absent')])
+
+        assert errors == []
+        assert [(s['kind'], s['action'], s['name']) for s in plan] == [
+            ('security_zone', 'create', 'tenant-b'),
+            ('virtual_network', 'create', 'app'),
+            ('virtual_network', 'delete', 'old-web'),
+            ('security_zone', 'delete', 'old-tenant')]
+        assert plan[1]['security_zone'] == 'tenant-b'
+        assert plan[1]['payload']['bound_to'] == [{'system_id': 'node-1'}]
+
+    def test_plan_existing_zone(self):
+
+        plan, errors = build_plan([], [vn_spec(name='app', vn_type='vxlan',
+                                               security_zone='tenant-a')])
+
+        assert errors == []
+        assert plan[0]['security_zone'] is None
+        assert plan[0]['payload']['security_zone_id'] == 'sz-1'
+
+    def test_plan_up_to_date(self):
+
+        plan, errors = build_plan([sz_spec(name='tenant-a', vni_id=5000)],
+                                  [vn_spec(name='web', vn_type='vxlan')])
+
+        assert (plan, errors) == ([], [])
+
+    def test_plan_zone_update(self):
+
+        plan, errors = build_plan([sz_spec(name='tenant-a', vni_id=6000)], [])
+
+        assert [(s['action'], s['id']) for s in plan] == [('update', 'sz-1')]
+        assert plan[0]['payload']['vni_id'] == 6000
+
+    def test_plan_missing_zone(self):
+
+        plan, errors = build_plan([], [vn_spec(name='app',
+                                               security_zone='unknown')])
+
+        assert plan == []
+        assert errors == ["Security zone unknown of virtual network app is "
+                          "not in the blueprint or removed"]
+
+    def test_plan_zone_move(self):
+
+        plan, errors = build_plan(
+            [sz_spec(name='tenant-b')],
+            [vn_spec(name='web', vn_type='vxlan', security_zone='old-tenant'),
+             vn_spec(name='old-web', vn_type='vxlan',
+                     security_zone='tenant-b')])
+
+        assert errors == ["Virtual network web is in security zone tenant-a, "
+                          "it cannot be moved to old-tenant",
+                          "Virtual network old-web is in security zone "
+                          "old-tenant, it cannot be moved to tenant-b"]
+
+    def test_plan_vn_type_change(self):
+
+        plan, errors = build_plan([], [vn_spec(name='web', vn_type='vlan',
+                                               security_zone='tenant-a')])
+
+        assert plan == []
+        assert errors == ["Virtual network web is of type vxlan, it cannot "
+                          "be changed to vlan"]
+
+    def test_plan_vn_update(self):
+
+        plan, errors = build_plan([], [vn_spec(name='web', vn_type='vxlan',
+                                               security_zone='tenant-a',
+                                               dhcp_service=True)])
+
+        assert errors == []
+        assert [(s['action'], s['id']) for s in plan] == [('update', 'vn-1')]
+        assert plan[0]['payload']['dhcp_service'] == 'dhcpServiceEnabled'
+
+    def test_plan_vn_cleared_setting(self):
+
+        web = dict(VNS['virtual_networks']['vn-1'], ipv4_enabled=True,
+                   ipv4_subnet='10.1.0.0/24')
+        plan, errors = build_plan([], [vn_spec(name='web', vn_type='vxlan')],
+                                  vn_data={'virtual_networks': {'vn-1': web}})
+
+        assert [(s['action'], s['id']) for s in plan] == [('update', 'vn-1')]
+        assert 'ipv4_subnet' not in plan[0]['payload']
+
+    def test_plan_zone_in_use(self):
+
+        plan, errors = build_plan([sz_spec(name='old-tenant',
+                                           state='absent')], [])
+
+        assert errors == ["Security zone old-tenant is still used by "
+                          "virtual network(s) old-web"]
+
+    def test_plan_purge(self):
+
+        plan, errors = build_plan([sz_spec(name='tenant-a')],
+                                  [vn_spec(name='web', vn_type='vxlan')],
+                                  purge=True)
+
+        assert errors == []
+        # The default zone is not a tenant zone and stays
+        assert [(s['action'], s['id']) for s in plan] == [('delete', 'vn-2'),
+                                                          ('delete', 'sz-2')]
+
+
+class TestReconcileRun(object):
+
+    @mock.patch('library.aos_bp_reconcile.aos_post')
+    def test_run_plan_skips_after_failure(self, mock_post):
+
+        mock_post.side_effect = ValueError('refused')
+        plan, _ = build_plan([sz_spec(name='tenant-b')],
+                             [vn_spec(name='app', security_zone='tenant-b')])
+
+        failed = aos_reconcile.run_plan('session', 'bp', plan, {})
+
+        assert failed == [plan[0]]
+        assert [s['status'] for s in plan] == ['failed', 'skipped']
+        assert plan[0]['error'] == 'ValueError: refused'
+        assert mock_post.call_count == 1
+
+    @mock.patch('library.aos_bp_reconcile.aos_post')
+    def test_run_plan_resolves_zone(self, mock_post):
+
+        mock_post.side_effect = [{'id': 'sz-3'}, {'id': 'vn-3'}]
+        plan, _ = build_plan([sz_spec(name='tenant-b')],
+                             [vn_spec(name='app', security_zone='tenant-b')])
+
+        assert aos_reconcile.run_plan('session', 'bp', plan, {}) == []
+        assert mock_post.call_args[0][2]['security_zone_id'] == 'sz-3'
+        assert [s['id'] for s in plan] == ['sz-3', 'vn-3']
+
+    @mock.patch('library.aos_bp_reconcile.aos_post')
+    @mock.patch('library.aos_bp_reconcile.blueprint_get')
+    def test_reconcile_check_mode(self, mock_get, mock_post):
+
+        mock_get.side_effect = [ZONES, VNS]
+        module = mock.MagicMock(check_mode=True)
+        module.exit_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'blueprint_id': 'bp',
+                         'security_zones': [{'name': 'tenant-b'}],
+                         'virtual_networks': [],
+                         'purge': False,
+                         'deploy': True,
+                         'poll_interval': 5,
+                         'concurrency': 4}
+
+        with pytest.raises(SystemExit):
+            aos_reconcile.aos_bp_reconcile(module)
+
+        result = module.exit_json.call_args[1]
+        assert result['changed']
+        assert [s['status'] for s in result['plan']] == ['planned']
+        assert not mock_post.called
+
+    def test_reconcile_invalid_specs(self):
+
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'blueprint_id': 'bp',
+                         'security_zones': [{'name': 'a', 'vni_id': 'x'},
+                                            {'name': 'a'}],
+                         'virtual_networks': [{'name': 'b',
+                                               'vn_type': 'gre'}],
+                         'poll_interval': -1}
+
+        with pytest.raises(SystemExit):
+            aos_reconcile.aos_bp_reconcile(module)
+
+        assert module.fail_json.call_args[1]['msg'] == [
+            "Duplicate security-zone: a",
+            "Invalid ID: must be an integer",
+            "Invalid vn_type: gre",
+            "Invalid poll_interval: must be greater than 0"]
@@ -0,0 +1,218 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+import mock
+import pytest
+import library.aos_bp_virtual_networks as aos_vn
+from library.aos import ResourceIndex, vn_add_options
+
+
+NODES = [{'id': 'node-1', 'label': 'rack_001_leaf1', 'role': 'leaf'},
+         {'id': 'node-2', 'label': 'rack_002_leaf1', 'role': 'leaf'}]
+
+
+def vn_spec(**kwargs):
+    return dict(aos_vn.VN_DEFAULTS, **kwargs)
+
+
+class TestVnValidate(object):
+
+    def test_vn_validate_valid_vlan(self):
+
+        assert aos_vn.validate_virtual_network(vn_spec(vn_id='101')) == (101, [])
+
+    def test_vn_validate_invalid_vni(self):
+
+        vn_id, errors = aos_vn.validate_virtual_network(
+            vn_spec(vn_id=101, vn_type='vxlan'))
+        assert errors == [["Invalid ID: must be a valid VNI number between "
+                           "4096 and 16777214"]]
+
+    def test_vn_validate_not_integer(self):
+
+        vn_id, errors = aos_vn.validate_virtual_network(vn_spec(vn_id='abc'))
+        assert errors == ["Invalid ID: must be an integer"]
+
+    def test_vn_validate_invalid_gateway(self):
+
+        vn_id, errors = aos_vn.validate_virtual_network(
+            vn_spec(virtual_gw_ipv4='fe80::1'))
+        assert errors == [["fe80::1 is not a valid ipv4 address or subnet"]]
+
+
+class TestVnBoundTo(object):
+
+    def test_vn_bound_to_id(self):
+
+        spec = vn_spec(bound_to_id=['node-9'])
+        assert aos_vn.get_bound_to(spec, ResourceIndex([])) == [
+            {'system_id': 'node-9'}]
+
+    def test_vn_bound_to_name(self):
+
+        spec = vn_spec(bound_to_name=['rack_002_leaf1', 'unknown'])
+        assert aos_vn.get_bound_to(spec, ResourceIndex(NODES)) == [
+            {'system_id': 'node-2'}]
+
+
+class TestVnBulk(object):
+
+    @mock.patch('library.aos_bp_virtual_networks.aos_post')
+    @mock.patch('library.aos_bp_virtual_networks.aos_delete')
+    @mock.patch('library.aos_bp_virtual_networks.find_bp_system_nodes')
+    @mock.patch('library.aos.aos_get')
+    def test_vn_bulk(self, mock_get, mock_nodes, mock_delete, mock_post):
+
+        mock_get.return_value = {'virtual_networks': {
+            'vn-1': {'id': 'vn-1', 'label': 'old-vn', 'vn_type': 'vlan'}}}
+        mock_nodes.return_value = NODES
+        mock_post.return_value = {'id': 'vn-2'}
+
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'session': 'session',
+                         'blueprint_id': 'bp',
+                         'concurrency': 4,
+                         'virtual_networks': [
+                             {'name': 'new-vn',
+                              'bound_to_name': ['rack_001_leaf1',
+                                                'rack_002_leaf1']},
+                             {'name': 'old-vn', 'state': 'absent'}]}
+
+        aos_vn.virtual_network_bulk(module)
+
+        mock_nodes.assert_called_once_with('session', 'bp',
+                                           ['rack_001_leaf1', 'rack_002_leaf1'])
+        mock_get.assert_called_once_with('session',
+                                         'blueprints/bp/virtual-networks')
+        mock_delete.assert_called_once_with(
+            'session', 'blueprints/bp/virtual-networks', 'vn-1')
+        assert mock_post.call_args[0][2]['bound_to'] == [
+            {'system_id': 'node-1'}, {'system_id': 'node-2'}]
+
+        results = module.exit_json.call_args[1]['virtual_networks']
+        assert [(r['name'], r['id'], r['changed']) for r in results] == [
+            ('new-vn', 'vn-2', True), ('old-vn', 'vn-1', True)]
+
+    @mock.patch('library.aos_bp_virtual_networks.aos_put')
+    @mock.patch('library.aos_bp_virtual_networks.aos_delete')
+    @mock.patch('library.aos.aos_get')
+    def test_vn_bulk_write_failed(self, mock_get, mock_delete, mock_put):
+
+        mock_get.return_value = {'virtual_networks': {
+            'vn-1': {'id': 'vn-1', 'label': 'web', 'vn_type': 'vlan'},
+            'vn-2': {'id': 'vn-2', 'label': 'old-vn', 'vn_type': 'vlan'}}}
+        mock_put.return_value = mock.MagicMock(ok=False, status_code=422,
+                                               text='invalid vn_id')
+        mock_delete.return_value = mock.MagicMock(ok=False, status_code=409,
+                                                  text='in use')
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'blueprint_id': 'bp',
+                         'concurrency': 4,
+                         'virtual_networks': [
+                             {'name': 'web', 'vn_id': 101},
+                             {'name': 'old-vn', 'state': 'absent'}]}
+
+        with pytest.raises(SystemExit):
+            aos_vn.virtual_network_bulk(module)
+
+        result = module.fail_json.call_args[1]
+        assert not result['changed']
+        assert [(r['success'], r['value']['msg'])
+                for r in result['virtual_networks']] == [
+            (False, "Unable to update virtual network web: 422 invalid vn_id"),
+            (False, "Unable to delete virtual network old-vn: 409 in use")]
+
+    @mock.patch('library.aos_bp_virtual_networks.find_bp_system_nodes')
+    def test_vn_bulk_unknown_node(self, mock_nodes):
+
+        mock_nodes.return_value = NODES[:1]
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'blueprint_id': 'bp',
+                         'concurrency': 4,
+                         'virtual_networks': [
+                             {'name': 'new-vn',
+                              'bound_to_name': ['rack_001_leaf1',
+                                                'rack_002_leaf1']}]}
+
+        with pytest.raises(SystemExit):
+            aos_vn.virtual_network_bulk(module)
+
+        module.fail_json.assert_called_once_with(
+            msg="System Node not found by name: rack_002_leaf1")
+
+
+class TestVnChanges(object):
+
+    my_vn = {'id': 'vn-1',
+             'label': 'vlan-101',
+             'vn_type': 'vlan',
+             'vn_id': '101',
+             'bound_to': [{'system_id': 'node-1', 'vlan_id': 101},
+                          {'system_id': 'node-2', 'vlan_id': 101}],
+             'ipv6_subnet': '2005::/64',
+             'virtual_gw_ipv6': '2005::1',
+             'dhcp_service': 'dhcpServiceDisabled'}
+
+    def test_vn_changes_none(self):
+
+        new_vn = {'id': 'vn-1',
+                  'label': 'vlan-101',
+                  'vn_type': 'vlan',
+                  'vn_id': 101,
+                  'bound_to': [{'system_id': 'node-2'},
+                               {'system_id': 'node-1'}],
+                  'ipv6_subnet': '2005:0:0:0::/64',
+                  'virtual_gw_ipv6': '2005:0::1',
+                  'dhcp_service': 'dhcpServiceDisabled'}
+        assert aos_vn.virt_net_changes(self.my_vn, new_vn) == []
+
+    def test_vn_changes_detected(self):
+
+        new_vn = {'vn_id': '101',
+                  'bound_to': [{'system_id': 'node-1'}],
+                  'ipv4_subnet': '10.1.1.0/24',
+                  'ipv6_subnet': '2005::/64',
+                  'virtual_gw_ipv6': '2005::1',
+                  'dhcp_service': 'dhcpServiceDisabled'}
+        assert aos_vn.virt_net_changes(self.my_vn, new_vn) == ['bound_to',
+                                                               'ipv4_subnet']
+
+    def test_vn_changes_cleared(self):
+
+        my_vn = {'id': 'vn-2', 'label': 'vlan-102', 'vn_type': 'vlan',
+                 'vn_id': '102', 'ipv4_enabled': True,
+                 'ipv4_subnet': '10.1.0.0/24', 'virtual_gw_ipv4': '10.1.0.1',
+                 'dhcp_service': 'dhcpServiceEnabled', 'bound_to': []}
+        new_vn = {'id': 'vn-2', 'label': 'vlan-102', 'vn_type': 'vlan',
+                  'bound_to': []}
+        vn_add_options(new_vn, None, False, False, None, None, None, None,
+                       False)
+
+        assert aos_vn.virt_net_changes(my_vn, new_vn) == [
+            'dhcp_service', 'ipv4_enabled', 'ipv4_subnet', 'virtual_gw_ipv4',
+            'vn_id']
+
+    def test_vn_changes_unset_equal(self):
+
+        my_vn = {'id': 'vn-3', 'label': 'vlan-103', 'vn_type': 'vlan',
+                 'ipv4_enabled': False, 'ipv6_subnet': None}
+        new_vn = {'bound_to': [], 'dhcp_service': 'dhcpServiceDisabled'}
+
+        assert aos_vn.virt_net_changes(my_vn, new_vn) == []
+
+    @mock.patch('library.aos_bp_virtual_networks.aos_put')
+    def test_vn_present_skips_unchanged(self, mock_put):
+
+        module = mock.MagicMock(check_mode=False)
+        module.params = vn_spec(name='vlan-101')
+
+        result = aos_vn.virt_net_present(
+            module, 'session', 'endpoint', self.my_vn, 101, None, False, False,
+            None, '2005::/64', None, '2005::1',
+            [{'system_id': 'node-1'}, {'system_id': 'node-2'}], False)
+
+        assert result == (True, False, self.my_vn)
+        assert not mock_put.called
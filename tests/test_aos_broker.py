@@ -0,0 +1,93 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+import json
+import threading
+import pytest
+import requests
+from mock import patch
+import library.aos as aos
+from library.aos_broker import BrokerServer
+
+
+def mock_response(status, body):
+    response = requests.Response()
+    response.status_code = status
+    response.encoding = 'utf-8'
+    response._content = json.dumps(body).encode('utf-8')
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@pytest.fixture
+def broker(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'aos-broker.sock')
+    server = BrokerServer(socket_path, idle_timeout=60)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    monkeypatch.setenv('AOS_BROKER_SOCKET', socket_path)
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class TestBroker(object):
+
+    @patch('library.aos.requests.Session.request')
+    def test_broker_relays_get(self, mock_request, broker):
+
+        mock_request.return_value = mock_response(200, {'items': []})
+        test_session = {'server': 'aos-server', 'token': 'token'}
+
+        assert aos.aos_get(test_session, 'resources/asn-pools') == {'items': []}
+        assert mock_request.call_args[0] == \
+            ('GET', 'https://aos-server/api/resources/asn-pools')
+
+    @patch('library.aos.requests.Session.request')
+    def test_broker_relays_put_response(self, mock_request, broker):
+
+        mock_request.return_value = mock_response(422, {'errors': 'bad'})
+        test_session = {'server': 'aos-server', 'token': 'token'}
+
+        response = aos.aos_put(test_session, 'blueprints/bp/deploy', {})
+        assert not response.ok
+        assert response.json() == {'errors': 'bad'}
+
+    @patch('library.aos.requests.Session.request')
+    def test_broker_holds_login_token(self, mock_request, broker):
+
+        mock_request.return_value = mock_response(201, {'token': 'abc'})
+        aos.aos_request({'server': 'aos-server'}, 'POST', 'user/login',
+                        {'username': 'admin', 'password': 'admin'},
+                        headers={'Content-Type': 'application/json'})
+
+        assert aos.broker_token('aos-server', 'admin', 'admin') == 'abc'
+        assert aos.broker_token('aos-server', 'other', 'admin') is None
+
+    @patch('library.aos.requests.Session.request')
+    def test_broker_token_password_checked(self, mock_request, broker):
+
+        mock_request.return_value = mock_response(201, {'token': 'abc'})
+        aos.aos_request({'server': 'aos-server'}, 'POST', 'user/login',
+                        {'username': 'admin', 'password': 'admin'},
+                        headers={'Content-Type': 'application/json'})
+
+        assert 'admin' not in json.dumps(broker.tokens[('aos-server',
+                                                        'admin')])
+        assert aos.broker_token('aos-server', 'admin', 'wrong') is None
+        assert aos.broker_token('aos-server', 'admin', '') is None
+
+    @patch('library.aos.requests.Session.request')
+    def test_broker_forgets_rejected_token(self, mock_request, broker):
+
+        broker.tokens[('aos-server', 'admin')] = aos.token_entry('abc',
+                                                                 'admin')
+        mock_request.return_value = mock_response(401, {'errors': 'expired'})
+
+        aos.aos_request({'server': 'aos-server', 'token': 'abc'},
+                        'GET', 'blueprints')
+
+        assert aos.broker_token('aos-server', 'admin', 'admin') is None
+        assert broker.tokens == {}
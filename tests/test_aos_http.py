@@ -0,0 +1,85 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+import pytest
+import requests
+from mock import MagicMock
+from urllib3.exceptions import MaxRetryError, NewConnectionError, \
+    ConnectTimeoutError, ReadTimeoutError
+from library.aos_http import Urllib3Response, Urllib3Session, \
+    requests_error, TRACED_POOL_CLASSES
+
+
+def make_response(status=200, body=b'{"id": "a"}'):
+    raw = MagicMock(status=status, reason='Not Found', headers={})
+    raw.read.return_value = body
+    raw.stream.return_value = iter([body])
+
+    return Urllib3Response(raw, 'https://aos-server/api/a', 0.01)
+
+
+class TestRequestsError(object):
+
+    def test_connection_error(self):
+
+        error = MaxRetryError(None, '/api/a',
+                              NewConnectionError(None, 'refused'))
+
+        assert type(requests_error(error)) is requests.ConnectionError
+
+    def test_timeouts(self):
+
+        connect = MaxRetryError(None, '/api/a',
+                                ConnectTimeoutError(None, 'slow'))
+        read = ReadTimeoutError(None, '/api/a', 'slow')
+
+        assert type(requests_error(connect)) is requests.ConnectTimeout
+        assert type(requests_error(read)) is requests.ReadTimeout
+
+
+class TestUrllib3Response(object):
+
+    def test_json(self):
+
+        response = make_response()
+
+        assert response.ok
+        assert response.json() == {'id': 'a'}
+        assert response.elapsed.total_seconds() == 0.01
+        response.raw.release_conn.assert_called_once_with()
+        assert not response.raw.close.called
+
+    def test_raise_for_status(self):
+
+        response = make_response(404)
+
+        with pytest.raises(requests.HTTPError) as error:
+            response.raise_for_status()
+
+        assert error.value.response is response
+        assert str(error.value).startswith('404 Client Error')
+
+    def test_close_unread_stream(self):
+
+        response = make_response()
+        next(response.iter_content(10))
+        response.close()
+
+        response.raw.close.assert_called_once_with()
+
+    def test_close_read_stream(self):
+
+        response = make_response()
+        list(response.iter_content(10))
+        response.close()
+
+        assert not response.raw.close.called
+
+
+class TestUrllib3Session(object):
+
+    def test_traced_pools(self):
+
+        http = Urllib3Session(retries=0, size=2, verify=False)
+
+        assert http.manager.pool_classes_by_scheme is TRACED_POOL_CLASSES
+        assert http.manager.connection_pool_kw['cert_reqs'] == 'CERT_NONE'
@@ -1,5 +1,7 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
+import mock
+import pytest
 import library.aos_ip_pool as aos_ip_pool
 
 
@@ -62,6 +64,15 @@ class TestIpv6PoolValidate(object):
                                             ADDR_TYPE_V6) == ['Invalid subnet: '
                                                               'fe80:0:g:1::/64']
 
+    def test_ipv6_validate_overlap(self):
+
+        test_range = ['fe80:0:0:1::/64', 'fe80:0:0:1::/64']
+        assert aos_ip_pool.validate_subnets(test_range,
+                                            ADDR_TYPE_V6) == ['Invalid subnet: '
+                                                              'fe80:0:0:1::/64 '
+                                                              'overlaps '
+                                                              'fe80:0:0:1::/64']
+
 
 class TestIpGetSubnet(object):
 
@@ -82,3 +93,74 @@ class TestIpGetSubnet(object):
         assert aos_ip_pool.get_subnets(test_subnet) == [{'network':
                                                         ['192.168.59.0/24',
                                                          '10.10.10.0/23']}]
+
+
+class TestIpPoolBulk(object):
+
+    @mock.patch('library.aos_ip_pool.aos_delete')
+    @mock.patch('library.aos_ip_pool.aos_put')
+    @mock.patch('library.aos_ip_pool.aos_post')
+    @mock.patch('library.aos.aos_get')
+    def test_ip_pool_bulk_ipv6(self, mock_get, mock_post, mock_put,
+                               mock_delete):
+
+        mock_get.return_value = {'items': [{'id': 'ip-1',
+                                            'display_name': 'ip-1',
+                                            'status': 'not_in_use',
+                                            'subnets': [
+                                                {'network': '2001:db8::/64'}]},
+                                           {'id': 'ip-2',
+                                            'display_name': 'ip-2',
+                                            'status': 'not_in_use',
+                                            'subnets': []}]}
+        mock_put.return_value = mock.MagicMock(ok=True)
+        mock_delete.return_value = mock.MagicMock(ok=True)
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'session': 'session',
+                         'ip_version': ADDR_TYPE_V6,
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'ip-1',
+                                    'subnets': ['2001:db8:1::/64']},
+                                   {'name': 'ip-2', 'state': 'absent'},
+                                   {'name': 'ip-3',
+                                    'subnets': ['2001:db8:2::/64']}]}
+
+        aos_ip_pool.ip_pool_bulk(module)
+
+        # Every request goes to the endpoint of the IP version
+        mock_get.assert_called_once_with('session', aos_ip_pool.V6_ENDPOINT)
+        assert mock_put.call_args[0][1] == aos_ip_pool.V6_ENDPOINT + '/ip-1'
+        assert mock_put.call_args[0][2]['subnets'] == [
+            {'network': '2001:db8::/64'}, {'network': '2001:db8:1::/64'}]
+        mock_delete.assert_called_once_with('session',
+                                            aos_ip_pool.V6_ENDPOINT, 'ip-2')
+        assert mock_post.call_args[0][1] == aos_ip_pool.V6_ENDPOINT
+        assert module.exit_json.call_args[1]['changed']
+
+    @mock.patch('library.aos_ip_pool.aos_put')
+    @mock.patch('library.aos.aos_get')
+    def test_ip_pool_bulk_update_failed(self, mock_get, mock_put):
+
+        mock_get.return_value = {'items': [{'id': 'ip-1',
+                                            'display_name': 'ip-1',
+                                            'status': 'not_in_use',
+                                            'subnets': []}]}
+        mock_put.return_value = mock.MagicMock(ok=False, status_code=409,
+                                               text='conflict')
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'ip_version': ADDR_TYPE_V4,
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'ip-1',
+                                    'subnets': ['10.0.0.0/24']}]}
+
+        with pytest.raises(SystemExit):
+            aos_ip_pool.ip_pool_bulk(module)
+
+        result = module.fail_json.call_args[1]
+        assert result['msg'] == "Unable to manage 1 IP Pool(s)"
+        assert result['pools'][0]['value']['msg'] == \
+            "Unable to update IP Pool ip-1: 409 conflict"
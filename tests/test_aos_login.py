@@ -1,6 +1,6 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
-from ansible.compat.tests.mock import patch
+from ansible.compat.tests.mock import patch, MagicMock
 import library.aos_login as aos_login
 
 
@@ -22,6 +22,7 @@ def test_module_args(mock_module, mock_aos_login):
     """
     aos_login - test module arguments
     """
+    mock_aos_login.return_value = ({}, False)
     aos_login.main()
     mock_module.assert_called_with(
         argument_spec={
@@ -43,3 +44,45 @@ def test_aos_login_success(mock_module, mock_aos_login):
     mock_aos_login.return_value = mock_session
     resp = aos_login.aos_login(mock_module)
     assert resp == mock_session
+
+
+@patch('library.aos_login.aos_token')
+@patch('library.aos_login.token_expiring')
+@patch('library.aos_login.broker_token')
+@patch('library.aos_login.broker_socket')
+def test_aos_login_broker_token(mock_socket, mock_broker_token,
+                                mock_expiring, mock_aos_token):
+    """
+    aos_login - reuse the token held by the broker
+    """
+    mock_module = MagicMock(params={'server': 'foo', 'user': 'admin',
+                                    'passwd': 'admin'})
+    mock_socket.return_value = '/tmp/aos-broker.sock'
+    mock_broker_token.return_value = 'old'
+    mock_expiring.return_value = False
+
+    assert aos_login.aos_login(mock_module) == (
+        {'server': 'foo', 'user': 'admin', 'token': 'old'}, False)
+    mock_broker_token.assert_called_with('foo', 'admin', 'admin')
+    assert not mock_aos_token.called
+
+
+@patch('library.aos_login.aos_token')
+@patch('library.aos_login.token_expiring')
+@patch('library.aos_login.broker_token')
+@patch('library.aos_login.broker_socket')
+def test_aos_login_broker_token_expiring(mock_socket, mock_broker_token,
+                                         mock_expiring, mock_aos_token):
+    """
+    aos_login - log in again when the broker token is about to expire
+    """
+    mock_module = MagicMock(params={'server': 'foo', 'user': 'admin',
+                                    'passwd': 'admin'})
+    mock_socket.return_value = '/tmp/aos-broker.sock'
+    mock_broker_token.return_value = 'old'
+    mock_expiring.return_value = True
+    mock_aos_token.return_value = ('new', True)
+
+    assert aos_login.aos_login(mock_module) == (
+        {'server': 'foo', 'user': 'admin', 'token': 'new'}, True)
+    mock_expiring.assert_called_with('old')
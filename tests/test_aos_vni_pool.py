@@ -1,5 +1,7 @@
 # Copyright (c) 2017 Apstra Inc, <community@apstra.com>
 
+import mock
+import pytest
 import library.aos_vni_pool as aos_vni_pool
 
 
@@ -70,3 +72,88 @@ class TestVniGetRange(object):
                                                         'last': 4200},
                                                        {'first': 4396,
                                                         'last': 4500}]
+
+    def test_vni_get_range_coalesce(self):
+
+        test_range = [[5000, 6000], [4096, 4200], [4201, 4500]]
+        assert aos_vni_pool.get_ranges(test_range) == [{'first': 4096,
+                                                        'last': 4500},
+                                                       {'first': 5000,
+                                                        'last': 6000}]
+
+    def test_vni_validate_overlap(self):
+
+        test_range = [[4096, 4200], [4150, 4300]]
+        assert aos_vni_pool.validate_ranges(test_range) == ['Invalid range: '
+                                                            '[4150, 4300] '
+                                                            'overlaps '
+                                                            '[4096, 4200]']
+
+
+class TestVniPoolBulk(object):
+
+    @mock.patch('library.aos_vni_pool.aos_delete')
+    @mock.patch('library.aos_vni_pool.aos_put')
+    @mock.patch('library.aos_vni_pool.aos_post')
+    @mock.patch('library.aos.aos_get')
+    def test_vni_pool_bulk(self, mock_get, mock_post, mock_put, mock_delete):
+
+        mock_get.return_value = {'items': [{'id': 'vni-1',
+                                            'display_name': 'vni-1',
+                                            'status': 'not_in_use',
+                                            'ranges': [{'first': 5000,
+                                                        'last': 5100}]},
+                                           {'id': 'vni-2',
+                                            'display_name': 'vni-2',
+                                            'status': 'not_in_use',
+                                            'ranges': []}]}
+        mock_put.return_value = mock.MagicMock(ok=True)
+        mock_delete.return_value = mock.MagicMock(ok=True)
+        module = mock.MagicMock(check_mode=False)
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'vni-1',
+                                    'ranges': [[5101, 5200]]},
+                                   {'name': 'vni-2', 'state': 'absent'},
+                                   {'name': 'vni-3',
+                                    'ranges': [[6000, 6100]]}]}
+
+        aos_vni_pool.vni_pool_bulk(module)
+
+        mock_put.assert_called_once_with(
+            'session', aos_vni_pool.ENDPOINT + '/vni-1',
+            {'ranges': [{'first': 5000, 'last': 5200}],
+             'display_name': 'vni-1', 'id': 'vni-1'})
+        mock_delete.assert_called_once_with('session', aos_vni_pool.ENDPOINT,
+                                            'vni-2')
+        assert mock_post.call_args[0][2]['display_name'] == 'vni-3'
+        results = module.exit_json.call_args[1]
+        assert results['changed']
+        assert [p['name'] for p in results['pools']] == ['vni-1', 'vni-2',
+                                                         'vni-3']
+
+    @mock.patch('library.aos_vni_pool.aos_delete')
+    @mock.patch('library.aos.aos_get')
+    def test_vni_pool_bulk_delete_failed(self, mock_get, mock_delete):
+
+        mock_get.return_value = {'items': [{'id': 'vni-1',
+                                            'display_name': 'vni-1',
+                                            'status': 'not_in_use',
+                                            'ranges': []}]}
+        mock_delete.return_value = mock.MagicMock(ok=False, status_code=500,
+                                                  text='server error')
+        module = mock.MagicMock(check_mode=False)
+        module.fail_json.side_effect = SystemExit
+        module.params = {'session': 'session',
+                         'concurrency': 4,
+                         'check_conflicts': False,
+                         'pools': [{'name': 'vni-1', 'state': 'absent'}]}
+
+        with pytest.raises(SystemExit):
+            aos_vni_pool.vni_pool_bulk(module)
+
+        result = module.fail_json.call_args[1]
+        assert not result['changed']
+        assert result['pools'][0]['value']['msg'] == \
+            "Unable to delete VNI Pool vni-1: 500 server error"
@@ -0,0 +1,188 @@
+# Copyright (c) 2017 Apstra Inc, <community@apstra.com>
+
+import json
+import mock
+import pytest
+import library.aos as aos
+import library.aos_asn_pool as aos_asn_pool
+import library.aos_bp_deploy as aos_bp_deploy
+import library.aos_bp_reconcile as aos_bp_reconcile
+from tests.mock_aos_server import start_mock_server
+
+
+@pytest.fixture(params=['requests', 'urllib3'])
+def mock_aos(request, tmp_path, monkeypatch):
+    server = start_mock_server(nodes=50, vns=20, pools=5, deploy_polls=2)
+
+    monkeypatch.setenv('AOS_HTTP_TRANSPORT', request.param)
+    monkeypatch.setenv('AOS_API_SCHEME', 'http')
+    monkeypatch.setenv('AOS_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('AOS_RETRY_BACKOFF', '0')
+    aos.close_pooled_sessions()
+    aos._blueprint_versions.clear()
+
+    yield server
+
+    aos.close_pooled_sessions()
+    server.shutdown()
+    server.server_close()
+
+
+def login(server):
+    token, _ = aos.aos_token(server.address, 'admin', 'admin')
+    return {'server': server.address, 'user': 'admin', 'token': token}
+
+
+def make_module(**params):
+    module = mock.MagicMock(check_mode=False)
+    module.exit_json.side_effect = SystemExit
+    module.fail_json.side_effect = SystemExit
+    module.params = params
+    return module
+
+
+class TestMockAosServer(object):
+
+    def test_login_token_cached(self, mock_aos):
+
+        first = login(mock_aos)
+        assert aos.aos_token(mock_aos.address, 'admin', 'admin') == \
+            (first['token'], False)
+        assert mock_aos.aos.requests == 1
+
+    def test_find_resource_item(self, mock_aos):
+
+        session = login(mock_aos)
+
+        assert aos.find_resource_item(session, 'resources/asn-pools',
+                                      name='asn-3')['id'] == 'asn-3'
+        assert aos.find_resource_item(session, 'resources/asn-pools',
+                                      uuid='missing') == {}
+
+    def test_find_bp_system_nodes(self, mock_aos):
+
+        session = login(mock_aos)
+        nodes = aos.find_bp_system_nodes(session, 'bp-0',
+                                         ['node_1', 'node_7', 'unknown'])
+
+        assert [n['id'] for n in nodes] == ['node-1', 'node-7']
+
+    def test_asn_pool_bulk(self, mock_aos):
+
+        session = login(mock_aos)
+        module = make_module(session=session, concurrency=4,
+                             check_conflicts=True,
+                             pools=[{'name': 'new-1', 'ranges': [[90000,
+                                                                  90010]]},
+                                    {'name': 'asn-0', 'state': 'absent'}])
+
+        with pytest.raises(SystemExit):
+            aos_asn_pool.asn_pool_bulk(module)
+
+        assert module.exit_json.call_args[1]['changed']
+        assert 'new-1' in mock_aos.aos.pools['asn-pools']
+        assert 'asn-0' not in mock_aos.aos.pools['asn-pools']
+
+    def test_deploy_wait(self, mock_aos):
+
+        session = login(mock_aos)
+        mock_aos.aos.blueprints['bp-0']['version'] = 2
+        module = make_module(session=session, name=None, id='bp-0',
+                             wait=True, timeout=30, poll_interval=0.01,
+                             handle=None, blueprints=None, concurrency=4)
+
+        with pytest.raises(SystemExit):
+            aos_bp_deploy.aos_bp_deploy(module)
+
+        result = module.exit_json.call_args[1]
+        assert result['deploy_done']
+        assert result['deploy_state'] == 'success'
+
+    def test_reconcile_deploy(self, mock_aos):
+
+        session = login(mock_aos)
+        bp = mock_aos.aos.blueprints['bp-0']
+        module = make_module(session=session, blueprint_id='bp-0',
+                             security_zones=[{'name': 'tenant-a'}],
+                             virtual_networks=[
+                                 {'name': 'app', 'vn_type': 'vxlan',
+                                  'security_zone': 'tenant-a',
+                                  'bound_to_name': ['node_1', 'node_2']},
+                                 {'name': 'vn-0', 'state': 'absent'}],
+                             purge=False, deploy=True, wait=True, timeout=30,
+                             poll_interval=0.01, concurrency=4)
+
+        with pytest.raises(SystemExit):
+            aos_bp_reconcile.aos_bp_reconcile(module)
+
+        result = module.exit_json.call_args[1]
+        zone = [sz for sz in bp['security-zones'].values()
+                if sz['label'] == 'tenant-a'][0]
+        app = [vn for vn in bp['virtual-networks'].values()
+               if vn['label'] == 'app'][0]
+
+        assert [s['status'] for s in result['plan']] == ['done'] * 3
+        assert app['security_zone_id'] == zone['id']
+        assert 'vn-0' not in [vn['label']
+                              for vn in bp['virtual-networks'].values()]
+        assert result['deploy']['deploy_state'] == 'success'
+        assert bp['deployed']['version'] == bp['version']
+
+    def test_conditional_get(self, mock_aos, monkeypatch):
+
+        monkeypatch.setenv('AOS_HTTP_CACHE', 'true')
+        session = login(mock_aos)
+
+        first = aos.aos_get(session, 'resources/vni-pools')
+        sent = mock_aos.aos.bytes_sent
+        assert aos.aos_get(session, 'resources/vni-pools') == first
+        assert mock_aos.aos.bytes_sent == sent
+
+    def test_retry_injected_errors(self, mock_aos):
+
+        session = login(mock_aos)
+        mock_aos.aos.error_rate = 0.2
+
+        for _ in range(10):
+            assert aos.aos_get(session, 'blueprints')['items']
+
+    def test_request_timings(self, mock_aos, monkeypatch):
+
+        session = login(mock_aos)
+        aos.close_pooled_sessions()
+        monkeypatch.setenv('AOS_METRICS', 'true')
+        del aos._metrics[:]
+
+        aos.aos_get(session, 'blueprints')
+        list(aos.aos_get_items(session, 'resources/asn-pools'))
+
+        first, second = aos.aos_metrics()['calls']
+        assert not first['timings']['reused']
+        assert first['timings']['dns'] is not None
+        assert first['timings']['connect'] is not None
+        assert first['timings']['tls'] is None
+        assert 0 < first['timings']['ttfb'] <= first['timings']['total']
+        assert second['timings']['reused']
+        assert second['response_bytes'] > 0
+
+    def test_trace_retries(self, mock_aos, monkeypatch, tmp_path):
+
+        trace = tmp_path / 'trace.jsonl'
+        session = login(mock_aos)
+        monkeypatch.setenv('AOS_TRACE_FILE', str(trace))
+        monkeypatch.setenv('AOS_TRACE_FORMAT', 'otel')
+        mock_aos.aos.error_rate = 0.3
+        sent = mock_aos.aos.requests
+
+        for _ in range(10):
+            aos.aos_get(session, 'blueprints')
+
+        spans = [json.loads(line)['resourceSpans'][0]['scopeSpans'][0]
+                 ['spans'][0] for line in trace.read_text().splitlines()]
+        resent = sum(int(a['value']['intValue']) for s in spans
+                     for a in s['attributes']
+                     if a['key'] == 'http.request.resend_count')
+
+        assert len(spans) == 10
+        assert len(set(s['traceId'] for s in spans)) == 1
+        assert 10 + resent == mock_aos.aos.requests - sent